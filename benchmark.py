@@ -0,0 +1,245 @@
+import argparse
+import json
+import logging
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import unicorn
+from unicorn import UC_HOOK_MEM_WRITE
+from unicorn.arm_const import *
+
+from core import analysis, peripheral
+from emulator import Emulator, RAM_START_ADDRESS, RAM_SIZE, create_peripherals, DEFAULT_FIRMWARE, DEFAULT_RX_PACKET
+from core.logger import logger
+from core.scenario import repeat_packet
+from core.svd import SVD_PATH, parse_svd, load_register_map
+from core.vclock import VirtualClock, cycles_to_us
+
+DEFAULT_REPEAT = 5
+# emulated seconds for the throughput run, covers the startup delay and a few radio exchanges
+THROUGHPUT_SECONDS = 10
+MILESTONE_SECONDS = 6
+MMIO_ITERATIONS = 20000
+IRQ_ITERATIONS = 5000
+GPIO_OUTSET = 0x50000508
+RADIO_TASKS_TXEN = 0x40001000
+# one loop per peripheral model: (peripheral, written register, read register),
+# registers with python handlers so the loops measure the models. INTENSET and
+# OUTSET are stored to and their INTENCLR/OUTCLR halves read back, RTC1 moves
+# a compare and reads the counter. Timer is the firmware's hot path, a capture
+# task followed by reading CC[0]
+MMIO_LOOPS = [
+    ("CLOCK", 0x40000304, 0x40000308),
+    ("P0", 0x50000508, 0x5000050c),
+    ("RADIO", 0x40001304, 0x40001308),
+    ("RTC1", 0x40011540, 0x40011504),
+    ("TIMER0", 0x40008040, 0x40008540),
+]
+# loop: str r1, [r0]; ldr r1, [r3]; subs r2, #1; bne loop; b .
+MMIO_LOOP_CODE = bytes.fromhex('01601968013afbd1fee7')
+MMIO_LOOP_END = 8
+# the handler is never run, dispatch() only needs somewhere to return to
+IRQ_RETURN_ADDRESS = RAM_START_ADDRESS + 0x100
+BENCHES = ["startup", "throughput", "milestones", "mmio", "irq"]
+
+
+class Benchmark:
+    def __init__(self, firmware, base, repeat):
+        self.firmware = firmware
+        self.base = base
+        self.repeat = repeat
+        # name -> {unit, samples}
+        self.results = {}
+
+    def add(self, name, unit, value):
+        self.results.setdefault(name, {"unit": unit, "samples": []})["samples"].append(value)
+
+    def new_emulator(self):
+        emu = Emulator(self.firmware, self.base)
+        emu.scenario.load(repeat_packet(DEFAULT_RX_PACKET))
+        return emu
+
+    def bench_startup(self):
+        # each phase of building an emulator from nothing, process caches included
+        start = time.process_time()
+        parse_svd(SVD_PATH)
+        self.add("startup.svd_parse", "s", time.process_time() - start)
+
+        start = time.process_time()
+        load_register_map()
+        self.add("startup.svd_cache_load", "s", time.process_time() - start)
+
+        peripheral.SVD_PERIPHERALS.clear()
+        start = time.process_time()
+        create_peripherals(VirtualClock(), None)
+        self.add("startup.peripherals", "s", time.process_time() - start)
+
+        # cold: the firmware is analyzed from scratch, cached: loaded from the
+        # analysis cache. Both use a cache of their own, the real one is left alone
+        saved_dir = analysis.CACHE_DIR
+        with tempfile.TemporaryDirectory() as cache_dir:
+            analysis.CACHE_DIR = cache_dir
+            try:
+                analysis.ANALYSES.clear()
+                start = time.process_time()
+                self.new_emulator()
+                self.add("startup.emulator_cold", "s", time.process_time() - start)
+
+                analysis.ANALYSES.clear()
+                start = time.process_time()
+                self.new_emulator()
+                self.add("startup.emulator_cached", "s", time.process_time() - start)
+            finally:
+                analysis.CACHE_DIR = saved_dir
+
+        start = time.process_time()
+        self.new_emulator()
+        self.add("startup.emulator_warm", "s", time.process_time() - start)
+
+        # a fresh interpreter, imports and all
+        start = time.perf_counter()
+        subprocess.run([sys.executable, '-c', 'import emulator; emulator.Emulator(%r, %d)' % (self.firmware, self.base)],
+                       check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        self.add("startup.process", "s", time.perf_counter() - start)
+
+    def bench_throughput(self):
+        emu = self.new_emulator()
+        start = time.process_time()
+        emu.start(THROUGHPUT_SECONDS)
+        elapsed = time.process_time() - start
+        self.add("run.seconds", "s", elapsed)
+        self.add("run.instructions_per_second", "insn/s", emu.icount / elapsed)
+        self.add("run.virtual_speedup", "x", THROUGHPUT_SECONDS / elapsed)
+
+    def bench_milestones(self):
+        emu = self.new_emulator()
+        reached = {}
+
+        def milestone(name):
+            def cb(uc, access, address, size, value, user_data):
+                if name not in reached:
+                    reached[name] = (time.process_time() - start, emu.clock.time)
+            return cb
+        emu.uc.hook_add(UC_HOOK_MEM_WRITE, milestone("first_gpio_outset"), begin=GPIO_OUTSET, end=GPIO_OUTSET)
+        emu.uc.hook_add(UC_HOOK_MEM_WRITE, milestone("first_radio_tx"), begin=RADIO_TASKS_TXEN, end=RADIO_TASKS_TXEN)
+        start = time.process_time()
+        emu.start(MILESTONE_SECONDS)
+        for name, (elapsed, cycles) in reached.items():
+            self.add("milestone.%s" % name, "s", elapsed)
+            self.add("milestone.%s_virtual" % name, "us", cycles_to_us(cycles))
+
+    def bench_mmio(self):
+        # tight load/store loops in RAM against one register of every peripheral model
+        total_accesses = 0
+        total_time = 0
+        for name, write_address, read_address in MMIO_LOOPS:
+            emu = self.new_emulator()
+            emu.uc.mem_write(RAM_START_ADDRESS, MMIO_LOOP_CODE)
+            emu.uc.reg_write(UC_ARM_REG_R0, write_address)
+            emu.uc.reg_write(UC_ARM_REG_R1, 1)
+            emu.uc.reg_write(UC_ARM_REG_R2, MMIO_ITERATIONS)
+            emu.uc.reg_write(UC_ARM_REG_R3, read_address)
+            start = time.process_time()
+            emu.uc.emu_start(RAM_START_ADDRESS | 1, RAM_START_ADDRESS + MMIO_LOOP_END)
+            elapsed = time.process_time() - start
+            self.add("mmio.%s_accesses_per_second" % name, "access/s", 2 * MMIO_ITERATIONS / elapsed)
+            total_accesses += 2 * MMIO_ITERATIONS
+            total_time += elapsed
+        self.add("mmio.accesses_per_second", "access/s", total_accesses / total_time)
+
+    def bench_irq(self):
+        # NVIC entry and exit from python, what every interrupt costs on top of the handler
+        emu = self.new_emulator()
+        nvic = emu.nvic
+        irq = emu.peripherals['RADIO'].irq
+        nvic.enabled |= 1 << irq
+        emu.uc.reg_write(UC_ARM_REG_MSP, RAM_START_ADDRESS + RAM_SIZE)
+        level = logger.level
+        logger.setLevel(logging.WARNING)
+        enter = exit = 0
+        for _ in range(IRQ_ITERATIONS):
+            nvic.set_pending(irq)
+            start = time.process_time()
+            nvic.dispatch(IRQ_RETURN_ADDRESS)
+            middle = time.process_time()
+            nvic.exception_return(emu.uc.reg_read(UC_ARM_REG_LR))
+            enter += middle - start
+            exit += time.process_time() - middle
+        logger.setLevel(level)
+        self.add("irq.enter_us", "us", enter / IRQ_ITERATIONS * 1e6)
+        self.add("irq.exit_us", "us", exit / IRQ_ITERATIONS * 1e6)
+
+    def run(self, selected=None):
+        for i in range(self.repeat):
+            for name in BENCHES:
+                if selected and name not in selected:
+                    continue
+                getattr(self, "bench_" + name)()
+            logger.warning("[*] round %d/%d done", i + 1, self.repeat)
+        return self.report()
+
+    def report(self):
+        results = {}
+        for name, result in sorted(self.results.items()):
+            samples = result["samples"]
+            results[name] = {
+                "unit": result["unit"],
+                "median": statistics.median(samples),
+                "min": min(samples),
+                "max": max(samples),
+                "samples": samples,
+            }
+        return {
+            "commit": git_commit(),
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "unicorn": unicorn.__version__,
+            "machine": platform.machine(),
+            "firmware": self.firmware,
+            "repeat": self.repeat,
+            "results": results,
+        }
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def print_report(report, baseline=None):
+    print("[*] commit %s, %d rounds, median (min..max)" % (report["commit"], report["repeat"]))
+    for name, result in report["results"].items():
+        line = "    %-42s %14.6g %-8s (%.6g..%.6g)" % (name, result["median"], result["unit"],
+                                                       result["min"], result["max"])
+        old = baseline["results"].get(name) if baseline else None
+        if old and old["median"]:
+            line += " %+.1f%%" % ((result["median"] - old["median"]) / old["median"] * 100)
+        print(line)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="measure startup, throughput, MMIO and IRQ costs of the emulator")
+    parser.add_argument('-f', '--firmware', default=DEFAULT_FIRMWARE)
+    parser.add_argument('-b', '--base', type=lambda x: int(x, 0), default=0x0)
+    parser.add_argument('-r', '--repeat', type=int, default=DEFAULT_REPEAT, help="rounds, medians are reported")
+    parser.add_argument('-o', '--output', help="write the results to this JSON file")
+    parser.add_argument('-c', '--compare', help="JSON results of an earlier run to compare with")
+    parser.add_argument('-B', '--bench', action='append', choices=BENCHES, help="run only this benchmark, can be repeated")
+    args = parser.parse_args()
+
+    logger.setLevel(logging.WARNING)
+    report = Benchmark(args.firmware, args.base, args.repeat).run(args.bench)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as fp:
+            baseline = json.load(fp)
+    print_report(report, baseline)
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump(report, fp, indent=2)
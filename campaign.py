@@ -0,0 +1,130 @@
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import sys
+import time
+
+from emulator import Emulator, FAULT_HANDLERS, DEFAULT_FIRMWARE
+from core import run
+from core.peripheral import load_svd_peripherals
+from core.run import CpuException, Fault, RxWaiting
+from core.scenario import rx_packets
+from core.logger import logger
+
+DEFAULT_BUDGET = 2000000
+
+# one Worker per pool process, created by the pool initializer
+WORKER = None
+
+
+def job_target(job):
+    return (job.get("firmware", DEFAULT_FIRMWARE), job.get("base", 0))
+
+
+class Worker:
+    def __init__(self, targets):
+        logger.setLevel(logging.WARNING)
+        load_svd_peripherals()
+        # (firmware, base) -> (emulator, snapshot when the radio first listens)
+        self.targets = {}
+        for fw_path, base_addr in targets:
+            self.target(fw_path, base_addr)
+
+    def target(self, fw_path, base_addr):
+        key = (fw_path, base_addr)
+        if key not in self.targets:
+            emu = Emulator(fw_path, base_addr)
+            emu.scenario.load(())
+            emu.boot()
+            emu.run(conditions=[RxWaiting()])
+            emu.analysis.save()
+            self.targets[key] = (emu, emu.snapshot())
+        return self.targets[key]
+
+    def exit_reason(self, result):
+        if result.reason == RxWaiting.name:
+            # every scripted packet has been received and processed
+            return "done"
+        if result.reason == run.INSTRUCTIONS:
+            return "budget"
+        if result.reason == Fault.name:
+            return "fault handler 0x%x" % result.condition.address
+        if result.reason == CpuException.name:
+            return "exception %d" % result.condition.exc_no
+        if result.reason == run.ERROR:
+            return "uc error: %s" % result.error
+        return result.reason
+
+    def run(self, job):
+        start_time = time.time()
+        emu, snapshot = self.target(*job_target(job))
+        emu.restore(snapshot)
+        emu.scenario.load(rx_packets([bytes.fromhex(p) for p in job.get("packets", [])]))
+        gpio_trace = []
+        tx_packets = []
+        icount = emu.icount
+        radio = emu.peripherals['RADIO']
+        gpio = emu.peripherals['P0']
+        gpio.add_callback("outset", lambda value: gpio_trace.append([emu.icount - icount, "set", value]))
+        gpio.add_callback("outclr", lambda value: gpio_trace.append([emu.icount - icount, "clr", value]))
+        radio.add_callback("tx_en", lambda: tx_packets.append(radio.last_tx_packet.hex()))
+        result = emu.run(instructions=job.get("budget", DEFAULT_BUDGET),
+                         conditions=[RxWaiting(), Fault(FAULT_HANDLERS), CpuException()])
+        return {
+            "id": job.get("id"),
+            "exit_reason": self.exit_reason(result),
+            "instructions": result.instructions,
+            "gpio": gpio_trace,
+            "tx": tx_packets,
+            "pc": result.pc,
+            "wall_time": time.time() - start_time,
+            "pid": os.getpid(),
+        }
+
+
+def init_worker(targets):
+    global WORKER
+    WORKER = Worker(targets)
+
+def run_job(job):
+    return WORKER.run(job)
+
+def load_jobs(path):
+    jobs = []
+    with open(path, 'r') as fp:
+        for i, line in enumerate(fp):
+            line = line.strip()
+            if line:
+                job = json.loads(line)
+                job.setdefault("id", i)
+                jobs.append(job)
+    return jobs
+
+def run_campaign(jobs, out, processes=None):
+    # every worker boots each firmware once and forks all its jobs from that snapshot
+    targets = sorted(set(job_target(job) for job in jobs))
+    with multiprocessing.Pool(processes, initializer=init_worker, initargs=(targets,)) as pool:
+        for result in pool.imap_unordered(run_job, jobs):
+            out.write(json.dumps(result) + "\n")
+            out.flush()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="run a list of emulator jobs on all cores")
+    parser.add_argument('jobs', help="json lines, one job per line: "
+                        "{\"firmware\", \"base\", \"packets\": [hex], \"budget\": instructions}")
+    parser.add_argument('-o', '--output', help="json lines results, default stdout")
+    parser.add_argument('-j', '--processes', type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    jobs = load_jobs(args.jobs)
+    out = open(args.output, 'w') if args.output else sys.stdout
+    start_time = time.time()
+    try:
+        run_campaign(jobs, out, args.processes)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    print("[*] %d jobs in %.2fs" % (len(jobs), time.time() - start_time), file=sys.stderr)
@@ -0,0 +1,75 @@
+import argparse
+import logging
+import sys
+
+from emulator import Emulator, FAULT_HANDLERS, DEFAULT_FIRMWARE, DEFAULT_RX_PACKET
+from core.logger import logger
+from core.run import GpioBlinks, RadioTx, PcReached, Fault, SanitizerReport, TIME, INSTRUCTIONS
+from core.scenario import read_scenario, repeat_packet
+from core.timeline import write_vcd
+
+# the LED RadioTest_CR blinks
+DEFAULT_LED_PINS = 1 << 15
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="run a firmware headless until an expected event, exit status 0 if it happened")
+    parser.add_argument('-f', '--firmware', default=DEFAULT_FIRMWARE)
+    parser.add_argument('-b', '--base', type=lambda x: int(x, 0), default=0x0)
+    parser.add_argument('-s', '--seconds', type=float, default=20, help="virtual time budget")
+    parser.add_argument('-i', '--instructions', type=int, help="instruction budget")
+    parser.add_argument('--blinks', type=int, help="expect this many blinks (on/off cycles after the pin is set up) of --pins")
+    parser.add_argument('--pins', type=lambda x: int(x, 0), default=DEFAULT_LED_PINS, help="P0 pin mask for --blinks")
+    parser.add_argument('--tx', help="expect a radio transmission of this hex packet, 'any' for any packet")
+    parser.add_argument('--pc', type=lambda x: int(x, 0), action='append', help="expect this address to be reached, can be repeated")
+    parser.add_argument('--scenario', help="radio packets from this scenario file")
+    parser.add_argument('--vcd', help="write the GPIO timelines of the run to this VCD file")
+    parser.add_argument('--trace', help="write a trace of the run to this file, see tracedump.py")
+    parser.add_argument('--sanitize', action='store_true', help="fail on uninitialized RAM reads, stack overflow and radio DMA out of bounds")
+    parser.add_argument('--stack-size', type=lambda x: int(x, 0), help="stack size for --sanitize, guessed if not given")
+    args = parser.parse_args()
+
+    logger.setLevel(logging.WARNING)
+    emu = Emulator(args.firmware, args.base)
+    if args.scenario:
+        emu.scenario.load(read_scenario(args.scenario))
+    else:
+        emu.scenario.load(repeat_packet(DEFAULT_RX_PACKET))
+    expected = []
+    if args.blinks is not None:
+        expected.append(GpioBlinks(args.blinks, args.pins))
+    if args.tx is not None:
+        expected.append(RadioTx(None if args.tx == 'any' else bytes.fromhex(args.tx)))
+    for address in args.pc or []:
+        expected.append(PcReached(address))
+    failures = [Fault(FAULT_HANDLERS)]
+    if args.sanitize:
+        emu.start_sanitizer(args.stack_size)
+        failures.append(SanitizerReport())
+    if args.trace:
+        emu.start_trace(args.trace)
+    emu.boot()
+    result = emu.run(args.seconds, args.instructions, expected + failures)
+    emu.analysis.save()
+    print("[*] %s after %d instructions, %dus virtual, %.3fs, pc=0x%x" % (
+          result.reason, result.instructions, result.time, result.wall_time, result.pc))
+    if args.trace:
+        print("[*] %d trace records written to %s" % (emu.stop_trace().records, args.trace))
+    if result.error is not None:
+        print("[!] %s" % result.error)
+    if args.sanitize:
+        for key, report in emu.sanitizer.reports.items():
+            print("[!] %s of %d bytes at 0x%x, pc=0x%x, %d times" % (report.kind, report.size, report.address,
+                  report.pc, emu.sanitizer.counts[key]))
+    gpio = emu.peripherals['P0']
+    for pin in range(32):
+        if args.pins >> pin & 1:
+            widths = gpio.timelines["OUT"].blink_widths(pin)
+            print("[*] P0.%d: %d blinks, on for %s cycles" % (pin, len(widths),
+                  "%d-%d" % (min(widths), max(widths)) if widths else "0"))
+    if args.vcd:
+        ports = [emu.peripherals[name] for name in ("P0", "P1") if name in emu.peripherals]
+        write_vcd(args.vcd, [(port.get_name(), name, port.timelines[name]) for port in ports
+                             for name in ("OUT", "DIR", "IN")], emu.clock.time)
+    # without expectations running out the budget without a fault is a pass
+    sys.exit(0 if result.condition in expected or (not expected and result.reason in (TIME, INSTRUCTIONS)) else 1)
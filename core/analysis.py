@@ -0,0 +1,214 @@
+import bisect
+import hashlib
+import mmap
+import os
+import struct
+from collections import Counter, namedtuple
+
+from .logger import logger
+from .svd import CACHE_DIR
+
+# static facts about one firmware image at one base address, gathered once and
+# kept in CACHE_DIR so later runs don't need capstone at all. Blocks are the
+# translation blocks unicorn reported, added the first time one runs.
+#
+# The results also depend on how the emulator analyzes, which instructions
+# get hooks and what counts as a poll loop. That goes into the header as the
+# digest of analyzer_config(), a cache made with other settings is rebuilt.
+# Bump ANALYZER_VERSION when the analysis code changes what it finds.
+#
+# cache file layout (little endian):
+#   header, string table ('\0' separated), vector table words,
+#   hooked instruction, block and MMIO site records
+ANALYSIS_MAGIC = b'NRFFWAN2'
+ANALYZER_VERSION = 2
+HEADER = struct.Struct('<8s20s20sIIIIII')
+VECTOR_RECORD = struct.Struct('<I')
+# address, mnemonic
+HOOKED_RECORD = struct.Struct('<II')
+# address, size, instructions, flags, instructions of a poll loop iteration,
+# call target (0 if none), disassembly
+BLOCK_RECORD = struct.Struct('<IHHBBxxII')
+# block pc, register address
+SITE_RECORD = struct.Struct('<II')
+BLOCK_POLL = 1 << 0
+BLOCK_POLL_TIME = 1 << 1
+
+# a block closing a poll loop: instructions of one iteration, and whether it
+# samples time (see emulator.POLL_STORES)
+PollLoop = namedtuple('PollLoop', ['instructions', 'samples_time'])
+
+# (digest, config digest) -> FirmwareAnalysis, emulators in one process share it
+ANALYSES = {}
+
+
+class FirmwareAnalysis:
+    def __init__(self, name, digest, base_addr, config=b''):
+        self.name = name
+        self.digest = digest
+        self.base_addr = base_addr
+        # analyzer_config() digest of the settings it was made with
+        self.config = config
+        # raw words of the vector table, see emulator.parse_vector_table()
+        self.vector_words = []
+        # address -> mnemonic of instructions that get hooks
+        self.hooked = {}
+        # block address -> size, instruction count, disassembly, call target
+        self.sizes = {}
+        self.icounts = {}
+        self.disassembly = {}
+        self.calls = {}
+        # block address -> PollLoop
+        self.poll_blocks = {}
+        # (block pc, register address) of MMIO accesses seen in traces
+        self.mmio_sites = set()
+        # something was added since the cache was loaded or written
+        self.dirty = False
+
+    def add_block(self, address, size, insns, poll):
+        self.sizes[address] = size
+        self.icounts[address] = len(insns)
+        self.disassembly[address] = "\n".join("0x%x: %s %s" % (i.address, i.mnemonic, i.op_str) for i in insns)
+        if insns and insns[-1].mnemonic == "bl":
+            self.calls[address] = insns[-1].operands[0].imm
+        if poll is not None:
+            self.poll_blocks[address] = poll
+        self.dirty = True
+
+    def add_mmio_site(self, pc, address):
+        if (pc, address) not in self.mmio_sites:
+            self.mmio_sites.add((pc, address))
+            self.dirty = True
+
+    def functions(self):
+        # entry points: exception handlers and the targets of bl. Without
+        # symbols that is as close to function boundaries as it gets
+        entries = {word & ~1 for word in self.vector_words[1:] if word & 1}
+        entries.update(self.calls.values())
+        return sorted(entries)
+
+    def function_of(self, address, entries):
+        # nearest entry point at or below address, entries as from functions()
+        i = bisect.bisect_right(entries, address)
+        return entries[i - 1] if i else None
+
+    def save(self):
+        if self.dirty:
+            write_analysis(analysis_path(self.name, self.digest), self)
+            self.dirty = False
+
+
+def image_digest(content, base_addr):
+    digest = hashlib.sha1(content)
+    digest.update(struct.pack('<I', base_addr))
+    return digest.digest()
+
+def analyzer_config(*settings):
+    # digest of the analyzer settings (instruction lists, tables...) and ANALYZER_VERSION
+    return hashlib.sha1(repr((ANALYZER_VERSION,) + settings).encode()).digest()
+
+def analysis_path(name, digest):
+    return os.path.join(CACHE_DIR, "%s-%s.fwan" % (name, digest.hex()))
+
+def write_analysis(path, analysis):
+    strings = {}
+    def intern(s):
+        if s not in strings:
+            strings[s] = len(strings)
+        return strings[s]
+
+    vector_data = b''.join(VECTOR_RECORD.pack(word) for word in analysis.vector_words)
+    hooked_data = b''.join(HOOKED_RECORD.pack(address, intern(mnemonic))
+                           for address, mnemonic in sorted(analysis.hooked.items()))
+    block_data = bytearray()
+    for address in sorted(analysis.icounts):
+        poll = analysis.poll_blocks.get(address)
+        flags = 0
+        if poll is not None:
+            flags = BLOCK_POLL | (BLOCK_POLL_TIME if poll.samples_time else 0)
+        block_data += BLOCK_RECORD.pack(address, analysis.sizes[address], analysis.icounts[address], flags,
+                                        poll.instructions if poll is not None else 0,
+                                        analysis.calls.get(address, 0), intern(analysis.disassembly[address]))
+    site_data = b''.join(SITE_RECORD.pack(pc, address) for pc, address in sorted(analysis.mmio_sites))
+    strtab = '\0'.join(strings).encode()
+    header = HEADER.pack(ANALYSIS_MAGIC, analysis.digest, analysis.config, analysis.base_addr, len(analysis.vector_words),
+                         len(analysis.hooked), len(analysis.icounts), len(analysis.mmio_sites), len(strtab))
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # parallel workers may race on a cold cache, see svd.write_cache()
+    tmp_path = "%s.%d" % (path, os.getpid())
+    with open(tmp_path, 'wb') as fp:
+        fp.write(header + strtab + vector_data + hooked_data + block_data + site_data)
+    os.replace(tmp_path, path)
+
+def read_analysis(path, name, digest, config=b''):
+    # None if the file is of another image or made by another analyzer
+    with open(path, 'rb') as fp, mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        if len(mm) < HEADER.size:
+            return None
+        magic, file_digest, file_config, base_addr, n_vector, n_hooked, n_blocks, n_sites, strtab_len = \
+            HEADER.unpack_from(mm, 0)
+        if magic != ANALYSIS_MAGIC or file_digest != digest:
+            return None
+        if file_config != config:
+            logger.info("[*] analysis cache %s was made with other analyzer settings", path)
+            return None
+        analysis = FirmwareAnalysis(name, digest, base_addr, config)
+        offset = HEADER.size
+        strings = mm[offset:offset + strtab_len].decode().split('\0')
+        offset += strtab_len
+        end = offset + n_vector * VECTOR_RECORD.size
+        analysis.vector_words = [word for word, in VECTOR_RECORD.iter_unpack(mm[offset:end])]
+        offset = end
+        end = offset + n_hooked * HOOKED_RECORD.size
+        analysis.hooked = {address: strings[n] for address, n in HOOKED_RECORD.iter_unpack(mm[offset:end])}
+        offset = end
+        end = offset + n_blocks * BLOCK_RECORD.size
+        for address, size, icount, flags, poll_icount, call, text in BLOCK_RECORD.iter_unpack(mm[offset:end]):
+            analysis.sizes[address] = size
+            analysis.icounts[address] = icount
+            analysis.disassembly[address] = strings[text]
+            if call:
+                analysis.calls[address] = call
+            if flags & BLOCK_POLL:
+                analysis.poll_blocks[address] = PollLoop(poll_icount, bool(flags & BLOCK_POLL_TIME))
+        offset = end
+        end = offset + n_sites * SITE_RECORD.size
+        analysis.mmio_sites = set(SITE_RECORD.iter_unpack(mm[offset:end]))
+    return analysis
+
+def load_analysis(fw_path, content, base_addr, build, config=b''):
+    # build(analysis) fills in a fresh analysis when nothing usable is
+    # cached, config is the analyzer_config() of the caller
+    digest = image_digest(content, base_addr)
+    analysis = ANALYSES.get((digest, config))
+    if analysis is not None:
+        return analysis
+    name = os.path.splitext(os.path.basename(fw_path))[0]
+    path = analysis_path(name, digest)
+    if os.path.exists(path):
+        analysis = read_analysis(path, name, digest, config)
+    if analysis is None:
+        logger.info("[*] analyzing firmware %s", fw_path)
+        analysis = FirmwareAnalysis(name, digest, base_addr, config)
+        build(analysis)
+        analysis.dirty = True
+        analysis.save()
+    ANALYSES[(digest, config)] = analysis
+    return analysis
+
+
+def hot_blocks(analysis, counts, top=20):
+    # [(block, executions, instructions)] by instructions executed
+    blocks = [(address, n, n * analysis.icounts.get(address, 0)) for address, n in counts.items()]
+    blocks.sort(key=lambda block: block[2], reverse=True)
+    return blocks[:top]
+
+def hot_functions(analysis, counts, top=20, entries=None):
+    # [(entry point, instructions)], blocks are charged to the function they lie in.
+    # entries are the function addresses of the symbol table if the image has one
+    entries = entries or analysis.functions()
+    functions = Counter()
+    for address, n in counts.items():
+        functions[analysis.function_of(address, entries)] += n * analysis.icounts.get(address, 0)
+    return functions.most_common(top)
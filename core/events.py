@@ -0,0 +1,90 @@
+from collections import namedtuple
+
+from .logger import logger
+
+# tasks triggering events that trigger tasks... deeper than this is a loop
+# in the wiring, the rest of the chain is dropped
+MAX_DEPTH = 16
+
+# what an event is wired to: (peripheral, task address) pairs and whether
+# the peripheral raises its interrupt
+Route = namedtuple('Route', ['tasks', 'irq'])
+
+
+class EventBus:
+    # event/task wiring between the peripheral models of one emulator. A model
+    # publishes an event (IPeripheral.publish), the bus runs the tasks SHORTS
+    # and PPI channels wire it to and raises the interrupt if INTEN enables it,
+    # all before the publishing model carries on. The wiring of an event is
+    # compiled into a Route the first time it fires and kept until a register
+    # it depends on is written (IPeripheral.routing_registers), so firing an
+    # event costs a dict lookup.
+    def __init__(self, uc, task_handler):
+        self.uc = uc
+        # task address -> model handling it, None for tasks nothing models
+        self.task_handler = task_handler
+        # event address -> Route
+        self.routes = {}
+        # model routing events of other peripherals, see peripherals/ppi.py
+        self.ppi = None
+        # irq -> model raising it
+        self.irq_lines = {}
+        self.depth = 0
+        self.callbacks = {
+            # (peripheral, event address), every event published
+            "event": None
+        }
+
+    def add_callback(self, name, cb):
+        self.callbacks[name] = cb
+
+    def attach(self, peripheral):
+        peripheral.bus = self
+        if peripheral.get_name() == "PPI":
+            self.ppi = peripheral
+        if peripheral.irq is not None:
+            self.irq_lines[peripheral.irq] = peripheral
+        self.invalidate()
+
+    def invalidate(self):
+        self.routes.clear()
+
+    def interrupt_exit(self, irq):
+        # events the handler left set raise the interrupt again, with
+        # ADDRESS and END published at once the handler of one returns
+        # before it has seen the other
+        peripheral = self.irq_lines.get(irq)
+        if peripheral is not None and peripheral.irq_asserted():
+            peripheral.raise_irq()
+
+    def compile(self, peripheral, address):
+        tasks = peripheral.short_tasks(address)
+        if self.ppi is not None and peripheral.event_routed(address):
+            tasks += self.ppi.channel_tasks(address)
+        handlers = []
+        for task in tasks:
+            handler = self.task_handler(task)
+            if handler is not None:
+                handlers.append((handler, task))
+        return Route(tuple(handlers), peripheral.interrupt_enabled(address))
+
+    def publish(self, peripheral, address):
+        route = self.routes.get(address)
+        if route is None:
+            route = self.routes[address] = self.compile(peripheral, address)
+        cb = self.callbacks["event"]
+        if cb != None:
+            cb(peripheral, address)
+        if route.irq:
+            peripheral.raise_irq()
+        if not route.tasks:
+            return
+        if self.depth >= MAX_DEPTH:
+            logger.warning("[!] event 0x%x of %s loops through its tasks", address, peripheral.get_name())
+            return
+        self.depth += 1
+        try:
+            for handler, task in route.tasks:
+                handler.task(self.uc, task)
+        finally:
+            self.depth -= 1
@@ -1,130 +1,361 @@
-from unicorn.arm_const import *
+import ctypes
 import struct
+
+from unicorn import unicorn as unicorn_lib
+from unicorn import UcError, UC_MEM_READ, UC_MEM_WRITE
+from unicorn.arm_const import *
 from .logger import logger
 
-ARM_CTX_REGISTERS = [
-    UC_ARM_REG_XPSR,
-    UC_ARM_REG_PC,
-    UC_ARM_REG_LR,
-    UC_ARM_REG_R12,
-    UC_ARM_REG_R3,
-    UC_ARM_REG_R2,
-    UC_ARM_REG_R1,
+# nRF52840 has 48 peripheral interrupts, IRQ n is exception 16 + n
+NUM_IRQS = 48
+IRQ_EXCEPTION_BASE = 16
+
+NVIC_ISER = 0xe000e100
+NVIC_ICER = 0xe000e180
+NVIC_ISPR = 0xe000e200
+NVIC_ICPR = 0xe000e280
+NVIC_IABR = 0xe000e300
+NVIC_IPR = 0xe000e400
+NVIC_END = NVIC_IPR + NUM_IRQS - 1
+SCB_VTOR = 0xe000ed08
+
+# only the top 3 bits of a priority are implemented
+PRIORITY_MASK = 0xe0
+# lower than any exception, what thread mode runs at
+THREAD_PRIORITY = 0x100
+
+XPSR_T_BIT = 1 << 24
+XPSR_ALIGN_BIT = 1 << 9
+CONTROL_NPRIV = 1 << 0
+CONTROL_SPSEL = 1 << 1
+CONTROL_FPCA = 1 << 2
+EXC_RETURN_PSP = 1 << 2
+EXC_RETURN_THREAD = 1 << 3
+EXC_RETURN_BASIC_FRAME = 1 << 4
+# special registers of mrs/msr by SYSm, 0-7 are the xPSR views
+SYSM_MSP = 8
+SYSM_PSP = 9
+SYSM_PRIMASK = 16
+SYSM_BASEPRI = 17
+SYSM_BASEPRI_MAX = 18
+SYSM_FAULTMASK = 19
+SYSM_CONTROL = 20
+XPSR_APSR_BITS = 0xf80f0000
+XPSR_IPSR_BITS = 0x1ff
+
+# stack frame in memory order, the extended frame adds the fp
+# registers and a reserved word on top of the basic one
+FRAME_REGISTERS = [
     UC_ARM_REG_R0,
+    UC_ARM_REG_R1,
+    UC_ARM_REG_R2,
+    UC_ARM_REG_R3,
+    UC_ARM_REG_R12,
+    UC_ARM_REG_LR,
+    UC_ARM_REG_PC,
+    UC_ARM_REG_XPSR,
 ]
-
-ARMCTX_EXTRA_REGISTERS = [
+FP_FRAME_REGISTERS = [
+    UC_ARM_REG_S0, UC_ARM_REG_S1, UC_ARM_REG_S2, UC_ARM_REG_S3,
+    UC_ARM_REG_S4, UC_ARM_REG_S5, UC_ARM_REG_S6, UC_ARM_REG_S7,
+    UC_ARM_REG_S8, UC_ARM_REG_S9, UC_ARM_REG_S10, UC_ARM_REG_S11,
+    UC_ARM_REG_S12, UC_ARM_REG_S13, UC_ARM_REG_S14, UC_ARM_REG_S15,
     UC_ARM_REG_FPSCR,
-    UC_ARM_REG_S15,
-    UC_ARM_REG_S14,
-    UC_ARM_REG_S13,
-    UC_ARM_REG_S12,
-    UC_ARM_REG_S11,
-    UC_ARM_REG_S10,
-    UC_ARM_REG_S9,
-    UC_ARM_REG_S8,
-    UC_ARM_REG_S7,
-    UC_ARM_REG_S6,
-    UC_ARM_REG_S5,
-    UC_ARM_REG_S4,
-    UC_ARM_REG_S3,
-    UC_ARM_REG_S2,
-    UC_ARM_REG_S1,
-    UC_ARM_REG_S0,
 ]
+FRAME = struct.Struct('<8I')
+FP_FRAME = struct.Struct('<17I4x')
+FRAME_SIZE = FRAME.size
+FP_FRAME_SIZE = FRAME.size + FP_FRAME.size
+
 
-def interrupt_enter(irq_num, uc, fw_base_addr):
-    # read handler address from vector table
-    vector_addr = (irq_num * 4) + fw_base_addr
-    data = uc.mem_read(vector_addr, 4)
-    handler_addr = struct.unpack('<I', data)[0]
-    control = uc.reg_read(UC_ARM_REG_CONTROL)
-    spsel_bit = (control & 0b10 == 0b10)
-    fpca_bit = (control & 0b100 == 0b100)   
-    # save registers
-    #print("before saving context")
-    #dump_ctx_registers(uc)
-    save_context(uc, spsel_bit, fpca_bit)
-    # put magic value in LR and call handler
-    lr = 0xffffffe9
-    if spsel_bit:
-        lr |= 0b100
-    if not fpca_bit:
-        lr |= 0b10000
-    uc.reg_write(UC_ARM_REG_LR, lr)
-    uc.reg_write(UC_ARM_REG_IPSR, irq_num)
-    uc.reg_write(UC_ARM_REG_PC, handler_addr)
-    logger.info("[*] entering interrupt %d, spsel=%r fpca=%r handler_addr=0x%x sp=0x%x", irq_num, spsel_bit, fpca_bit, handler_addr, uc.reg_read(UC_ARM_REG_SP))
-
-def interrupt_return(uc):
-    lr = uc.reg_read(UC_ARM_REG_LR)
-    irq_num = uc.reg_read(UC_ARM_REG_IPSR)
-    if lr & 0xffffff00 == 0xffffff00:
-        spsel = (lr & 0b100 != 0)
-        fpca = (lr & 0b10000 == 0)
-        restore_context(uc, spsel, fpca)
-        #print("after restoring context")
-        #dump_ctx_registers(uc)
-        pc = uc.reg_read(UC_ARM_REG_PC)
-        sp = uc.reg_read(UC_ARM_REG_SP)
-        logger.info("[*] returning from interrupt %d spel=%r fpca=%r lr=%x pc=0x%x sp=0x%x", irq_num, spsel, fpca, lr, pc, sp)
-        # set control register
-        ctrl = 0
-        if spsel:
-            ctrl |= 0b10
-        if fpca:
-            ctrl |= 0b100
-        uc.reg_write(UC_ARM_REG_CONTROL, ctrl)
-    else:
-        control = uc.reg_read(UC_ARM_REG_CONTROL)
-        spsel_bit = (control & 0b10 == 0b10)
-        fpca_bit = (control & 0b100 == 0b100)
-        restore_context(uc, spsel_bit, fpca_bit)
-        #print("after restoring context")
-        #dump_ctx_registers(uc)
-        pc = uc.reg_read(UC_ARM_REG_PC)
-        sp = uc.reg_read(UC_ARM_REG_SP)
-        logger.info("[*] returning from interrupt %d pc=0x%x sp=0x%x", irq_num, pc, sp)        
-
-def save_context(uc, spsel_bit, fpca_bit):
-    sp_reg = UC_ARM_REG_MSP
-    if spsel_bit:
-        sp_reg = UC_ARM_REG_PSP
-    
-    sp = uc.reg_read(sp_reg)
-    if fpca_bit:
-        #print("saving extended registers")
-        for reg in ARMCTX_EXTRA_REGISTERS:
-            val = uc.reg_read(reg)
-            sp -= 4
-            uc.mem_write(sp, val.to_bytes(4, 'little'))
-    for reg in ARM_CTX_REGISTERS:
-        val = uc.reg_read(reg)
-        sp -= 4
-        uc.mem_write(sp, val.to_bytes(4, 'little'))
-    
-    uc.reg_write(UC_ARM_REG_SP, sp)
-
-def restore_context(uc, spsel, fpca):
-    sp_reg = UC_ARM_REG_MSP
-    if spsel:
-        sp_reg = UC_ARM_REG_PSP        
-    sp = uc.reg_read(sp_reg)    
-    for reg in ARM_CTX_REGISTERS[::-1]:
-        data = uc.mem_read(sp, 4)
-        val = struct.unpack('<I', data)[0]
-        sp += 4
-        uc.reg_write(reg, val)
-    if fpca:
-        #print("restoring extended registers")
-        for reg in ARMCTX_EXTRA_REGISTERS[::-1]:
-            data = uc.mem_read(sp, 4)
-            val = struct.unpack('<I', data)[0]
+class RegisterBatch:
+    # reads or writes a fixed list of 32 bit registers in one call into unicorn
+    def __init__(self, uc, registers):
+        self.uc = uc
+        self.count = len(registers)
+        self.registers = (ctypes.c_int * self.count)(*registers)
+        self.values = (ctypes.c_uint32 * self.count)()
+        base = ctypes.addressof(self.values)
+        self.pointers = (ctypes.c_void_p * self.count)(*[base + 4 * i for i in range(self.count)])
+
+    def read(self):
+        status = unicorn_lib._uc.uc_reg_read_batch(self.uc._uch, self.registers, self.pointers, self.count)
+        if status != 0:
+            raise UcError(status)
+        return self.values
+
+    def write(self, values):
+        self.values[:] = values
+        status = unicorn_lib._uc.uc_reg_write_batch(self.uc._uch, self.registers, self.pointers, self.count)
+        if status != 0:
+            raise UcError(status)
+
+
+class NVIC:
+    def __init__(self, uc, vector_base):
+        self.uc = uc
+        self.vtor = vector_base
+        # bit n is IRQ n
+        self.enabled = 0
+        self.pending = 0
+        self.priorities = [0] * NUM_IRQS
+        # IRQs being handled, innermost last
+        self.active = []
+        # some enabled IRQ may preempt what is running right now
+        self.ready = False
+        # unicorn keeps PRIMASK, these two only exist here. Nonzero BASEPRI
+        # masks IRQs of that priority and lower, FAULTMASK all of them
+        self.basepri = 0
+        self.faultmask = 0
+        self.callbacks = {
+            "enter": None,
+            "exit": None
+        }
+        self.entry_regs = RegisterBatch(uc, FRAME_REGISTERS + [UC_ARM_REG_CONTROL, UC_ARM_REG_MSP,
+                                                               UC_ARM_REG_PSP])
+        self.entry_writes = RegisterBatch(uc, [UC_ARM_REG_IPSR, UC_ARM_REG_CONTROL, UC_ARM_REG_MSP,
+                                               UC_ARM_REG_PSP, UC_ARM_REG_LR, UC_ARM_REG_PC])
+        self.return_regs = RegisterBatch(uc, [UC_ARM_REG_CONTROL, UC_ARM_REG_MSP, UC_ARM_REG_PSP])
+        self.return_writes = RegisterBatch(uc, [UC_ARM_REG_XPSR, UC_ARM_REG_IPSR, UC_ARM_REG_CONTROL,
+                                                UC_ARM_REG_MSP, UC_ARM_REG_PSP] + FRAME_REGISTERS[:6] + [UC_ARM_REG_PC])
+        self.tail_chain_writes = RegisterBatch(uc, [UC_ARM_REG_IPSR, UC_ARM_REG_LR, UC_ARM_REG_PC])
+        self.fp_regs = RegisterBatch(uc, FP_FRAME_REGISTERS)
+
+    def add_callback(self, name, cb):
+        self.callbacks[name] = cb
+
+    def save_state(self):
+        return (self.vtor, self.enabled, self.pending, list(self.priorities), list(self.active),
+                self.basepri, self.faultmask)
+
+    def load_state(self, state):
+        self.vtor, self.enabled, self.pending, priorities, active, self.basepri, self.faultmask = state
+        self.priorities = list(priorities)
+        self.active = list(active)
+        self.update()
+
+    def set_pending(self, irq):
+        self.pending |= 1 << irq
+        self.update()
+
+    def clear_pending(self, irq):
+        self.pending &= ~(1 << irq)
+        self.update()
+
+    def execution_priority(self):
+        if self.active:
+            return min(self.priorities[irq] for irq in self.active)
+        return THREAD_PRIORITY
+
+    def next_pending(self):
+        # highest priority (lowest value, then lowest number) IRQ that preempts the running code
+        candidates = self.pending & self.enabled
+        best = None
+        limit = self.execution_priority()
+        if self.basepri and self.basepri < limit:
+            limit = self.basepri
+        while candidates:
+            irq = (candidates & -candidates).bit_length() - 1
+            candidates &= candidates - 1
+            if self.priorities[irq] < limit and (best is None or self.priorities[irq] < self.priorities[best]):
+                best = irq
+        return best
+
+    def update(self):
+        self.ready = self.pending & self.enabled != 0 and self.next_pending() is not None
+
+    def handler_address(self, irq):
+        data = self.uc.mem_read(self.vtor + (IRQ_EXCEPTION_BASE + irq) * 4, 4)
+        return struct.unpack('<I', data)[0]
+
+    def dispatch(self, return_address):
+        # take the next pending IRQ, return_address is where the interrupted
+        # code continues (the pc unicorn reports in a block hook is stale).
+        # While PRIMASK is set nothing is taken and ready stays as it is,
+        # that costs one register read per block until cpsie
+        if self.faultmask or self.uc.reg_read(UC_ARM_REG_PRIMASK) & 1:
+            return False
+        irq = self.next_pending()
+        if irq is None:
+            self.ready = False
+            return False
+        values = self.entry_regs.read()
+        r0, r1, r2, r3, r12, lr, pc, xpsr, control, msp, psp = values
+        self.pending &= ~(1 << irq)
+        self.active.append(irq)
+        self.update()
+
+        fp_frame = control & CONTROL_FPCA
+        use_psp = control & CONTROL_SPSEL and not (xpsr & 0x1ff)
+        sp = psp if use_psp else msp
+        size = FP_FRAME_SIZE if fp_frame else FRAME_SIZE
+        xpsr |= XPSR_T_BIT
+        if sp & 4:
+            xpsr |= XPSR_ALIGN_BIT
+        else:
+            xpsr &= ~XPSR_ALIGN_BIT
+        frame_ptr = (sp - size) & ~7
+        frame = FRAME.pack(r0, r1, r2, r3, r12, lr, return_address & ~1, xpsr)
+        if fp_frame:
+            frame += FP_FRAME.pack(*self.fp_regs.read())
+        self.uc.mem_write(frame_ptr, frame)
+
+        exc_return = 0xffffffe1
+        if not fp_frame:
+            exc_return |= EXC_RETURN_BASIC_FRAME
+        if not (xpsr & 0x1ff):
+            exc_return |= EXC_RETURN_THREAD
+            if use_psp:
+                exc_return |= EXC_RETURN_PSP
+                psp = frame_ptr
+            else:
+                msp = frame_ptr
+        else:
+            msp = frame_ptr
+        handler = self.handler_address(irq)
+        # handlers always run on the main stack with a fresh fp context
+        self.entry_writes.write([IRQ_EXCEPTION_BASE + irq, control & ~(CONTROL_SPSEL | CONTROL_FPCA),
+                                 msp, psp, exc_return, handler | 1])
+        logger.info("[*] entering interrupt %d, handler_addr=0x%x sp=0x%x", IRQ_EXCEPTION_BASE + irq, handler, frame_ptr)
+        cb = self.callbacks["enter"]
+        if cb != None:
+            cb(irq)
+        return True
+
+    def exception_return(self, exc_return):
+        irq = self.active.pop() if self.active else None
+        cb = self.callbacks["exit"]
+        if cb != None and irq is not None:
+            cb(irq)
+
+        # tail chaining: the frame on the stack is reused as is, the next
+        # handler returns with the same EXC_RETURN
+        nxt = self.next_pending()
+        if nxt is not None:
+            self.pending &= ~(1 << nxt)
+            self.active.append(nxt)
+            self.update()
+            self.tail_chain_writes.write([IRQ_EXCEPTION_BASE + nxt, exc_return, self.handler_address(nxt) | 1])
+            logger.info("[*] tail chaining interrupt %d into %d",
+                        IRQ_EXCEPTION_BASE + irq if irq is not None else 0, IRQ_EXCEPTION_BASE + nxt)
+            cb = self.callbacks["enter"]
+            if cb != None:
+                cb(nxt)
+            return
+        self.update()
+
+        control, msp, psp = self.return_regs.read()
+        use_psp = exc_return & EXC_RETURN_PSP and exc_return & EXC_RETURN_THREAD
+        sp = psp if use_psp else msp
+        fp_frame = not (exc_return & EXC_RETURN_BASIC_FRAME)
+        size = FP_FRAME_SIZE if fp_frame else FRAME_SIZE
+        data = self.uc.mem_read(sp, size)
+        r0, r1, r2, r3, r12, lr, pc, xpsr = FRAME.unpack_from(data)
+        if fp_frame:
+            self.fp_regs.write(FP_FRAME.unpack_from(data, FRAME_SIZE))
+        sp += size
+        if xpsr & XPSR_ALIGN_BIT:
             sp += 4
-            uc.reg_write(reg, val)
+        if use_psp:
+            psp = sp
+        else:
+            msp = sp
+        # nPRIV is left as the handler found it
+        control &= CONTROL_NPRIV
+        if use_psp:
+            control |= CONTROL_SPSEL
+        if fp_frame:
+            control |= CONTROL_FPCA
+        self.return_writes.write([xpsr | XPSR_T_BIT, xpsr & 0x1ff, control, msp, psp,
+                                  r0, r1, r2, r3, r12, lr, pc | 1])
+        logger.info("[*] returning from interrupt %d pc=0x%x sp=0x%x",
+                    IRQ_EXCEPTION_BASE + irq if irq is not None else 0, pc, sp)
+
+    def read_special(self, sysm):
+        # mrs
+        if sysm < SYSM_MSP:
+            mask = XPSR_IPSR_BITS if sysm & 1 else 0
+            if not sysm & 4:
+                mask |= XPSR_APSR_BITS
+            return self.uc.reg_read(UC_ARM_REG_XPSR) & mask
+        if sysm == SYSM_MSP:
+            return self.uc.reg_read(UC_ARM_REG_MSP)
+        if sysm == SYSM_PSP:
+            return self.uc.reg_read(UC_ARM_REG_PSP)
+        if sysm == SYSM_PRIMASK:
+            return self.uc.reg_read(UC_ARM_REG_PRIMASK) & 1
+        if sysm in (SYSM_BASEPRI, SYSM_BASEPRI_MAX):
+            return self.basepri
+        if sysm == SYSM_FAULTMASK:
+            return self.faultmask
+        if sysm == SYSM_CONTROL:
+            return self.uc.reg_read(UC_ARM_REG_CONTROL)
+        return 0
+
+    def write_special(self, sysm, value):
+        # msr, and cpsid/cpsie for PRIMASK and FAULTMASK
+        if sysm < 4:
+            xpsr = self.uc.reg_read(UC_ARM_REG_XPSR)
+            self.uc.reg_write(UC_ARM_REG_XPSR, (xpsr & ~XPSR_APSR_BITS) | (value & XPSR_APSR_BITS))
+        elif sysm == SYSM_MSP:
+            self.uc.reg_write(UC_ARM_REG_MSP, value & ~3)
+        elif sysm == SYSM_PSP:
+            self.uc.reg_write(UC_ARM_REG_PSP, value & ~3)
+        elif sysm == SYSM_PRIMASK:
+            self.uc.reg_write(UC_ARM_REG_PRIMASK, value & 1)
+        elif sysm == SYSM_BASEPRI:
+            self.basepri = value & PRIORITY_MASK
+        elif sysm == SYSM_BASEPRI_MAX:
+            # only ever raises the masking
+            value &= PRIORITY_MASK
+            if value and (not self.basepri or value < self.basepri):
+                self.basepri = value
+        elif sysm == SYSM_FAULTMASK:
+            self.faultmask = value & 1
+        elif sysm == SYSM_CONTROL:
+            control = self.uc.reg_read(UC_ARM_REG_CONTROL)
+            self.uc.reg_write(UC_ARM_REG_CONTROL, (control & ~(CONTROL_NPRIV | CONTROL_SPSEL)) |
+                              (value & (CONTROL_NPRIV | CONTROL_SPSEL)))
+        self.update()
+
+    def uc_mem_cb(self, uc, access, address, size, value, user_data):
+        if access == UC_MEM_READ:
+            word = address & ~3
+            uc.mem_write(word, self.read_register(word).to_bytes(4, 'little'))
+        elif access == UC_MEM_WRITE:
+            self.write_register(address, size, value)
+
+    def read_register(self, address):
+        if address == SCB_VTOR:
+            return self.vtor
+        if address >= NVIC_IPR:
+            n = address - NVIC_IPR
+            return int.from_bytes(bytes(self.priorities[n:n + 4]).ljust(4, b'\0'), 'little')
+        shift = (address & 0x7f) // 4 * 32
+        if address < NVIC_ISPR:
+            bits = self.enabled
+        elif address < NVIC_IABR:
+            bits = self.pending
+        else:
+            bits = sum(1 << irq for irq in self.active)
+        return (bits >> shift) & 0xffffffff
 
-    uc.reg_write(UC_ARM_REG_SP, sp)
-   
-def dump_ctx_registers(uc):
-    for reg in ARM_CTX_REGISTERS:
-        logger.debug("%s %x", reg, uc.reg_read(reg))
+    def write_register(self, address, size, value):
+        if address == SCB_VTOR:
+            self.vtor = value & 0xffffff80
+        elif address >= NVIC_IPR:
+            n = address - NVIC_IPR
+            for i in range(size):
+                if n + i < NUM_IRQS:
+                    self.priorities[n + i] = (value >> (8 * i)) & PRIORITY_MASK
+        elif address < NVIC_IABR:
+            bits = (value & 0xffffffff) << ((address & 0x7f) // 4 * 32)
+            if address < NVIC_ICER:
+                self.enabled |= bits
+            elif address < NVIC_ISPR:
+                self.enabled &= ~bits
+            elif address < NVIC_ICPR:
+                self.pending |= bits
+            else:
+                self.pending &= ~bits
+        self.update()
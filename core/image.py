@@ -0,0 +1,255 @@
+import bisect
+import hashlib
+import mmap
+import os
+import struct
+from array import array
+from collections import namedtuple
+
+from .logger import logger
+from .svd import CACHE_DIR
+
+# firmware images as the programmer writes them: raw .bin at a given base,
+# ELF (PT_LOAD segments at their load address) or Intel HEX. Files are
+# mmapped, segments of .bin and ELF images are views of the mapping so the
+# only copy is the one into guest memory. Initialized data is loaded where
+# the linker put its initial values, in flash, and the startup code copies it
+# to RAM as on the device. UICR contents go to the UICR.
+
+# address, bytes (memoryview of the file, or bytearray for HEX) and size in
+# memory, the bytes are zero padded to it (.bss)
+Segment = namedtuple('Segment', ['address', 'data', 'size'])
+# function or object of the symbol table
+Symbol = namedtuple('Symbol', ['address', 'size', 'name'])
+
+FLASH_END = 0x100000
+
+ELF_MAGIC = b'\x7fELF'
+# 32 bit little endian ELF, the parts of it the loader needs
+ELF_HEADER = struct.Struct('<16sHHIIIIIHHHHHH')
+PROGRAM_HEADER = struct.Struct('<IIIIIIII')
+SECTION_HEADER = struct.Struct('<IIIIIIIIII')
+ELF_SYMBOL = struct.Struct('<IIIBBH')
+PT_LOAD = 1
+SHT_SYMTAB = 2
+STT_OBJECT = 1
+STT_FUNC = 2
+
+# Intel HEX record types
+HEX_DATA = 0
+HEX_EOF = 1
+HEX_SEGMENT = 2
+HEX_START_SEGMENT = 3
+HEX_LINEAR = 4
+HEX_START_LINEAR = 5
+
+# symbol cache file layout (little endian):
+#   header, string table ('\0' separated), symbol records
+SYMBOLS_MAGIC = b'NRFSYMS1'
+SYMBOLS_HEADER = struct.Struct('<8s20sII')
+# address, size, the name is the string of the same index
+SYMBOL_RECORD = struct.Struct('<II')
+
+
+class SymbolIndex:
+    # address <-> name of the functions and objects of an image, sorted by
+    # address so an address is named with one bisect
+    def __init__(self, symbols=()):
+        symbols = sorted(symbols)
+        self.addresses = array('I', [symbol.address for symbol in symbols])
+        self.symbols = symbols
+        self.by_name = {symbol.name: symbol for symbol in symbols}
+
+    def __len__(self):
+        return len(self.symbols)
+
+    def lookup(self, address):
+        # (Symbol, offset) of the symbol address lies in, None if it is in none.
+        # Symbols without a size cover everything up to the next one
+        i = bisect.bisect_right(self.addresses, address) - 1
+        if i < 0:
+            return None
+        symbol = self.symbols[i]
+        if symbol.size and address >= symbol.address + symbol.size:
+            return None
+        return symbol, address - symbol.address
+
+    def name(self, address):
+        # 'name+0x12' or the bare address
+        found = self.lookup(address)
+        if found is None:
+            return "0x%x" % address
+        symbol, offset = found
+        return "%s+0x%x" % (symbol.name, offset) if offset else symbol.name
+
+    def address(self, name):
+        # inverse of name(), 'name', 'name+0x12' or a number
+        name, _, offset = name.partition('+')
+        offset = int(offset, 0) if offset else 0
+        symbol = self.by_name.get(name)
+        if symbol is not None:
+            return symbol.address + offset
+        try:
+            return int(name, 0) + offset
+        except ValueError:
+            raise KeyError("no symbol %s" % name)
+
+    def functions(self):
+        return [symbol.address for symbol in self.symbols]
+
+
+class FirmwareImage:
+    def __init__(self, path, kind, digest):
+        self.path = path
+        self.name = os.path.splitext(os.path.basename(path))[0]
+        self.kind = kind
+        # sha1 of the file
+        self.digest = digest
+        self.segments = []
+        self.entry = None
+        self.symbols = SymbolIndex()
+        self.mm = None
+        self.view = None
+
+    def flash_range(self):
+        # (begin, end) of what the image has in flash
+        flash = [segment for segment in self.segments if segment.address < FLASH_END or self.kind == 'bin']
+        if not flash:
+            raise ValueError("%s has nothing in flash" % self.path)
+        return (min(segment.address for segment in flash),
+                max(segment.address + segment.size for segment in flash))
+
+    def close(self):
+        # segments of the mapping can't be used after this
+        for segment in self.segments:
+            if isinstance(segment.data, memoryview):
+                segment.data.release()
+        self.segments = []
+        if self.mm is not None:
+            self.view.release()
+            self.mm.close()
+            self.mm = None
+
+
+def load_image(path, base_addr=0):
+    # base_addr only places .bin images, the others say where they go
+    with open(path, 'rb') as fp:
+        mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+    image = FirmwareImage(path, None, hashlib.sha1(mm).digest())
+    image.mm = mm
+    image.view = view = memoryview(mm)
+    if mm[:4] == ELF_MAGIC:
+        image.kind = 'elf'
+        load_elf(image, view)
+    elif path.lower().endswith(('.hex', '.ihex')):
+        image.kind = 'hex'
+        load_hex(image, view)
+    else:
+        image.kind = 'bin'
+        image.segments.append(Segment(base_addr, view, len(view)))
+    logger.debug("[*] loaded %s image %s: %d segments, %d symbols", image.kind, path, len(image.segments),
+                len(image.symbols))
+    return image
+
+def load_elf(image, view):
+    ident, _, _, _, image.entry, phoff, shoff, _, _, phentsize, phnum, shentsize, shnum, _ = \
+        ELF_HEADER.unpack_from(view, 0)
+    if ident[4] != 1 or ident[5] != 1:
+        raise ValueError("%s is not a 32 bit little endian ELF" % image.path)
+    for n in range(phnum):
+        kind, offset, vaddr, paddr, filesz, memsz, flags, align = PROGRAM_HEADER.unpack_from(view, phoff + n * phentsize)
+        # .data is linked to RAM and loaded in flash, only its initial values go there
+        size = memsz if paddr == vaddr else filesz
+        if kind != PT_LOAD or size == 0:
+            continue
+        image.segments.append(Segment(paddr, view[offset:offset + filesz], size))
+    image.symbols = load_symbols(image, lambda: read_elf_symbols(view, shoff, shentsize, shnum))
+
+def read_elf_symbols(view, shoff, shentsize, shnum):
+    sections = [SECTION_HEADER.unpack_from(view, shoff + n * shentsize) for n in range(shnum)]
+    symbols = []
+    for _, kind, _, _, offset, size, link, _, _, entsize in sections:
+        if kind != SHT_SYMTAB:
+            continue
+        strtab_offset = sections[link][4]
+        for n in range(size // (entsize or ELF_SYMBOL.size)):
+            name, value, sym_size, info, _, shndx = ELF_SYMBOL.unpack_from(view, offset + n * ELF_SYMBOL.size)
+            if info & 0xf not in (STT_FUNC, STT_OBJECT) or shndx == 0:
+                continue
+            end = view.obj.find(b'\0', strtab_offset + name)
+            if info & 0xf == STT_FUNC:
+                # thumb bit
+                value &= ~1
+            symbols.append(Symbol(value, sym_size, bytes(view[strtab_offset + name:end]).decode()))
+    return symbols
+
+def load_hex(image, view):
+    # HEX data is text, it gets decoded into one bytearray per contiguous run
+    upper = 0
+    segment = None
+    for line in bytes(view).splitlines():
+        line = line.strip()
+        if not line.startswith(b':'):
+            continue
+        record = bytes.fromhex(line[1:].decode())
+        if sum(record) & 0xff:
+            raise ValueError("%s: bad checksum in %s" % (image.path, line.decode()))
+        size, offset, kind = record[0], (record[1] << 8) | record[2], record[3]
+        data = record[4:4 + size]
+        if kind == HEX_DATA:
+            address = upper + offset
+            if segment is None or segment[0] + len(segment[1]) != address:
+                segment = (address, bytearray())
+                image.segments.append(segment)
+            segment[1].extend(data)
+        elif kind == HEX_SEGMENT:
+            upper = int.from_bytes(data, 'big') << 4
+        elif kind == HEX_LINEAR:
+            upper = int.from_bytes(data, 'big') << 16
+        elif kind in (HEX_START_LINEAR, HEX_START_SEGMENT):
+            image.entry = int.from_bytes(data, 'big')
+        elif kind == HEX_EOF:
+            break
+    image.segments = [Segment(address, data, len(data)) for address, data in image.segments]
+
+
+def symbols_path(name, digest):
+    return os.path.join(CACHE_DIR, "%s-%s.syms" % (name, digest.hex()))
+
+def write_symbols(path, digest, symbols):
+    names = '\0'.join(symbol.name for symbol in symbols).encode()
+    data = SYMBOLS_HEADER.pack(SYMBOLS_MAGIC, digest, len(symbols), len(names)) + names
+    data += b''.join(SYMBOL_RECORD.pack(symbol.address, symbol.size) for symbol in symbols)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # parallel workers may race on a cold cache, see svd.write_cache()
+    tmp_path = "%s.%d" % (path, os.getpid())
+    with open(tmp_path, 'wb') as fp:
+        fp.write(data)
+    os.replace(tmp_path, path)
+
+def read_symbols(path, digest):
+    with open(path, 'rb') as fp, mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        magic, file_digest, count, names_len = SYMBOLS_HEADER.unpack_from(mm, 0)
+        if magic != SYMBOLS_MAGIC or file_digest != digest:
+            return None
+        offset = SYMBOLS_HEADER.size
+        names = mm[offset:offset + names_len].decode().split('\0') if count else []
+        offset += names_len
+        return [Symbol(address, size, name) for (address, size), name in
+                zip(SYMBOL_RECORD.iter_unpack(mm[offset:offset + count * SYMBOL_RECORD.size]), names)]
+
+def load_symbols(image, parse):
+    # the symbol index of image, parse() reads it when nothing is cached
+    path = symbols_path(image.name, image.digest)
+    symbols = read_symbols(path, image.digest) if os.path.exists(path) else None
+    if symbols is None:
+        symbols = sorted(parse())
+        write_symbols(path, image.digest, symbols)
+    return SymbolIndex(symbols)
+
+def image_symbols(path):
+    # just the symbols of an image, tools naming addresses of a trace need no more
+    image = load_image(path)
+    symbols = image.symbols
+    image.close()
+    return symbols
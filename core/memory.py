@@ -0,0 +1,66 @@
+import ctypes
+from collections import namedtuple
+
+from unicorn import UC_PROT_ALL
+
+PAGE_SIZE = 0x1000
+ZERO_PAGE = bytes(PAGE_SIZE)
+# pages are compared in groups first so clean areas are skipped in one memcmp
+CHUNK_SIZE = 0x10000
+
+# memory holds the bytes of every MemoryRegion keyed by base address,
+# peripherals the save_state() of every peripheral keyed by name
+Snapshot = namedtuple('Snapshot', ['context', 'memory', 'peripherals', 'state'])
+
+
+class MemoryRegion:
+    # guest memory backed by a host bytearray, so python can read, compare
+    # and patch it without going through uc.mem_read/mem_write
+    def __init__(self, uc, begin, size):
+        self.begin = begin
+        self.size = size
+        self.data = bytearray(size)
+        # keeps the buffer exported (and thus never reallocated) while mapped
+        self._buffer = (ctypes.c_char * size).from_buffer(self.data)
+        self.view = memoryview(self.data)
+        # the same memory as 32 bit words, peripheral registers live here
+        self.words = self.view.cast('I')
+        uc.mem_map_ptr(begin, size, UC_PROT_ALL, ctypes.addressof(self._buffer))
+
+    def contains(self, address):
+        return self.begin <= address < self.begin + self.size
+
+    def save(self):
+        return bytes(self.data)
+
+    def save_pages(self, previous=None):
+        # the memory as a tuple of pages. Pages equal to the ones of previous
+        # (an earlier save_pages()) or all zero are shared, not copied
+        view = self.view
+        pages = []
+        for n, offset in enumerate(range(0, self.size, PAGE_SIZE)):
+            page = view[offset:offset + PAGE_SIZE]
+            if previous is not None and previous[n] == page:
+                pages.append(previous[n])
+            elif page == ZERO_PAGE:
+                pages.append(ZERO_PAGE)
+            else:
+                pages.append(bytes(page))
+        return tuple(pages)
+
+    def restore(self, saved):
+        # only pages that differ from the snapshot are rewritten,
+        # returns the number of dirty pages
+        if self.data == saved:
+            return 0
+        view = self.view
+        dirty = 0
+        for chunk in range(0, self.size, CHUNK_SIZE):
+            if saved.startswith(view[chunk:chunk + CHUNK_SIZE], chunk):
+                continue
+            for offset in range(chunk, min(chunk + CHUNK_SIZE, self.size), PAGE_SIZE):
+                end = offset + PAGE_SIZE
+                if not saved.startswith(view[offset:end], offset):
+                    view[offset:end] = saved[offset:end]
+                    dirty += 1
+        return dirty
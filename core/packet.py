@@ -0,0 +1,217 @@
+from collections import namedtuple
+
+# packet framing of the nRF52 radio as configured by PCNF0/PCNF1, CRCCNF,
+# CRCPOLY, CRCINIT, DATAWHITEIV and the BASEn/PREFIXn addresses.
+#
+# A packet on air is handled as one integer whose bit n is the n-th bit sent:
+# address, S0, LENGTH, S1, PAYLOAD, CRC. Fields go out LSB first unless
+# PCNF1.ENDIAN is big, the CRC always MSB first. That way framing, whitening
+# and the CRC are a few shifts and xors on python ints, with byte tables for
+# the CRC and one precomputed whitening sequence per DATAWHITEIV.
+
+# PCNF0
+PCNF0_LFLEN = 0xf
+PCNF0_S0LEN_SHIFT = 8
+PCNF0_S1LEN_SHIFT = 16
+PCNF0_S1INCL = 1 << 20
+PCNF0_CRCINC = 1 << 26
+# PCNF1
+PCNF1_MAXLEN = 0xff
+PCNF1_STATLEN_SHIFT = 8
+PCNF1_BALEN_SHIFT = 16
+PCNF1_ENDIAN_BIG = 1 << 24
+PCNF1_WHITEEN = 1 << 25
+# CRCCNF
+CRCCNF_LEN = 0x3
+CRCCNF_SKIPADDR = 1 << 8
+
+# longest frame after the address: S0, LENGTH and S1 of up to 38 bits,
+# 255 payload bytes and a 24 bit CRC
+MAX_FRAME_BITS = 38 + 255 * 8 + 24
+# the whitening LFSR repeats after this many bits
+WHITENING_PERIOD = 127
+
+# register names a PacketFormat is made from, in the order of its key
+FORMAT_REGISTERS = ["PCNF0", "PCNF1", "CRCCNF", "CRCPOLY", "CRCINIT", "DATAWHITEIV",
+                    "BASE0", "BASE1", "PREFIX0", "PREFIX1"]
+
+REVERSE = bytes(int('{:08b}'.format(i)[::-1], 2) for i in range(256))
+
+# address is the logical address (0-7) the packet was sent to or received on.
+# packet is what the firmware has in RAM at PACKETPTR, air the bytes on air
+# from the address on, crc the CRC of the packet as sent
+Frame = namedtuple('Frame', ['address', 's0', 'length', 's1', 'payload', 'crc', 'crc_ok', 'packet', 'air',
+                             'time', 'frequency'], defaults=[None, None])
+
+# key -> PacketFormat, nodes configured the same share one
+FORMATS = {}
+# DATAWHITEIV -> whitening sequence as an int
+WHITENING = {}
+
+
+def reverse_bits(value, width):
+    return int('{:0{}b}'.format(value, width)[::-1], 2) if width else 0
+
+def whitening_sequence(iv):
+    # x^7 + x^4 + 1, bit n of the result whitens bit n of the frame
+    sequence = WHITENING.get(iv)
+    if sequence is None:
+        # DATAWHITEIV bit 0 is LFSR position 6, position 0 is always 1
+        lfsr = reverse_bits(iv & 0x7f, 7) | 1
+        period = 0
+        for n in range(WHITENING_PERIOD):
+            out = (lfsr >> 6) & 1
+            period |= out << n
+            lfsr = ((lfsr << 1) & 0x7f) | out
+            if out:
+                lfsr ^= 1 << 4
+        sequence = 0
+        for n in range(0, MAX_FRAME_BITS, WHITENING_PERIOD):
+            sequence |= period << n
+        WHITENING[iv] = sequence
+    return sequence
+
+def crc_table(poly):
+    # the CRC register is kept bit reversed, so bytes sent LSB first are
+    # fed in as they are and the register is the CRC in the order it is sent
+    table = []
+    for byte in range(256):
+        crc = byte
+        for _ in range(8):
+            crc = (crc >> 1) ^ poly if crc & 1 else crc >> 1
+        table.append(crc)
+    return table
+
+
+class PacketFormat:
+    def __init__(self, key):
+        pcnf0, pcnf1, crccnf, crcpoly, crcinit, whiteiv, base0, base1, prefix0, prefix1 = key
+        self.lflen = pcnf0 & PCNF0_LFLEN
+        self.s0len = (pcnf0 >> PCNF0_S0LEN_SHIFT) & 1
+        self.s1len = (pcnf0 >> PCNF0_S1LEN_SHIFT) & 0xf
+        self.crcinc = pcnf0 & PCNF0_CRCINC != 0
+        self.maxlen = pcnf1 & PCNF1_MAXLEN
+        self.statlen = (pcnf1 >> PCNF1_STATLEN_SHIFT) & 0xff
+        self.balen = (pcnf1 >> PCNF1_BALEN_SHIFT) & 0x7
+        self.big_endian = pcnf1 & PCNF1_ENDIAN_BIG != 0
+        self.whitening = whitening_sequence(whiteiv) if pcnf1 & PCNF1_WHITEEN else 0
+        # RAM layout: S0, LENGTH and S1 take whole bytes, S1 may be there without bits on air
+        self.s1_bytes = max((self.s1len + 7) // 8, 1 if pcnf0 & PCNF0_S1INCL else 0)
+        self.length_bytes = (self.lflen + 7) // 8
+        self.header_size = self.s0len + self.length_bytes + self.s1_bytes
+        self.header_bits = 8 * self.s0len + self.lflen + self.s1len
+        # largest packet the radio reads from or writes to RAM
+        self.ram_size = self.header_size + self.maxlen
+
+        self.crc_width = 8 * (crccnf & CRCCNF_LEN)
+        self.crc_skip_address = crccnf & CRCCNF_SKIPADDR != 0
+        # the x^0 term is always there, x^width is not part of the register
+        poly = (crcpoly | 1) & ((1 << self.crc_width) - 1)
+        self.crc_poly = reverse_bits(poly, self.crc_width)
+        self.crc_init = reverse_bits(crcinit & ((1 << self.crc_width) - 1), self.crc_width)
+        self.crc_table = crc_table(self.crc_poly) if self.crc_width else None
+
+        # logical address -> address as sent, BALEN bytes of BASEn then the prefix byte
+        self.address_size = self.balen + 1
+        self.addresses = []
+        for n in range(8):
+            base = base0 if n == 0 else base1
+            prefix = ((prefix0 if n < 4 else prefix1) >> (8 * (n % 4))) & 0xff
+            address = (base >> (32 - 8 * self.balen)) if self.balen else 0
+            self.addresses.append((address | prefix << (8 * self.balen)).to_bytes(self.address_size, 'little'))
+        self.logical_addresses = {}
+        for n, address in reversed(list(enumerate(self.addresses))):
+            self.logical_addresses[address] = n
+
+    def field(self, value, width):
+        # header fields as sent, big endian ones MSB first
+        return reverse_bits(value, width) if self.big_endian else value
+
+    def crc(self, address, body, bits):
+        # CRC over the address (unless CRCCNF.SKIPADDR) and the first bits of body
+        crc = self.crc_init
+        table = self.crc_table
+        data = b'' if self.crc_skip_address else address
+        data += (body & ((1 << bits) - 1)).to_bytes((bits + 7) // 8, 'little')
+        for byte in data[:len(data) - (1 if bits % 8 else 0)]:
+            crc = (crc >> 8) ^ table[(crc ^ byte) & 0xff]
+        if bits % 8:
+            # a frame that doesn't end on a byte boundary
+            last = data[-1]
+            for n in range(bits % 8):
+                crc = (crc >> 1) ^ self.crc_poly if (crc ^ (last >> n)) & 1 else crc >> 1
+        return crc
+
+    def parse_header(self, packet):
+        # S0, LENGTH and S1 as the firmware left them in RAM
+        offset = self.s0len
+        s0 = packet[0] if self.s0len and packet else 0
+        length = int.from_bytes(packet[offset:offset + self.length_bytes], 'little') & ((1 << self.lflen) - 1)
+        offset += self.length_bytes
+        s1 = int.from_bytes(packet[offset:offset + self.s1_bytes], 'little') & ((1 << self.s1len) - 1)
+        return s0, length, s1
+
+    def ram_header(self, s0, length, s1):
+        return (s0.to_bytes(self.s0len, 'little') + length.to_bytes(self.length_bytes, 'little') +
+                s1.to_bytes(self.s1_bytes, 'little'))
+
+    def payload_length(self, length):
+        # bytes of payload a LENGTH field stands for, and whether MAXLEN cut it short
+        size = length + self.statlen - (self.crc_width // 8 if self.crcinc else 0)
+        size = max(size, 0)
+        if size > self.maxlen:
+            return self.maxlen, True
+        return size, False
+
+    def encode(self, packet, address=0, time=None, frequency=None):
+        # frame of the RAM packet sent to logical address. A packet longer
+        # than MAXLEN is cut short and goes out with a bad CRC
+        s0, length, s1 = self.parse_header(packet)
+        size, truncated = self.payload_length(length)
+        payload = bytes(packet[self.header_size:self.header_size + size])
+        size = len(payload)
+        body = self.field(s0, 8 * self.s0len)
+        body |= self.field(length, self.lflen) << (8 * self.s0len)
+        body |= self.field(s1, self.s1len) << (8 * self.s0len + self.lflen)
+        body |= int.from_bytes(payload.translate(REVERSE) if self.big_endian else payload,
+                               'little') << self.header_bits
+        bits = self.header_bits + 8 * size
+        address_bytes = self.addresses[address]
+        crc = self.crc(address_bytes, body, bits) if self.crc_width else 0
+        sent_crc = crc ^ 1 if truncated and self.crc_width else crc
+        body |= sent_crc << bits
+        bits += self.crc_width
+        body ^= self.whitening & ((1 << bits) - 1)
+        air = address_bytes + body.to_bytes((bits + 7) // 8, 'little')
+        return Frame(address, s0, length, s1, payload, reverse_bits(sent_crc, self.crc_width), not truncated,
+                     self.ram_header(s0, length, s1) + payload, air, time, frequency)
+
+    def decode(self, air, enabled=0xff, time=None, frequency=None):
+        # frame of the bytes on air if they are sent to one of the enabled
+        # logical addresses (a mask), None if not
+        address = self.logical_addresses.get(bytes(air[:self.address_size]))
+        if address is None or not enabled & (1 << address):
+            return None
+        body = int.from_bytes(air[self.address_size:], 'little')
+        body ^= self.whitening & ((1 << (8 * (len(air) - self.address_size))) - 1)
+        s0 = self.field(body & ((1 << (8 * self.s0len)) - 1), 8 * self.s0len)
+        length = self.field((body >> (8 * self.s0len)) & ((1 << self.lflen) - 1), self.lflen)
+        s1 = self.field((body >> (8 * self.s0len + self.lflen)) & ((1 << self.s1len) - 1), self.s1len)
+        size, truncated = self.payload_length(length)
+        payload = ((body >> self.header_bits) & ((1 << (8 * size)) - 1)).to_bytes(size, 'little')
+        if self.big_endian:
+            payload = payload.translate(REVERSE)
+        bits = self.header_bits + 8 * size
+        received = (body >> bits) & ((1 << self.crc_width) - 1)
+        crc = self.crc(self.addresses[address], body, bits) if self.crc_width else 0
+        return Frame(address, s0, length, s1, payload, reverse_bits(received, self.crc_width),
+                     crc == received and not truncated, self.ram_header(s0, length, s1) + payload,
+                     bytes(air), time, frequency)
+
+
+def packet_format(key):
+    # key: values of FORMAT_REGISTERS
+    packet_format = FORMATS.get(key)
+    if packet_format is None:
+        packet_format = FORMATS[key] = PacketFormat(key)
+    return packet_format
@@ -1,17 +1,72 @@
-import os
+import bisect
 import importlib
+import re
+from array import array
 
-class IPeripheralRegistry(type):
-    peripherals = []
-    def __init__(cls, name, bases, attrs):
-        if name != 'IPeripheral':
-            IPeripheralRegistry.peripherals.append(cls)
+from .svd import load_register_map
+
+# SVD peripheral name -> (SvdPeripheral, [SvdRegister]), loaded once per process
+SVD_PERIPHERALS = {}
+# [(begin, end, name)] of the models, see peripheral_windows()
+PERIPHERAL_WINDOWS = []
+# the same windows sorted by address and their starts, for window_name()
+SORTED_WINDOWS = []
+WINDOW_STARTS = []
+# SVD peripheral name -> (module, class) of its model. Models are imported
+# when first needed, their MMIO windows come from the SVD
+PERIPHERAL_MODELS = {
+    "RADIO": ("peripherals.radio", "Radio"),
+    "CLOCK": ("peripherals.clock", "Clock"),
+    "P0": ("peripherals.gpio", "GPIO"),
+    "P1": ("peripherals.gpio", "GPIO_P1"),
+    "TIMER0": ("peripherals.timer", "Timer_0"),
+    "RTC1": ("peripherals.rtc", "RTC1"),
+    "PPI": ("peripherals.ppi", "PPI"),
+}
+# models with registers in SVD clusters, which the register map lacks. Their
+# MMIO window is the whole address block of the peripheral
+BLOCK_WINDOWS = {"PPI"}
+# tasks that only copy the time into another register, by model name
+# pattern. Firmware storing to them in a loop is waiting for time to pass
+TIME_SAMPLING_TASKS = {"TIMER*": ["TASKS_CAPTURE*"]}
+# EVENTS_ registers start here, bit n of INTEN and EVTEN is the event at EVENTS_OFFSET + 4 * n
+EVENTS_OFFSET = 0x100
 
 class Register:
-    def __init__(self, name, address, value=0):
+    # the value lives in guest memory once the peripheral is bound to its
+    # MMIO window (see IPeripheral.bind), in a word of its own until then
+    def __init__(self, name, address, value=0, mask=0xffffffff, access=None, fields=()):
         self.name = name
         self.address = address
-        self.value = value
+        self.reset_value = value
+        # bits covered by the SVD fields
+        self.mask = mask
+        self.access = access
+        # core.svd.SvdField of the register
+        self.fields = fields
+        self.words = array('I', [value])
+        self.index = 0
+
+    @classmethod
+    def from_svd(cls, reg, value=None):
+        mask = 0
+        for field in reg.fields:
+            mask |= ((1 << field.bit_width) - 1) << field.bit_offset
+        return cls(reg.name, reg.address, reg.reset_value if value is None else value, mask or 0xffffffff,
+                   reg.access, reg.fields)
+
+    def bind(self, words, index):
+        words[index] = self.words[self.index]
+        self.words = words
+        self.index = index
+
+    @property
+    def value(self):
+        return self.words[self.index]
+
+    @value.setter
+    def value(self, value):
+        self.words[self.index] = value & 0xffffffff
     
     def get_nth_bit(self, n):
         return (self.value & (1 << n) != 0)
@@ -20,23 +75,173 @@ class Register:
         mask =  ((1 << (end - start + 1)) - 1) << start
         return (self.value & mask) >> (start - 1)
 
-class IPeripheral(object, metaclass=IPeripheralRegistry):   
+def load_svd_peripherals():
+    if not SVD_PERIPHERALS:
+        regmap = load_register_map()
+        for peripheral in regmap.peripherals:
+            SVD_PERIPHERALS[peripheral.name] = (peripheral, [])
+        for reg in regmap.registers:
+            SVD_PERIPHERALS[reg.peripheral][1].append(reg)
+    return SVD_PERIPHERALS
+
+def match_names(name, patterns):
+    # 'TASKS_*' matches by prefix, anything else the exact name
+    for pattern in patterns:
+        if name == pattern or (pattern.endswith('*') and name.startswith(pattern[:-1])):
+            return True
+    return False
+
+def indexed_name(name, names):
+    # SVD fields call EVENTS_COMPARE[0] COMPARE0
+    if name in names:
+        return name
+    match = re.match(r'(.*\D)(\d+)$', name)
+    if match and '%s[%s]' % match.groups() in names:
+        return '%s[%s]' % match.groups()
+    return None
+
+class IPeripheral(object):
+    # interrupt line of the peripheral, and the NVIC it raises it on
+    irq = None
+    nvic = None
+    # core.events.EventBus the events are published on
+    bus = None
+    # names of the registers whose reads or writes have side effects and are
+    # passed to read()/write(). Every other register is plain storage the
+    # firmware accesses without a python callback. XSET/XCLR pairs are always handled
+    read_handlers = []
+    write_handlers = []
+    # reset values that differ from the SVD
+    reset_values = {}
+    # registers wiring events to tasks and interrupts, writing them drops
+    # the routes the bus compiled
+    routing_registers = ["SHORTS", "INTEN*", "EVTEN*"]
+
     def __init__(self) -> None:
+        # the full register set of the SVD peripheral called get_name()
         self.base_address = None
         self.register_list = []
+        if self.get_name() is not None:
+            peripheral, registers = load_svd_peripherals()[self.get_name()]
+            self.base_address = peripheral.base_address
+            self.register_list = [Register.from_svd(reg, self.reset_values.get(reg.name)) for reg in registers]
+        self.populate_maps()
 
     def get_name(self):
         return None
     
     def read(self, uc, address):
-        pass
+        # runs before the firmware loads from address, whatever is left in
+        # the register is what it gets
+        entry = self.set_clear.get(address)
+        if entry is not None:
+            self.register_address_map[address].value = entry[0].value
 
     def write(self, uc, address, value):
-        pass
+        # runs before value is stored at address
+        entry = self.set_clear.get(address)
+        if entry is not None:
+            target, set_bits = entry
+            if set_bits:
+                target.value |= value
+            else:
+                target.value &= ~value
+        if address in self.routing_addresses:
+            if self.bus is not None:
+                self.bus.invalidate()
+            inten = self.register_name_map.get('INTEN')
+            if inten is not None and (address == inten.address or entry is not None and entry[0] is inten):
+                if entry is None:
+                    inten.value = value
+                # the line is level triggered, enabling an event that is already set raises it
+                if self.irq_asserted():
+                    self.raise_irq()
+
+    def task(self, uc, address):
+        # a task triggered by the hardware (SHORTS, PPI), not by the firmware
+        self.write(uc, address, 1)
+
+    def publish(self, name):
+        # the peripheral generates EVENTS_<name>. The register is set and what
+        # SHORTS, PPI and INTEN wire it to happens right away, see core.events
+        register = self.register_name_map['EVENTS_' + name]
+        register.value = 1
+        if self.bus is not None:
+            self.bus.publish(self, register.address)
+        elif self.interrupt_enabled(register.address):
+            self.raise_irq()
+
+    def event_mask(self, address):
+        return 1 << ((address - self.base_address - EVENTS_OFFSET) // 4)
+
+    def interrupt_enabled(self, address):
+        inten = self.register_name_map.get('INTEN')
+        return inten is not None and inten.value & self.event_mask(address) != 0
+
+    def irq_asserted(self):
+        # the interrupt line is level triggered, up while an enabled event is set
+        inten = self.register_name_map.get('INTEN')
+        if inten is None or not inten.value:
+            return False
+        return any(self.get_reg_val(self.base_address + EVENTS_OFFSET + 4 * n)
+                   for n in range(32) if inten.value & (1 << n))
+
+    def event_routed(self, address):
+        # peripherals with EVTEN only pass the events it enables on to PPI
+        evten = self.register_name_map.get('EVTEN')
+        return evten is None or evten.value & self.event_mask(address) != 0
+
+    def short_tasks(self, address):
+        # task addresses the SHORTS in effect wire the event at address to
+        shorts = self.register_name_map.get('SHORTS')
+        return [task for mask, task in self.shorts.get(address, ()) if shorts.value & mask]
 
     def populate_maps(self):
         self.register_name_map = {register.name: register for register in self.register_list}
-        self.register_address_map = {register.address: register for register in self.register_list}
+        # XSET/XCLR write 1s to set/clear bits of X and both read back X. INTENSET/INTENCLR
+        # have no INTEN register on most peripherals, it gets one outside of guest memory
+        self.set_clear = {}
+        for name, register in list(self.register_name_map.items()):
+            if name.endswith('SET') and name[:-3] + 'CLR' in self.register_name_map:
+                target = self.register_name_map.get(name[:-3])
+                if target is None:
+                    target = Register(name[:-3], None)
+                    self.register_list.append(target)
+                    self.register_name_map[target.name] = target
+                self.set_clear[register.address] = (target, True)
+                self.set_clear[self.register_name_map[name[:-3] + 'CLR'].address] = (target, False)
+        self.register_address_map = {register.address: register for register in self.register_list
+                                     if register.address is not None}
+        self.routing_addresses = {register.address for register in self.register_list if register.address is not None
+                                  and match_names(register.name, self.routing_registers)}
+        # writing 1 triggers a task, any other value is ignored
+        self.task_addresses = {register.address for register in self.register_list if register.address is not None
+                               and register.name.startswith('TASKS_')}
+        # event address -> [(SHORTS bit, task address)], from the SVD fields named EVENT_TASK
+        self.shorts = {}
+        shorts = self.register_name_map.get('SHORTS')
+        for field in shorts.fields if shorts is not None else ():
+            event, task = field.name.split('_', 1)
+            event = indexed_name('EVENTS_' + event, self.register_name_map)
+            task = indexed_name('TASKS_' + task, self.register_name_map)
+            if event is not None and task is not None:
+                self.shorts.setdefault(self.register_name_map[event].address, []).append(
+                    (1 << field.bit_offset, self.register_name_map[task].address))
+
+    def bind(self, region):
+        # move the registers inside region into its guest memory
+        for register in self.register_list:
+            if register.address is not None and region.contains(register.address):
+                register.bind(region.words, (register.address - region.begin) // 4)
+
+    def read_addresses(self):
+        return [register.address for register in self.register_list if register.address is not None and
+                (register.address in self.set_clear or match_names(register.name, self.read_handlers))]
+
+    def write_addresses(self):
+        return [register.address for register in self.register_list if register.address is not None and
+                (register.address in self.set_clear or register.address in self.routing_addresses or
+                 match_names(register.name, self.write_handlers))]
 
     def get_reg_by_name(self, name):
         return self.register_name_map[name]
@@ -44,7 +249,7 @@ class IPeripheral(object, metaclass=IPeripheralRegistry):
     def set_reg_val(self, reg_address, value):
         if reg_address in self.register_address_map.keys():
             register = self.register_address_map[reg_address]           
-            register.value = value
+            register.value = value & register.mask
 
     def get_reg_val(self, reg_address):
         if reg_address in self.register_address_map.keys():            
@@ -52,9 +257,57 @@ class IPeripheral(object, metaclass=IPeripheralRegistry):
         else:
             return None
 
+    def raise_irq(self):
+        if self.nvic is not None and self.irq is not None:
+            self.nvic.set_pending(self.irq)
+
+    # python side state captured by Emulator.snapshot(), peripherals
+    # keeping state outside of their registers extend these
+    def save_state(self):
+        return [register.value for register in self.register_list]
+
+    def load_state(self, state):
+        # the values were masked when saved, skip the setter
+        for register, value in zip(self.register_list, state):
+            register.words[register.index] = value
+
+def load_peripheral(name):
+    module, cls = PERIPHERAL_MODELS[name]
+    return getattr(importlib.import_module(module), cls)
+
 def load_peripherals():
-    for filename in os.listdir('peripherals'):        
-        name, etx = os.path.splitext(filename)
-        modname = f"peripherals.{name}"
-        importlib.import_module(modname)
-    return IPeripheralRegistry.peripherals
\ No newline at end of file
+    return [load_peripheral(name) for name in PERIPHERAL_MODELS]
+
+def time_sampling_addresses():
+    # addresses of the TIME_SAMPLING_TASKS of every model, from the SVD
+    addresses = set()
+    for name in PERIPHERAL_MODELS:
+        for pattern, tasks in TIME_SAMPLING_TASKS.items():
+            if match_names(name, [pattern]):
+                addresses.update(reg.address for reg in load_svd_peripherals()[name][1]
+                                 if match_names(reg.name, tasks))
+    return addresses
+
+def peripheral_windows():
+    # [(begin, end, name)] of the MMIO window of every model, end exclusive.
+    # The windows span the SVD registers, the address blocks of P0 and P1 overlap
+    if not PERIPHERAL_WINDOWS:
+        for name in PERIPHERAL_MODELS:
+            peripheral, registers = load_svd_peripherals()[name]
+            if name in BLOCK_WINDOWS:
+                begin = peripheral.base_address + peripheral.block_offset
+                PERIPHERAL_WINDOWS.append((begin, begin + peripheral.block_size, name))
+                continue
+            addresses = [reg.address for reg in registers]
+            PERIPHERAL_WINDOWS.append((min(addresses), max(addresses) + 4, name))
+    return PERIPHERAL_WINDOWS
+
+def window_name(address):
+    # model whose MMIO window holds address, None outside of them. The windows don't overlap
+    if not SORTED_WINDOWS:
+        SORTED_WINDOWS.extend(sorted(peripheral_windows()))
+        WINDOW_STARTS.extend(begin for begin, _, _ in SORTED_WINDOWS)
+    i = bisect.bisect_right(WINDOW_STARTS, address) - 1
+    if i >= 0 and address < SORTED_WINDOWS[i][1]:
+        return SORTED_WINDOWS[i][2]
+    return None
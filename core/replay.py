@@ -0,0 +1,239 @@
+import bisect
+import functools
+import pickle
+import types
+from array import array
+from collections import namedtuple
+
+from . import trace as tracing
+from .memory import Snapshot
+from .vclock import NEVER, seconds_to_cycles
+
+# a run of the emulator is deterministic given its firmware and the packets
+# it receives: peripherals, interrupts and time all derive from the virtual
+# clock. A recording keeps the packets the scenario handed out, so a replay
+# feeds the same ones, and checkpoints every interval instructions. Seeking
+# restores the nearest checkpoint and runs the rest, so it costs at most one
+# interval of emulation however long the session was.
+#
+# Interrupt entries, model register reads and received packets are logged
+# too, with the instruction count they happened at. A replay doesn't need
+# them, they tell where to seek to.
+DEFAULT_INTERVAL = 50000
+RECORDING_MAGIC = b'NRFREPL1'
+
+# icount is the instruction count at the start of the basic block (counted
+# at block entry, so it includes the block), pc the block. address is the
+# register read or the frequency of a packet, value what was read, the irq
+# number or the index of the packet in Recording.payloads
+Event = namedtuple('Event', ['type', 'icount', 'pc', 'address', 'value'])
+# icount and time where the emulator stood, packets is how many packets the
+# scenario had taken from its stream by then
+Checkpoint = namedtuple('Checkpoint', ['icount', 'time', 'snapshot', 'packets'])
+
+
+class Recording:
+    def __init__(self, fw_path, base_addr, interval=DEFAULT_INTERVAL):
+        self.fw_path = fw_path
+        self.base_addr = base_addr
+        self.interval = interval
+        self.checkpoints = []
+        # the stream of the scenario as far as the run got
+        self.packets = []
+        self.types = array('B')
+        self.icounts = array('Q')
+        self.pcs = array('I')
+        self.addresses = array('I')
+        self.values = array('I')
+        # received packets, RADIO_RX events point here
+        self.payloads = []
+
+    def log(self, kind, icount, pc, address, value):
+        self.types.append(kind)
+        self.icounts.append(icount)
+        self.pcs.append(pc)
+        self.addresses.append(address)
+        self.values.append(value)
+
+    def irq_enter(self, icount, pc, irq):
+        self.log(tracing.IRQ_ENTER, icount, pc, 0, irq)
+
+    def mmio_read(self, icount, pc, address, value):
+        self.log(tracing.MMIO_READ, icount, pc, address, value)
+
+    def rx(self, icount, pc, frequency, packet):
+        self.log(tracing.RADIO_RX, icount, pc, frequency, len(self.payloads))
+        self.payloads.append(bytes(packet))
+
+    @property
+    def end(self):
+        # instruction count the recording stopped at
+        return self.checkpoints[-1].icount if self.checkpoints else 0
+
+    def events(self, kinds=None, begin=0, end=NEVER):
+        # Events with begin <= icount < end, of the given types if any
+        i = bisect.bisect_left(self.icounts, begin)
+        while i < len(self.icounts) and self.icounts[i] < end:
+            if not kinds or self.types[i] in kinds:
+                yield Event(self.types[i], self.icounts[i], self.pcs[i], self.addresses[i], self.values[i])
+            i += 1
+
+    def checkpoint_before(self, icount):
+        # latest checkpoint at or before icount
+        i = bisect.bisect_right([checkpoint.icount for checkpoint in self.checkpoints], icount)
+        return self.checkpoints[max(i - 1, 0)]
+
+    def save(self, path):
+        # the firmware goes first, loading needs an emulator of it, see load_recording()
+        with open(path, 'wb') as fp:
+            fp.write(RECORDING_MAGIC)
+            pickle.dump((self.fw_path, self.base_addr), fp)
+            RecordingPickler(fp).dump(self)
+
+
+class RecordingPickler(pickle.Pickler):
+    # the clock queue holds callbacks of peripherals and tools. Methods of the
+    # emulator's own objects are saved by name and bound again on load, other
+    # callbacks (tools, stale events of finished runs) are dropped
+    def persistent_id(self, obj):
+        if isinstance(obj, types.MethodType):
+            return ("callback", owner_name(obj.__self__), obj.__name__)
+        if isinstance(obj, functools.partial) or (isinstance(obj, types.FunctionType) and '<' in obj.__qualname__):
+            # lambdas and closures
+            return ("callback", None, None)
+        return None
+
+class RecordingUnpickler(pickle.Unpickler):
+    def __init__(self, fp, emu):
+        super().__init__(fp)
+        self.emu = emu
+
+    def persistent_load(self, pid):
+        _, owner, name = pid
+        owner = find_owner(self.emu, owner)
+        if owner is None:
+            return ignore_event
+        return getattr(owner, name)
+
+def ignore_event(arg=None):
+    pass
+
+def owner_name(owner):
+    # what a callback belongs to, see find_owner()
+    if owner is None:
+        return None
+    name = getattr(owner, 'get_name', None)
+    if name is not None:
+        return ("peripheral", name())
+    return (type(owner).__name__, None)
+
+def find_owner(emu, owner):
+    if owner is None:
+        return None
+    kind, name = owner
+    if kind == "peripheral":
+        return emu.peripherals[name]
+    return {"Emulator": emu, "RxScenario": emu.scenario, "NVIC": emu.nvic}.get(kind)
+
+def open_recording(path):
+    fp = open(path, 'rb')
+    if fp.read(len(RECORDING_MAGIC)) != RECORDING_MAGIC:
+        fp.close()
+        raise ValueError("not a recording: %s" % path)
+    return fp
+
+def recording_firmware(path):
+    # (firmware path, base address) the recording was made with
+    with open_recording(path) as fp:
+        return pickle.load(fp)
+
+def load_recording(path, emu):
+    # emu: an emulator of the recorded firmware, the callbacks get bound to it
+    with open_recording(path) as fp:
+        pickle.load(fp)
+        return RecordingUnpickler(fp, emu).load()
+
+
+def tap(packets, recording):
+    for packet in packets:
+        recording.packets.append(packet)
+        yield packet
+
+
+class Recorder:
+    # records the runs of emu from start() to stop(), start() after the scenario is loaded
+    def __init__(self, emu, fw_path, interval=DEFAULT_INTERVAL):
+        self.emu = emu
+        self.recording = Recording(fw_path, emu.base_addr, interval)
+        self.pages = {}
+
+    def start(self):
+        emu = self.emu
+        emu.recording = self.recording
+        emu.scenario.packets = tap(emu.scenario.packets, self.recording)
+        return self.recording
+
+    def checkpoint(self):
+        # memory pages that didn't change since the previous checkpoint are shared with it
+        emu = self.emu
+        for region in emu.memory:
+            self.pages[region.begin] = region.save_pages(self.pages.get(region.begin))
+        snapshot = Snapshot(emu.uc.context_save(), dict(self.pages),
+                            {name: p.save_state() for name, p in emu.peripherals.items()},
+                            emu.save_state())
+        self.recording.checkpoints.append(Checkpoint(emu.icount, emu.clock.time, snapshot,
+                                                     len(self.recording.packets)))
+
+    def run(self, seconds):
+        # Emulator.run_until() with a checkpoint every interval instructions. The
+        # stop event goes in before the first checkpoint, every checkpoint has the
+        # same clock events ahead of it as the run had
+        emu = self.emu
+        emu.stop_generation += 1
+        emu.clock.schedule_at(emu.clock.time + seconds_to_cycles(seconds), emu.stop_cb, emu.stop_generation)
+        if not self.recording.checkpoints or self.recording.end != emu.icount:
+            self.checkpoint()
+        while True:
+            limit = emu.icount + self.recording.interval
+            emu.icount_limit = limit
+            try:
+                emu.resume()
+            finally:
+                emu.icount_limit = NEVER
+            self.checkpoint()
+            if emu.icount < limit:
+                # time is up or the firmware ran off its end
+                break
+        return self.recording
+
+    def stop(self):
+        self.emu.recording = None
+        return self.recording
+
+
+class Replayer:
+    # moves emu (of the same firmware, fresh or not) to any point of recording
+    def __init__(self, emu, recording):
+        self.emu = emu
+        self.recording = recording
+        self.checkpoint = None
+
+    def restore(self, checkpoint):
+        emu = self.emu
+        snapshot = checkpoint.snapshot
+        emu.restore(Snapshot(snapshot.context, {begin: b''.join(pages) for begin, pages in snapshot.memory.items()},
+                             snapshot.peripherals, snapshot.state))
+        emu.scenario.packets = iter(self.recording.packets[checkpoint.packets:])
+        self.checkpoint = checkpoint
+
+    def seek(self, icount):
+        # returns the instruction count reached, the first block boundary at
+        # or after icount (or the end of the recording)
+        emu = self.emu
+        icount = min(icount, self.recording.end)
+        checkpoint = self.recording.checkpoint_before(icount)
+        # going forward from where the last seek ended is cheaper unless a checkpoint lies in between
+        if self.checkpoint is None or not checkpoint.icount <= self.checkpoint.icount <= emu.icount <= icount:
+            self.restore(checkpoint)
+        emu.run_to(icount)
+        return emu.icount
@@ -0,0 +1,303 @@
+import time
+from collections import namedtuple
+
+from unicorn import UcError, UC_HOOK_CODE, UC_HOOK_INTR
+from unicorn.arm_const import UC_ARM_REG_PC
+
+from .vclock import NEVER, seconds_to_cycles, cycles_to_us
+
+# why a run ended: one of its conditions, or a budget ran out
+TIME = "time"
+INSTRUCTIONS = "instructions"
+ERROR = "error"
+# the firmware ran off the end of its image
+EXITED = "exited"
+
+# fault handlers at most this far apart are hooked as one range
+HANDLER_GAP = 16
+
+# reason is TIME, INSTRUCTIONS, ERROR, EXITED or the name of the condition that was met
+# (that condition is in condition), instructions and time (us) are what this
+# run took, error the unicorn error if there was one
+RunResult = namedtuple('RunResult', ['reason', 'condition', 'pc', 'instructions', 'time', 'wall_time', 'error'])
+
+
+class Condition:
+    # something that ends a headless run. arm() hooks into the emulator and
+    # calls stop(self) once the condition is met, stop(self, pc) from a code
+    # hook (see Emulator.stop()). disarm() undoes arm()
+    name = None
+
+    def arm(self, emu, stop):
+        pass
+
+    def disarm(self, emu):
+        pass
+
+
+class GpioToggles(Condition):
+    # count level changes of any of pins (a mask of P0), a blink is two
+    name = "gpio"
+
+    def __init__(self, count, pins=0xffffffff):
+        self.count = count
+        self.pins = pins
+        self.toggles = 0
+
+    def arm(self, emu, stop):
+        self.gpio = emu.peripherals['P0']
+        self.saved = self.gpio.callbacks["change"]
+        self.stop = stop
+        self.gpio.add_callback("change", self.changed_cb)
+
+    def disarm(self, emu):
+        self.gpio.add_callback("change", self.saved)
+
+    def changed_cb(self, changed):
+        if changed & self.pins:
+            self.toggles += 1
+            if self.toggles >= self.count:
+                self.stop(self)
+        if self.saved != None:
+            self.saved(changed)
+
+
+class GpioBlinks(Condition):
+    # count complete on/off cycles of pins (a mask of P0), the same blinks as
+    # PinTimeline.blinks(): a pin's first edge is it being set up, not a blink
+    name = "blinks"
+
+    def __init__(self, count, pins=0xffffffff, active=1):
+        self.count = count
+        self.pins = pins
+        self.active = active
+        self.blinks = 0
+        # pins that had their first edge, and those lit since
+        self.started = 0
+        self.lit = 0
+
+    def arm(self, emu, stop):
+        self.gpio = emu.peripherals['P0']
+        self.saved = self.gpio.callbacks["change"]
+        self.stop = stop
+        self.gpio.add_callback("change", self.changed_cb)
+
+    def disarm(self, emu):
+        self.gpio.add_callback("change", self.saved)
+
+    def changed_cb(self, changed):
+        pins = changed & self.pins
+        if pins:
+            on = self.gpio.out.value if self.active else ~self.gpio.out.value
+            counted = pins & self.started
+            self.blinks += bin(counted & self.lit & ~on).count("1")
+            self.lit = (self.lit & ~pins) | (counted & on)
+            self.started |= pins
+            if self.blinks >= self.count:
+                self.stop(self)
+        if self.saved != None:
+            self.saved(changed)
+
+
+class RadioTx(Condition):
+    # the firmware transmits payload (length byte included), any packet if None
+    name = "radio_tx"
+
+    def __init__(self, payload=None):
+        self.payload = payload
+        self.packet = None
+
+    def arm(self, emu, stop):
+        self.radio = emu.peripherals['RADIO']
+        self.saved = self.radio.callbacks["tx_en"]
+        self.stop = stop
+        self.radio.add_callback("tx_en", self.tx_cb)
+
+    def disarm(self, emu):
+        self.radio.add_callback("tx_en", self.saved)
+
+    def tx_cb(self):
+        packet = self.radio.last_tx_packet
+        if self.payload is None or packet == self.payload:
+            self.packet = packet
+            self.stop(self)
+        if self.saved != None:
+            self.saved()
+
+
+class PcReached(Condition):
+    name = "pc"
+
+    def __init__(self, address):
+        self.address = address & ~1
+        self.handle = None
+
+    def arm(self, emu, stop):
+        self.handle = emu.uc.hook_add(UC_HOOK_CODE, lambda uc, address, size, user_data: stop(self, address),
+                                      begin=self.address, end=self.address)
+
+    def disarm(self, emu):
+        emu.uc.hook_del(self.handle)
+
+
+class Fault(Condition):
+    # entry into one of the fault handlers of the vector table, address is
+    # the handler entered
+    name = "fault"
+
+    def __init__(self, handlers):
+        self.handlers = handlers
+        self.handles = []
+        self.address = None
+
+    def arm(self, emu, stop):
+        self.stop = stop
+        # handlers next to each other share a hook, hooks cost a lot to add and
+        # remove for every run. Whatever else runs in between is no handler
+        self.addresses = sorted({emu.vector_table[handler] & ~1 for handler in self.handlers})
+        ranges = []
+        for address in self.addresses:
+            if ranges and address - ranges[-1][1] <= HANDLER_GAP:
+                ranges[-1][1] = address
+            else:
+                ranges.append([address, address])
+        for begin, end in ranges:
+            self.handles.append(emu.uc.hook_add(UC_HOOK_CODE, self.fault_cb, begin=begin, end=end))
+
+    def disarm(self, emu):
+        for handle in self.handles:
+            emu.uc.hook_del(handle)
+        self.handles = []
+
+    def fault_cb(self, uc, address, size, user_data):
+        if address not in self.addresses:
+            return
+        self.address = address
+        self.stop(self, address)
+
+
+class CpuException(Condition):
+    # an exception unicorn raises instead of running it, of svc or bkpt. An
+    # undefined instruction is a unicorn error. exc_no is unicorn's number of it
+    name = "exception"
+
+    def __init__(self):
+        self.handle = None
+        self.exc_no = None
+
+    def arm(self, emu, stop):
+        self.stop = stop
+        self.handle = emu.uc.hook_add(UC_HOOK_INTR, self.intr_cb)
+
+    def disarm(self, emu):
+        emu.uc.hook_del(self.handle)
+
+    def intr_cb(self, uc, exc_no, user_data):
+        self.exc_no = exc_no
+        self.stop(self)
+
+
+class RxWaiting(Condition):
+    # the radio listens again with nothing left in the scenario to send, so
+    # whatever the firmware received has been handled
+    name = "rx_waiting"
+
+    def arm(self, emu, stop):
+        self.scenario = emu.scenario
+        self.saved = self.scenario.callbacks["waiting"]
+        self.stop = stop
+        self.scenario.add_callback("waiting", self.waiting_cb)
+
+    def disarm(self, emu):
+        self.scenario.add_callback("waiting", self.saved)
+
+    def waiting_cb(self):
+        self.stop(self)
+        if self.saved != None:
+            self.saved()
+
+
+class SanitizerReport(Condition):
+    # a new report of the sanitizer the emulator runs, see Emulator.start_sanitizer()
+    name = "sanitizer"
+
+    def __init__(self):
+        self.report = None
+
+    def arm(self, emu, stop):
+        self.sanitizer = emu.sanitizer
+        self.saved = self.sanitizer.callbacks["report"]
+        self.stop = stop
+        self.sanitizer.add_callback("report", self.report_cb)
+
+    def disarm(self, emu):
+        self.sanitizer.add_callback("report", self.saved)
+
+    def report_cb(self, report):
+        self.report = report
+        self.stop(self)
+        if self.saved != None:
+            self.saved(report)
+
+
+class HeadlessRun:
+    # runs an emulator until a condition is met or a budget is used up.
+    # The instruction budget is a clock event like the time budget, so the
+    # block hook does no extra work. Both are relative to where the run starts
+    def __init__(self, emu, seconds=None, instructions=None, conditions=()):
+        self.emu = emu
+        self.seconds = seconds
+        self.instructions = instructions
+        self.conditions = list(conditions)
+        self.reason = None
+        self.condition = None
+        self.generation = 0
+
+    def stop(self, condition, pc=None):
+        if self.reason is None:
+            self.reason = condition.name
+            self.condition = condition
+        self.emu.stop(pc)
+
+    def budget_cb(self, generation):
+        if generation != self.generation:
+            return
+        left = self.icount_limit - self.emu.icount
+        if left > 0:
+            # idle time passed since the event was scheduled
+            self.emu.clock.schedule(left, self.budget_cb, self.generation)
+            return
+        if self.reason is None:
+            self.reason = INSTRUCTIONS
+        self.emu.stop()
+
+    def run(self):
+        emu = self.emu
+        clock = emu.clock
+        self.generation += 1
+        icount = emu.icount
+        start = clock.time
+        deadline = NEVER if self.seconds is None else start + seconds_to_cycles(self.seconds)
+        if self.instructions is not None:
+            self.icount_limit = icount + self.instructions
+            clock.schedule(self.instructions, self.budget_cb, self.generation)
+        for condition in self.conditions:
+            condition.arm(emu, self.stop)
+        start_time = time.time()
+        error = None
+        try:
+            if deadline == NEVER:
+                emu.resume()
+            else:
+                emu.run_until(deadline)
+        except UcError as e:
+            error = e
+            self.reason = ERROR
+        finally:
+            self.generation += 1
+            for condition in self.conditions:
+                condition.disarm(emu)
+        if self.reason is None:
+            self.reason = TIME if clock.time >= deadline else EXITED
+        return RunResult(self.reason, self.condition, emu.uc.reg_read(UC_ARM_REG_PC), emu.icount - icount,
+                         cycles_to_us(clock.time - start), time.time() - start_time, error)
@@ -0,0 +1,176 @@
+from collections import namedtuple, Counter
+
+from unicorn import UC_HOOK_MEM_READ, UC_HOOK_MEM_WRITE
+from unicorn.arm_const import UC_ARM_REG_SP, UC_ARM_REG_MSP, UC_ARM_REG_PSP, UC_ARM_REG_LR
+
+from .ic import EXC_RETURN_PSP, EXC_RETURN_BASIC_FRAME, FRAME_SIZE, FP_FRAME_SIZE
+from .logger import logger
+
+# shadow memory for SRAM: one bit per byte, set once the byte has been
+# written by the firmware (stores, exception frames) or by radio DMA. Only the
+# RAM range is hooked, a store costs a shift and an or, a load a compare.
+# Copies of many bytes at once (packets the radio receives) set whole shadow
+# bytes per slice assignment instead of going bit by bit.
+#
+# The stack is [stack_limit, initial_sp). Below it lies a guard window, a
+# store there while sp is below the limit is the stack overflowing into
+# whatever the linker put under it. Radio DMA has to stay within the object
+# PACKETPTR points into: its symbol if the image has one, else the stack or
+# the RAM before it.
+UNINIT_READ = "uninit_read"
+STACK_OVERFLOW = "stack_overflow"
+RADIO_OVERFLOW = "radio_overflow"
+RADIO_UNINIT = "radio_uninit"
+
+# stack size assumed for images without symbols
+DEFAULT_STACK_SIZE = 0x1000
+STACK_GUARD = 0x400
+
+# pc is the basic block the access happened in, see Emulator.block_address
+Report = namedtuple('Report', ['kind', 'pc', 'address', 'size', 'icount'])
+
+
+class Sanitizer:
+    def __init__(self, emu, ram_begin, ram_size, stack_size=None):
+        self.emu = emu
+        self.ram_begin = ram_begin
+        self.ram_end = ram_begin + ram_size
+        self.shadow = bytearray(ram_size // 8)
+        self.stack_top = emu.vector_table['initial_sp']
+        self.stack_limit = self.stack_top - stack_size if stack_size else self.guess_stack_limit()
+        self.guard_begin = max(self.stack_limit - STACK_GUARD, ram_begin)
+        # (kind, pc) -> first Report, and how often each happened
+        self.reports = {}
+        self.counts = Counter()
+        self.handles = []
+        self.callbacks = {
+            # Report, the first one of every (kind, pc)
+            "report": None
+        }
+
+    def add_callback(self, name, cb):
+        self.callbacks[name] = cb
+
+    def guess_stack_limit(self):
+        # end of the last object below the stack, the stack may grow down to it
+        ends = [symbol.address + symbol.size for symbol in self.emu.symbols.symbols
+                if self.ram_begin <= symbol.address < self.stack_top]
+        return max(ends) if ends else self.stack_top - DEFAULT_STACK_SIZE
+
+    def start(self):
+        emu = self.emu
+        end = self.ram_end - 1
+        self.handles = [emu.uc.hook_add(UC_HOOK_MEM_WRITE, self.uc_write_cb, begin=self.ram_begin, end=end),
+                        emu.uc.hook_add(UC_HOOK_MEM_READ, self.uc_read_cb, begin=self.ram_begin, end=end)]
+        self.saved_enter = emu.nvic.callbacks["enter"]
+        emu.nvic.add_callback("enter", self.irq_enter_cb)
+        radio = emu.peripherals['RADIO']
+        self.saved_dma = (radio.callbacks["dma_write"], radio.callbacks["dma_read"])
+        radio.add_callback("dma_write", self.dma_write_cb)
+        radio.add_callback("dma_read", self.dma_read_cb)
+
+    def stop(self):
+        emu = self.emu
+        for handle in self.handles:
+            emu.uc.hook_del(handle)
+        self.handles = []
+        emu.nvic.add_callback("enter", self.saved_enter)
+        radio = emu.peripherals['RADIO']
+        radio.add_callback("dma_write", self.saved_dma[0])
+        radio.add_callback("dma_read", self.saved_dma[1])
+
+    def save_state(self):
+        return bytes(self.shadow)
+
+    def load_state(self, state):
+        self.shadow[:] = state
+
+    def mark(self, address, size):
+        # bytes [address, address + size) are initialized
+        begin = max(address, self.ram_begin) - self.ram_begin
+        end = min(address + size, self.ram_end) - self.ram_begin
+        if begin >= end:
+            return
+        first, last = begin >> 3, (end - 1) >> 3
+        if first == last:
+            self.shadow[first] |= ((1 << (end - begin)) - 1) << (begin & 7)
+            return
+        self.shadow[first] |= (0xff << (begin & 7)) & 0xff
+        self.shadow[last] |= 0xff >> (7 - ((end - 1) & 7))
+        self.shadow[first + 1:last] = b'\xff' * (last - first - 1)
+
+    def uninitialized(self, address, size):
+        # offset of the first byte of [address, address + size) never written, None if there is none
+        begin = address - self.ram_begin
+        shadow = self.shadow
+        for offset in range(begin, begin + size):
+            if not shadow[offset >> 3] >> (offset & 7) & 1:
+                return offset + self.ram_begin
+        return None
+
+    def report(self, kind, address, size):
+        emu = self.emu
+        key = (kind, emu.block_address)
+        self.counts[key] += 1
+        if key in self.reports:
+            return
+        report = self.reports[key] = Report(kind, emu.block_address, address, size, emu.icount)
+        logger.info("[!] sanitizer: %s of %d bytes at 0x%x, pc=0x%x", kind, size, address, report.pc)
+        cb = self.callbacks["report"]
+        if cb != None:
+            cb(report)
+
+    def uc_write_cb(self, uc, access, address, size, value, user_data):
+        offset = address - self.ram_begin
+        bit = offset & 7
+        if bit + size <= 8:
+            self.shadow[offset >> 3] |= ((1 << size) - 1) << bit
+        else:
+            self.mark(address, size)
+        if self.guard_begin <= address < self.stack_limit and uc.reg_read(UC_ARM_REG_SP) <= address:
+            self.report(STACK_OVERFLOW, address, size)
+
+    def uc_read_cb(self, uc, access, address, size, value, user_data):
+        offset = address - self.ram_begin
+        bit = offset & 7
+        if bit + size <= 8:
+            mask = ((1 << size) - 1) << bit
+            if self.shadow[offset >> 3] & mask == mask:
+                return
+        if address + size > self.ram_end or self.uninitialized(address, size) is not None:
+            self.report(UNINIT_READ, address, size)
+
+    def irq_enter_cb(self, irq):
+        # the frame is pushed with mem_write, no hook sees it. EXC_RETURN in
+        # lr says which stack it went on and whether it has the fp registers
+        uc = self.emu.uc
+        exc_return = uc.reg_read(UC_ARM_REG_LR)
+        sp = uc.reg_read(UC_ARM_REG_PSP if exc_return & EXC_RETURN_PSP else UC_ARM_REG_MSP)
+        size = FRAME_SIZE if exc_return & EXC_RETURN_BASIC_FRAME else FP_FRAME_SIZE
+        self.mark(sp, size)
+        if self.guard_begin <= sp < self.stack_limit:
+            self.report(STACK_OVERFLOW, sp, size)
+        if self.saved_enter is not None:
+            self.saved_enter(irq)
+
+    def buffer_end(self, address):
+        # end of the RAM object address points into, see the top of the file
+        found = self.emu.symbols.lookup(address)
+        if found is not None and found[0].size:
+            return found[0].address + found[0].size
+        if address < self.stack_limit:
+            return self.stack_limit
+        if address < self.stack_top:
+            return self.stack_top
+        return self.ram_end
+
+    def dma_write_cb(self, address, size):
+        if not self.ram_begin <= address < self.ram_end or address + size > self.buffer_end(address):
+            self.report(RADIO_OVERFLOW, address, size)
+        self.mark(address, size)
+
+    def dma_read_cb(self, address, size):
+        if not self.ram_begin <= address < self.ram_end or address + size > self.buffer_end(address):
+            self.report(RADIO_OVERFLOW, address, size)
+        elif self.uninitialized(address, size) is not None:
+            self.report(RADIO_UNINIT, address, size)
@@ -0,0 +1,178 @@
+import gzip
+import itertools
+from collections import namedtuple
+
+from .logger import logger
+from .vclock import seconds_to_cycles, cycles_to_us
+
+# when a packet goes on air:
+#   AT      absolute virtual time
+#   AFTER   relative to the previous packet
+#   ON_RX   once the radio listens, after the previous packet
+AT = 0
+AFTER = 1
+ON_RX = 2
+# frequency of packets any listening radio gets
+ANY_FREQUENCY = None
+
+# time in cycles (for ON_RX the delay after the radio starts listening),
+# rxmatch is the logical address the packet was sent to
+RxPacket = namedtuple('RxPacket', ['trigger', 'time', 'frequency', 'crc_ok', 'rxmatch', 'payload'])
+
+# scenario files have one packet per line, '#' starts a comment:
+#   <time> <frequency> <crc> <rxmatch> <payload>
+# time is in microseconds, '5000000' absolute, '+400' after the previous
+# packet or 'rx+40' 40us after the radio starts listening. frequency is the
+# FREQUENCY register value or '*', crc 'ok' or 'bad', payload hex or '-' if empty.
+# Files ending in .gz are decompressed on the fly
+TRIGGER_PREFIXES = [("rx+", ON_RX), ("+", AFTER)]
+
+
+def us_to_cycles(us):
+    return seconds_to_cycles(us / 1000000)
+
+def parse_packet(line):
+    time, frequency, crc, rxmatch, payload = line.split()
+    trigger = AT
+    for prefix, kind in TRIGGER_PREFIXES:
+        if time.startswith(prefix):
+            trigger = kind
+            time = time[len(prefix):]
+            break
+    if crc not in ("ok", "bad"):
+        raise ValueError("crc must be 'ok' or 'bad': %r" % crc)
+    return RxPacket(trigger, us_to_cycles(int(time)), ANY_FREQUENCY if frequency == '*' else int(frequency, 0),
+                    crc == "ok", int(rxmatch), b'' if payload == '-' else bytes.fromhex(payload))
+
+def format_packet(packet):
+    if packet.trigger == ON_RX:
+        time = "rx+%d" % cycles_to_us(packet.time)
+    elif packet.trigger == AFTER:
+        time = "+%d" % cycles_to_us(packet.time)
+    else:
+        time = "%d" % cycles_to_us(packet.time)
+    return "%s %s %s %d %s" % (time, '*' if packet.frequency is ANY_FREQUENCY else packet.frequency,
+                               "ok" if packet.crc_ok else "bad", packet.rxmatch, packet.payload.hex() or '-')
+
+def read_scenario(path):
+    # generator, only the line being parsed is in memory
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rt') as fp:
+        for n, line in enumerate(fp, 1):
+            line = line.split('#', 1)[0].strip()
+            if not line:
+                continue
+            try:
+                yield parse_packet(line)
+            except ValueError as e:
+                raise ValueError("%s:%d: %s" % (path, n, e))
+
+def write_scenario(path, packets):
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'wt') as fp:
+        fp.write("# time frequency crc rxmatch payload\n")
+        for packet in packets:
+            fp.write(format_packet(packet) + "\n")
+
+def rx_packets(payloads, delay=0):
+    # each payload is received the next time the radio listens
+    for payload in payloads:
+        yield RxPacket(ON_RX, delay, ANY_FREQUENCY, True, 0, payload)
+
+def repeat_packet(payload, delay=0):
+    return rx_packets(itertools.repeat(payload), delay)
+
+
+class RxScenario:
+    # feeds packets to the radio of one emulator. Only the next packet of the
+    # stream is held, it goes on air from a clock event and is received if the
+    # radio listens on its frequency at that time. ON_RX packets instead wait
+    # for the radio to listen
+    def __init__(self, emu, packets=()):
+        self.emu = emu
+        self.radio = emu.peripherals['RADIO']
+        self.clock = emu.clock
+        self.packets = iter(())
+        self.head = None
+        # bumped whenever the scheduled event of head becomes stale
+        self.generation = 0
+        # air time of the previous packet
+        self.last_time = 0
+        self.received = 0
+        self.missed = 0
+        self.callbacks = {
+            "rx": None,
+            "miss": None,
+            "waiting": None
+        }
+        self.radio.add_callback("rx_start", self.rx_start_cb)
+        self.load(packets)
+
+    def add_callback(self, name, cb):
+        self.callbacks[name] = cb
+
+    def load(self, packets):
+        # replaces whatever is left of the current stream
+        self.packets = iter(packets)
+        self.last_time = self.clock.time
+        self.advance()
+
+    def save_state(self):
+        # the stream itself can't be saved, restoring keeps its current position
+        return (self.head, self.generation, self.last_time, self.received, self.missed)
+
+    def load_state(self, state):
+        self.head, self.generation, self.last_time, self.received, self.missed = state
+
+    def advance(self):
+        self.generation += 1
+        self.head = next(self.packets, None)
+        if self.head is None:
+            return
+        if self.head.trigger == ON_RX:
+            if self.radio.is_listening():
+                self.clock.schedule(self.head.time, self.deliver_cb, self.generation)
+            return
+        at = self.head.time if self.head.trigger == AT else self.last_time + self.head.time
+        self.clock.schedule_at(max(at, self.clock.time), self.deliver_cb, self.generation)
+
+    def matches(self, packet):
+        frequency = self.radio.get_reg_by_name('FREQUENCY').value
+        return (self.radio.is_listening() and self.radio.accepts_address(packet.rxmatch) and
+                packet.frequency in (ANY_FREQUENCY, frequency))
+
+    def rx_start_cb(self):
+        # the radio started listening, called from its MMIO hook
+        if self.head is None:
+            # events run at block boundaries, where the emulator can be stopped
+            self.clock.schedule(0, self.waiting_cb, self.generation)
+        elif self.head.trigger == ON_RX:
+            self.generation += 1
+            self.clock.schedule(self.head.time, self.deliver_cb, self.generation)
+
+    def waiting_cb(self, generation):
+        if generation != self.generation or self.head is not None or not self.radio.is_listening():
+            return
+        cb = self.callbacks["waiting"]
+        if cb != None:
+            cb()
+
+    def deliver_cb(self, generation):
+        if generation != self.generation:
+            return
+        packet = self.head
+        if self.matches(packet):
+            self.received += 1
+            self.emu.inject_rx_packet(packet.payload, packet.crc_ok, packet.rxmatch)
+            cb = self.callbacks["rx"]
+        elif packet.trigger == ON_RX:
+            # not for this radio yet, try again next time it listens
+            return
+        else:
+            logger.debug("[*] radio not listening, missed packet %s", packet.payload.hex())
+            self.missed += 1
+            cb = self.callbacks["miss"]
+        self.last_time = self.clock.time
+        self.advance()
+        if cb != None:
+            cb(packet)
@@ -0,0 +1,169 @@
+import bisect
+import hashlib
+import mmap
+import os
+import struct
+from collections import namedtuple
+
+from .logger import logger
+
+# relative to the repository, not the working directory
+DATA_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data')
+SVD_PATH = os.path.join(DATA_DIR, 'nrf52840.svd')
+CACHE_DIR = os.path.join(DATA_DIR, '.cache')
+
+SvdPeripheral = namedtuple('SvdPeripheral', ['name', 'base_address', 'block_offset', 'block_size'])
+SvdRegister = namedtuple('SvdRegister', ['name', 'address', 'size', 'reset_value', 'access', 'peripheral', 'fields'])
+SvdField = namedtuple('SvdField', ['name', 'bit_offset', 'bit_width'])
+
+# cache file layout (little endian):
+#   header, string table ('\0' separated), peripheral, register and field records
+CACHE_MAGIC = b'NRFRMAP1'
+HEADER = struct.Struct('<8s20sIIII')
+PERIPHERAL_RECORD = struct.Struct('<IIII')
+REGISTER_RECORD = struct.Struct('<IIIIIBxxxII')
+FIELD_RECORD = struct.Struct('<IBBxx')
+ACCESS_TYPES = [None, 'read-only', 'write-only', 'read-write', 'writeOnce', 'read-writeOnce']
+
+
+class RegisterMap:
+    def __init__(self, peripherals, registers):
+        self.peripherals = peripherals
+        self.registers = registers
+
+
+class AddressIndex:
+    # address -> peripheral and register of a RegisterMap. Peripheral blocks are
+    # sorted for bisect, peripherals sharing one block (UART0/UARTE0) become a
+    # single entry and the first of them names its registers
+    def __init__(self, regmap):
+        blocks = {}
+        for p in regmap.peripherals:
+            blocks.setdefault((p.base_address + p.block_offset, p.block_size), []).append(p.name)
+        self.blocks = [(begin, begin + size, "/".join(names)) for (begin, size), names in sorted(blocks.items())]
+        self.starts = [begin for begin, _, _ in self.blocks]
+        self.block_names = {name: block for _, _, block in self.blocks for name in block.split("/")}
+        self.registers = {}
+        for reg in regmap.registers:
+            self.registers.setdefault(reg.address, reg)
+
+    def peripheral(self, address):
+        # blocks overlap (P0/P1), a known register settles it
+        reg = self.register(address)
+        if reg is not None:
+            return self.block_names[reg.peripheral]
+        i = bisect.bisect_right(self.starts, address) - 1
+        while i >= 0:
+            begin, end, name = self.blocks[i]
+            if address < end:
+                return name
+            i -= 1
+        return None
+
+    def register(self, address):
+        return self.registers.get(address & ~3)
+
+
+def field_values(reg, value):
+    # [(field name, value)] of a register value
+    return [(f.name, (value >> f.bit_offset) & ((1 << f.bit_width) - 1)) for f in reg.fields]
+
+
+def svd_digest(svd_path):
+    with open(svd_path, 'rb') as fp:
+        return hashlib.sha1(fp.read()).digest()
+
+def cache_path(svd_path, digest):
+    name = os.path.splitext(os.path.basename(svd_path))[0]
+    return os.path.join(CACHE_DIR, "%s-%s.regmap" % (name, digest.hex()))
+
+def parse_svd(svd_path):
+    # cmsis_svd is only needed when the cache has to be rebuilt
+    from cmsis_svd.parser import SVDParser
+    device = SVDParser.for_xml_file(svd_path).get_device()
+    peripherals = []
+    registers = []
+    for p in device.peripherals:
+        peripherals.append(SvdPeripheral(p.name, p.base_address, p.address_block.offset, p.address_block.size))
+        seen = set()
+        # derived peripherals list some of their registers twice
+        for reg in p.registers:
+            if reg.address_offset in seen:
+                continue
+            seen.add(reg.address_offset)
+            fields = tuple(SvdField(f.name, f.bit_offset, f.bit_width) for f in reg.fields)
+            registers.append(SvdRegister(reg.name, p.base_address + reg.address_offset, reg.size or 32,
+                                         reg.reset_value or 0, reg.access, p.name, fields))
+    return RegisterMap(peripherals, registers)
+
+def write_cache(path, digest, regmap):
+    strings = {}
+    def intern(s):
+        if s not in strings:
+            strings[s] = len(strings)
+        return strings[s]
+
+    periph_idx = {}
+    periph_data = bytearray()
+    for i, p in enumerate(regmap.peripherals):
+        periph_idx.setdefault(p.name, i)
+        periph_data += PERIPHERAL_RECORD.pack(intern(p.name), p.base_address, p.block_offset, p.block_size)
+    reg_data = bytearray()
+    field_data = bytearray()
+    field_count = 0
+    for reg in regmap.registers:
+        reg_data += REGISTER_RECORD.pack(intern(reg.name), periph_idx[reg.peripheral], reg.address, reg.size,
+                                         reg.reset_value, ACCESS_TYPES.index(reg.access), field_count, len(reg.fields))
+        for f in reg.fields:
+            field_data += FIELD_RECORD.pack(intern(f.name), f.bit_offset, f.bit_width)
+        field_count += len(reg.fields)
+    strtab = '\0'.join(strings).encode()
+    header = HEADER.pack(CACHE_MAGIC, digest, len(regmap.peripherals), len(regmap.registers), field_count, len(strtab))
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # write to a temporary name first, parallel workers may race on a cold cache
+    tmp_path = "%s.%d" % (path, os.getpid())
+    with open(tmp_path, 'wb') as fp:
+        fp.write(header + strtab + periph_data + reg_data + field_data)
+    os.replace(tmp_path, path)
+
+def read_cache(path, digest):
+    with open(path, 'rb') as fp, mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        magic, file_digest, n_periph, n_reg, n_field, strtab_len = HEADER.unpack_from(mm, 0)
+        if magic != CACHE_MAGIC or file_digest != digest:
+            return None
+        offset = HEADER.size
+        strings = mm[offset:offset + strtab_len].decode().split('\0')
+        offset += strtab_len
+        end = offset + n_periph * PERIPHERAL_RECORD.size
+        peripherals = [SvdPeripheral(strings[n], base, block_offset, block_size)
+                       for n, base, block_offset, block_size in PERIPHERAL_RECORD.iter_unpack(mm[offset:end])]
+        offset = end
+        end = offset + n_reg * REGISTER_RECORD.size
+        reg_records = list(REGISTER_RECORD.iter_unpack(mm[offset:end]))
+        offset = end
+        fields = [SvdField(strings[n], bit_offset, bit_width)
+                  for n, bit_offset, bit_width in FIELD_RECORD.iter_unpack(mm[offset:offset + n_field * FIELD_RECORD.size])]
+    registers = [SvdRegister(strings[n], address, size, reset_value, ACCESS_TYPES[access], peripherals[p].name,
+                             tuple(fields[field_start:field_start + field_count]))
+                 for n, p, address, size, reset_value, access, field_start, field_count in reg_records]
+    return RegisterMap(peripherals, registers)
+
+def load_register_map(svd_path=SVD_PATH):
+    digest = svd_digest(svd_path)
+    path = cache_path(svd_path, digest)
+    if os.path.exists(path):
+        regmap = read_cache(path, digest)
+        if regmap is not None:
+            return regmap
+    logger.info("[*] building register map cache for %s", svd_path)
+    regmap = parse_svd(svd_path)
+    write_cache(path, digest, regmap)
+    remove_stale_caches(path)
+    return regmap
+
+def remove_stale_caches(path):
+    prefix = os.path.basename(path).rsplit('-', 1)[0] + '-'
+    for filename in os.listdir(os.path.dirname(path)):
+        if filename.startswith(prefix) and filename.endswith('.regmap') and filename != os.path.basename(path):
+            os.remove(os.path.join(os.path.dirname(path), filename))
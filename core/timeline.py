@@ -0,0 +1,143 @@
+import bisect
+import time
+from array import array
+
+from .vclock import CPU_FREQUENCY
+
+# VCD time unit, a cycle of the 64 MHz cpu is a whole number of them
+VCD_TIMESCALE_PS = 1
+PS_PER_CYCLE = 1000000000000 // CPU_FREQUENCY
+
+
+class PinTimeline:
+    # levels of the 32 pins of a port over virtual time, run length encoded:
+    # from times[i] on the pins are at levels[i]. Runs may be empty when a
+    # pin changes twice in one translation block, which keeps short pulses
+    def __init__(self, initial=0):
+        self.times = array('Q', [0])
+        self.levels = array('I', [initial])
+
+    def record(self, time, levels):
+        if levels != self.levels[-1]:
+            self.times.append(time)
+            self.levels.append(levels)
+
+    def save_state(self):
+        # a copy: the timeline may have been cut back further than the
+        # snapshot by the time it is restored, replay seeks back and forth
+        return (self.times.tobytes(), self.levels.tobytes())
+
+    def load_state(self, state):
+        # back to a snapshot, what happened after it is forgotten
+        times, levels = state
+        self.times = array('Q', times)
+        self.levels = array('I', levels)
+
+    def level(self, pin, time):
+        i = bisect.bisect_right(self.times, time) - 1
+        return (self.levels[max(i, 0)] >> pin) & 1
+
+    def edges(self, pin):
+        # [(time, new level)] of every change of pin
+        edges = []
+        bit = 1 << pin
+        previous = self.levels[0] & bit
+        for time, levels in zip(self.times, self.levels):
+            if levels & bit != previous:
+                previous = levels & bit
+                edges.append((time, 1 if previous else 0))
+        return edges
+
+    def changed_pins(self):
+        # mask of the pins that changed at least once
+        mask = 0
+        for previous, levels in zip(self.levels, self.levels[1:]):
+            mask |= previous ^ levels
+        return mask
+
+    def pulse_widths(self, pin, level=1):
+        # cycles pin stayed at level, pulses still going on are left out
+        widths = []
+        start = 0 if self.level(pin, 0) == level else None
+        for time, new in self.edges(pin):
+            if new == level:
+                start = time
+            elif start is not None:
+                widths.append(time - start)
+                start = None
+        return widths
+
+    def blink_widths(self, pin, active=1):
+        # cycles an LED on pin was lit in each complete on/off cycle, active
+        # is the level that lights it. The first edge is the firmware setting
+        # the pin up at boot, a pulse starting there isn't a blink
+        widths = []
+        start = None
+        for i, (time, new) in enumerate(self.edges(pin)):
+            if new == active:
+                start = time if i else None
+            elif start is not None:
+                widths.append(time - start)
+                start = None
+        return widths
+
+    def blinks(self, pin, active=1):
+        return len(self.blink_widths(pin, active))
+
+
+def vcd_identifier(n):
+    # short printable identifiers: !, ", ..., ~, !!, ...
+    chars = ""
+    while True:
+        chars += chr(33 + n % 94)
+        n = n // 94 - 1
+        if n < 0:
+            return chars
+
+def write_vcd(path, signals, end_time=None):
+    # signals: [(scope, name, PinTimeline)], each is a 32 bit bus plus a wire
+    # for every pin that ever changed
+    vars = []
+    count = 0
+    for scope, name, timeline in signals:
+        changed = timeline.changed_pins()
+        # pin -> identifier of its wire
+        wires = {}
+        for pin in range(32):
+            if changed >> pin & 1:
+                wires[pin] = vcd_identifier(count + 1 + len(wires))
+        vars.append((scope, name, timeline, vcd_identifier(count), wires))
+        count += 1 + len(wires)
+    with open(path, 'w') as fp:
+        fp.write("$date %s $end\n" % time.strftime("%Y-%m-%d %H:%M:%S"))
+        fp.write("$version nrf52 emulator $end\n")
+        fp.write("$timescale %dps $end\n" % VCD_TIMESCALE_PS)
+        for scope in dict.fromkeys(var[0] for var in vars):
+            fp.write("$scope module %s $end\n" % scope)
+            for var_scope, name, timeline, ident, wires in vars:
+                if var_scope == scope:
+                    fp.write("$var wire 32 %s %s [31:0] $end\n" % (ident, name))
+                    for pin, wire in wires.items():
+                        fp.write("$var wire 1 %s %s%d $end\n" % (wire, name, pin))
+            fp.write("$upscope $end\n")
+        fp.write("$enddefinitions $end\n")
+
+        # value changes of all signals merged by time
+        changes = []
+        for n, var in enumerate(vars):
+            changes.extend((t, n, i) for i, t in enumerate(var[2].times))
+        changes.sort()
+        current = None
+        for t, n, i in changes:
+            scope, name, timeline, ident, wires = vars[n]
+            if t != current:
+                fp.write("#%d\n" % (t * PS_PER_CYCLE // VCD_TIMESCALE_PS))
+                current = t
+            levels = timeline.levels[i]
+            diff = levels ^ timeline.levels[i - 1] if i else 0xffffffff
+            fp.write("b%s %s\n" % (bin(levels)[2:], ident))
+            for pin, wire in wires.items():
+                if diff >> pin & 1:
+                    fp.write("%d%s\n" % (levels >> pin & 1, wire))
+        if end_time is not None:
+            fp.write("#%d\n" % (end_time * PS_PER_CYCLE // VCD_TIMESCALE_PS))
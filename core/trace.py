@@ -0,0 +1,160 @@
+import gzip
+import struct
+from collections import namedtuple
+
+# record types
+MMIO_READ = 1
+MMIO_WRITE = 2
+IRQ_ENTER = 3
+IRQ_EXIT = 4
+GPIO_OUTSET = 5
+GPIO_OUTCLR = 6
+RADIO_TX = 7
+RADIO_RX = 8
+# continuation of a RADIO_TX/RADIO_RX record carrying payload bytes
+DATA = 9
+RECORD_TYPES = {
+    MMIO_READ: "mmio_read",
+    MMIO_WRITE: "mmio_write",
+    IRQ_ENTER: "irq_enter",
+    IRQ_EXIT: "irq_exit",
+    GPIO_OUTSET: "gpio_outset",
+    GPIO_OUTCLR: "gpio_outclr",
+    RADIO_TX: "radio_tx",
+    RADIO_RX: "radio_rx",
+}
+
+# type, size (bytes accessed or payload length), pc of the basic block,
+# virtual time in cycles, address, value. IRQ records hold the irq number in
+# value, radio records the frequency in address and are followed by DATA
+# records with the payload
+RECORD = struct.Struct('<BxHIQII')
+RECORD_SIZE = RECORD.size
+DATA_HEADER = struct.Struct('<B')
+DATA_SIZE = RECORD_SIZE - DATA_HEADER.size
+MAGIC = b'NRFTRACE'
+HEADER = struct.Struct('<8sII')
+VERSION = 1
+# 64k records, 1.5MB
+DEFAULT_CAPACITY = 1 << 16
+READ_CHUNK = RECORD_SIZE * 4096
+
+Record = namedtuple('Record', ['type', 'size', 'pc', 'time', 'address', 'value', 'payload'])
+
+
+class TraceWriter:
+    # records go to a preallocated buffer. With a file the buffer is written
+    # out whenever it fills up, without one it is a ring keeping the latest records
+    def __init__(self, path=None, capacity=DEFAULT_CAPACITY):
+        self.buffer = bytearray(RECORD_SIZE * capacity)
+        self.view = memoryview(self.buffer)
+        self.offset = 0
+        self.wrapped = False
+        self.records = 0
+        self.fp = None
+        if path is not None:
+            self.fp = open(path, 'wb')
+            self.fp.write(HEADER.pack(MAGIC, VERSION, RECORD_SIZE))
+
+    def record(self, kind, pc, time, address, value, size=4):
+        RECORD.pack_into(self.buffer, self.offset, kind, size, pc, time, address, value)
+        self.offset += RECORD_SIZE
+        self.records += 1
+        if self.offset == len(self.buffer):
+            self.flush()
+
+    def payload(self, kind, pc, time, address, data):
+        self.record(kind, pc, time, address, 0, len(data))
+        for i in range(0, len(data), DATA_SIZE):
+            chunk = data[i:i + DATA_SIZE]
+            self.buffer[self.offset] = DATA
+            self.buffer[self.offset + 1:self.offset + RECORD_SIZE] = chunk.ljust(DATA_SIZE, b'\0')
+            self.offset += RECORD_SIZE
+            if self.offset == len(self.buffer):
+                self.flush()
+
+    def flush(self):
+        if self.fp is not None:
+            self.fp.write(self.view[:self.offset])
+        elif self.offset == len(self.buffer):
+            self.wrapped = True
+        else:
+            return
+        self.offset = 0
+
+    def contents(self):
+        # buffered records, oldest first
+        if self.wrapped:
+            return bytes(self.view[self.offset:]) + bytes(self.view[:self.offset])
+        return bytes(self.view[:self.offset])
+
+    def save(self, path):
+        # write the in-memory ring to a trace file
+        with open(path, 'wb') as fp:
+            fp.write(HEADER.pack(MAGIC, VERSION, RECORD_SIZE))
+            fp.write(self.contents())
+
+    def close(self):
+        if self.fp is not None:
+            self.flush()
+            self.fp.close()
+            self.fp = None
+
+
+def iter_records(chunks):
+    # chunks of whole records -> Record, payload records are merged into their header
+    pending = None
+    data = None
+    for chunk in chunks:
+        for i, (kind, size, pc, time, address, value) in enumerate(RECORD.iter_unpack(chunk)):
+            if kind == DATA:
+                if pending is None:
+                    # the ring wrapped in the middle of a payload
+                    continue
+                offset = i * RECORD_SIZE + DATA_HEADER.size
+                data += chunk[offset:offset + min(DATA_SIZE, pending.size - len(data))]
+                if len(data) == pending.size:
+                    yield pending._replace(payload=bytes(data))
+                    pending = None
+                continue
+            if pending is not None:
+                # truncated payload
+                yield pending._replace(payload=bytes(data))
+                pending = None
+            record = Record(kind, size, pc, time, address, value, None)
+            if kind in (RADIO_TX, RADIO_RX) and size:
+                pending = record
+                data = bytearray()
+            elif kind in (RADIO_TX, RADIO_RX):
+                yield record._replace(payload=b'')
+            else:
+                yield record
+    if pending is not None:
+        yield pending._replace(payload=bytes(data))
+
+def read_chunks(fp):
+    header = fp.read(HEADER.size)
+    magic, version, record_size = HEADER.unpack(header)
+    if magic != MAGIC or record_size != RECORD_SIZE:
+        raise ValueError("not a trace file (version %d)" % version)
+    while True:
+        chunk = fp.read(READ_CHUNK)
+        if not chunk:
+            break
+        tail = len(chunk) % RECORD_SIZE
+        if tail:
+            # partial record at the end of an unfinished trace
+            chunk = chunk[:-tail]
+            if not chunk:
+                break
+        yield chunk
+
+def open_trace(path):
+    # '.gz' traces are decompressed on the fly
+    opener = gzip.open if path.endswith('.gz') else open
+    return opener(path, 'rb')
+
+def read_trace(path):
+    # streams the records of a trace file without loading it
+    with open_trace(path) as fp:
+        yield from iter_records(read_chunks(fp))
@@ -0,0 +1,206 @@
+import struct
+from collections import namedtuple
+from itertools import groupby
+from operator import itemgetter
+
+from . import trace as tracing
+
+# two traces of the same scenario, e.g. of two builds of a firmware, are
+# compared as sequences of peripheral events: what was written to which
+# register, interrupts, pin changes and packets sent. pcs and times are left
+# out, they move with every change to the code. Runs of the same event count
+# as one unless repeats are kept, a delay loop writing TASKS_CAPTURE a few
+# times more in one build is no divergence.
+#
+# Both traces are streamed a chunk at a time. As long as the chunks at the
+# same offset of both files are byte for byte the same they are skipped
+# without decoding, the common prefix of two runs of one build costs a memcmp.
+# After that every chunk is turned into a list of event keys by one
+# comprehension and the lists are compared a slice at a time.
+DEFAULT_KINDS = (tracing.MMIO_WRITE, tracing.IRQ_ENTER, tracing.IRQ_EXIT, tracing.GPIO_OUTSET,
+                 tracing.GPIO_OUTCLR, tracing.RADIO_TX)
+RADIO_KINDS = (tracing.RADIO_TX, tracing.RADIO_RX)
+# events shown before the divergence
+DEFAULT_CONTEXT = 8
+# trace.RECORD with its pad byte, DATA records have payload there. The key of
+# an event is (type, size, address, value), DATA records are keys as they are
+KEY_RECORD = struct.Struct('<BBHIQII')
+DATA = tracing.DATA
+SIZE_FIELD = struct.Struct('<H')
+SIZE_OFFSET = 2
+
+# one chunk of a trace: index of its first record, the bytes and the state
+# decoding starts from (see EventStream.decode())
+Chunk = namedtuple('Chunk', ['record', 'data', 'carry', 'last'])
+# the first events that differ: record index in each trace and the Record,
+# None for a trace that ended. context are (index, Record) of the events before
+Divergence = namedtuple('Divergence', ['index_a', 'record_a', 'index_b', 'record_b', 'context_a', 'context_b'])
+
+
+def event_key(row):
+    return row if row[0] == DATA else (row[0], row[2], row[5], row[6])
+
+def record_at(data, position):
+    # Record at position of a chunk, payloads are cut short at its end
+    kind, size, pc, time, address, value = tracing.RECORD.unpack_from(data, position * tracing.RECORD_SIZE)
+    payload = None
+    if kind in RADIO_KINDS:
+        payload = bytearray()
+        offset = (position + 1) * tracing.RECORD_SIZE
+        while len(payload) < size and offset < len(data) and data[offset] == DATA:
+            payload += data[offset + tracing.DATA_HEADER.size:offset + tracing.RECORD_SIZE]
+            offset += tracing.RECORD_SIZE
+        payload = bytes(payload[:size])
+    return tracing.Record(kind, size, pc, time, address, value, payload)
+
+
+class EventStream:
+    # the events of one trace file
+    def __init__(self, fp, kinds=DEFAULT_KINDS, repeats=False):
+        self.chunks = tracing.read_chunks(fp)
+        self.wanted = set(kinds)
+        if self.wanted & set(RADIO_KINDS):
+            self.wanted.add(DATA)
+        # radio records that aren't wanted, their DATA records are dropped with them
+        self.dropped_kinds = [kind for kind in RADIO_KINDS if kind not in self.wanted]
+        self.repeats = repeats
+        # records before the next chunk
+        self.record = 0
+        # DATA records of a dropped payload the next chunk starts with
+        self.carry = 0
+        # last event key so far, runs carry over from one chunk to the next
+        self.last = None
+        self.chunk = None
+        self.previous = None
+
+    def next_chunk(self):
+        # the next Chunk, None at the end of the trace
+        data = next(self.chunks, None)
+        self.previous = self.chunk
+        self.chunk = None if data is None else Chunk(self.record, data, self.carry, self.last)
+        if data is not None:
+            self.record += len(data) // tracing.RECORD_SIZE
+        return self.chunk
+
+    def skip(self, chunk):
+        # chunk is the same in both traces and isn't decoded. The run of the
+        # last event is broken off the same way in both
+        _, self.carry = self.dropped(chunk.data, chunk.carry)
+        self.last = None
+
+    def dropped(self, data, carry):
+        # (positions of the records of unwanted payloads, carry for the next chunk)
+        types = data[0::tracing.RECORD_SIZE]
+        count = len(types)
+        drop = set(range(min(carry, count)))
+        carry = max(carry - count, 0)
+        for kind in self.dropped_kinds:
+            i = types.find(kind)
+            while i >= 0:
+                size, = SIZE_FIELD.unpack_from(data, i * tracing.RECORD_SIZE + SIZE_OFFSET)
+                end = i + 1 + (size + tracing.DATA_SIZE - 1) // tracing.DATA_SIZE
+                drop.update(range(i, min(end, count)))
+                carry = max(carry, end - count)
+                i = types.find(kind, i + 1)
+        return drop, carry
+
+    def decode(self, chunk, positions=False):
+        # event keys of chunk, [(key, position)] with positions. The stream
+        # moves on to the state after it
+        drop, self.carry = self.dropped(chunk.data, chunk.carry)
+        wanted = self.wanted
+        rows = KEY_RECORD.iter_unpack(chunk.data)
+        if positions:
+            events = [(event_key(row), i) for i, row in enumerate(rows) if row[0] in wanted and i not in drop]
+            if not self.repeats:
+                events = [next(run) for _, run in groupby(events, key=itemgetter(0))]
+                if events and events[0][0] == chunk.last:
+                    del events[0]
+            self.last = events[-1][0] if events else chunk.last
+            return events
+        # event_key() inlined, this is where the time goes
+        if drop:
+            keys = [row if row[0] == DATA else (row[0], row[2], row[5], row[6])
+                    for i, row in enumerate(rows) if row[0] in wanted and i not in drop]
+        else:
+            keys = [row if row[0] == DATA else (row[0], row[2], row[5], row[6]) for row in rows if row[0] in wanted]
+        if not self.repeats:
+            keys = [key for key, _ in groupby(keys)]
+            if keys and keys[0] == chunk.last:
+                del keys[0]
+        self.last = keys[-1] if keys else chunk.last
+        return keys
+
+    def locate(self, chunk, n, context):
+        # (index, Record) of event n of chunk (the current one, None at the
+        # end of the trace) and the events before it in this chunk and the
+        # previous one. The Record is None at the end, DATA events are found
+        # as the radio record they belong to
+        events = self.decode(chunk, True) if chunk is not None else []
+        target = None
+        if n < len(events):
+            data, record, position = chunk.data, chunk.record, events[n][1]
+            while data[position * tracing.RECORD_SIZE] == DATA:
+                if data is chunk.data and position == 0:
+                    # the radio record is in the previous chunk, payloads are
+                    # much shorter than a chunk
+                    data = self.previous.data + chunk.data
+                    record = self.previous.record
+                    position = len(self.previous.data) // tracing.RECORD_SIZE
+                position -= 1
+            target = (record + position, record_at(data, position))
+        before = []
+        if self.previous is not None:
+            before = [(self.previous, position) for key, position in self.decode(self.previous, True)]
+        before += [(chunk, position) for key, position in events]
+        before = [(c.record + position, record_at(c.data, position)) for c, position in before
+                  if c.data[position * tracing.RECORD_SIZE] != DATA and
+                  (target is None or c.record + position < target[0])][-context:]
+        if target is None:
+            return (self.record, None), before
+        return target, before
+
+
+def first_divergence(path_a, path_b, kinds=DEFAULT_KINDS, repeats=False, context=DEFAULT_CONTEXT):
+    # Divergence of the traces at path_a and path_b, None if they have the same events
+    with open(path_a, 'rb') as fp_a, open(path_b, 'rb') as fp_b:
+        a = EventStream(fp_a, kinds, repeats)
+        b = EventStream(fp_b, kinds, repeats)
+        chunk_a, chunk_b = a.next_chunk(), b.next_chunk()
+        # common prefix
+        while chunk_a is not None and chunk_b is not None and chunk_a.data == chunk_b.data:
+            a.skip(chunk_a)
+            b.skip(chunk_b)
+            chunk_a, chunk_b = a.next_chunk(), b.next_chunk()
+        keys_a = a.decode(chunk_a) if chunk_a is not None else []
+        keys_b = b.decode(chunk_b) if chunk_b is not None else []
+        i = j = 0
+        while True:
+            if i == len(keys_a) and chunk_a is not None:
+                chunk_a = a.next_chunk()
+                keys_a = a.decode(chunk_a) if chunk_a is not None else []
+                i = 0
+                continue
+            if j == len(keys_b) and chunk_b is not None:
+                chunk_b = b.next_chunk()
+                keys_b = b.decode(chunk_b) if chunk_b is not None else []
+                j = 0
+                continue
+            n = min(len(keys_a) - i, len(keys_b) - j)
+            if n == 0:
+                if chunk_a is None and chunk_b is None:
+                    return None
+                # one trace ended
+                break
+            if keys_a[i:i + n] == keys_b[j:j + n]:
+                i += n
+                j += n
+                continue
+            k = next(k for k in range(n) if keys_a[i + k] != keys_b[j + k])
+            i += k
+            j += k
+            break
+        # the chunks are decoded again, this time with the positions of the events
+        (index_a, record_a), context_a = a.locate(chunk_a, i, context)
+        (index_b, record_b), context_b = b.locate(chunk_b, j, context)
+        return Divergence(index_a, record_a, index_b, record_b, context_a, context_b)
@@ -0,0 +1,94 @@
+import heapq
+
+# one executed instruction is one cycle of the 64 MHz cpu
+CPU_FREQUENCY = 64000000
+NEVER = float('inf')
+
+# a register read again by a loop of at most POLL_WINDOW cycles, with
+# nothing else polled in between, counts as busy waiting. After
+# POLL_THRESHOLD such reads time is fast forwarded, doubling the jump
+# up to MAX_WARP cycles (which bounds how far a polled deadline can be
+# overshot) and never past the next scheduled event.
+POLL_WINDOW = 256
+POLL_THRESHOLD = 4
+MIN_WARP = 64
+MAX_WARP = CPU_FREQUENCY // 1000
+
+
+def seconds_to_cycles(seconds):
+    return int(seconds * CPU_FREQUENCY)
+
+def cycles_to_us(cycles):
+    return cycles * 1000000 // CPU_FREQUENCY
+
+
+class VirtualClock:
+    def __init__(self):
+        # cycles since reset, executed instructions plus skipped idle time
+        self.time = 0
+        self.skipped = 0
+        # heap of (deadline, seq, callback, arg), events are never removed,
+        # owners invalidate them by checking arg when they fire
+        self.queue = []
+        self.seq = 0
+        self.next_deadline = NEVER
+        self.poll_key = None
+        self.poll_time = 0
+        self.poll_streak = 0
+        self.warp = 0
+
+    def schedule_at(self, deadline, callback, arg=None):
+        heapq.heappush(self.queue, (deadline, self.seq, callback, arg))
+        self.seq += 1
+        self.next_deadline = self.queue[0][0]
+
+    def schedule(self, delay, callback, arg=None):
+        self.schedule_at(self.time + delay, callback, arg)
+
+    def run_due(self):
+        queue = self.queue
+        while queue and queue[0][0] <= self.time:
+            deadline, seq, callback, arg = heapq.heappop(queue)
+            callback(arg)
+        self.next_deadline = queue[0][0] if queue else NEVER
+
+    def advance(self, cycles):
+        # skip idle time, but never past the next event. Due events are left
+        # to the next block boundary, firmware state is only consistent there
+        target = min(self.time + cycles, self.next_deadline)
+        if target > self.time:
+            self.skipped += target - self.time
+            self.time = target
+
+    def skip_polling(self, cycles):
+        # advance() for time a poll loop spends spinning, the loop keeps
+        # counting as busy waiting with the jump it has built up
+        self.advance(cycles)
+        self.poll_time = self.time
+
+    def skip_to_next_event(self):
+        if self.next_deadline != NEVER:
+            self.advance(self.next_deadline - self.time)
+
+    def idle_poll(self, key):
+        # called by peripherals when firmware samples a value that only changes with time
+        if key == self.poll_key and self.time - self.poll_time <= POLL_WINDOW:
+            self.poll_streak += 1
+            if self.poll_streak >= POLL_THRESHOLD:
+                self.warp = min(max(self.warp * 2, MIN_WARP), MAX_WARP)
+                self.advance(self.warp)
+        else:
+            self.poll_streak = 0
+            self.warp = 0
+        self.poll_key = key
+        self.poll_time = self.time
+
+    def save_state(self):
+        return (self.time, self.skipped, list(self.queue), self.seq,
+                self.poll_key, self.poll_time, self.poll_streak, self.warp)
+
+    def load_state(self, state):
+        (self.time, self.skipped, queue, self.seq,
+         self.poll_key, self.poll_time, self.poll_streak, self.warp) = state
+        self.queue = list(queue)
+        self.next_deadline = self.queue[0][0] if self.queue else NEVER
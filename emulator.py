@@ -1,24 +1,113 @@
 from unicorn import *
+from unicorn import unicorn as unicorn_lib
 from unicorn.arm_const import *
-from capstone import *
-from capstone.arm import *
-from cmsis_svd.parser import SVDParser
 
-from collections import OrderedDict
+from collections import OrderedDict, Counter
+import ctypes
+import os
 import struct
 
-from core.peripheral import load_peripherals
-from core.ic import interrupt_enter,interrupt_return
+from core.analysis import PollLoop, load_analysis, analyzer_config
+from core.peripheral import load_peripheral, load_peripherals, peripheral_windows, window_name, time_sampling_addresses
+from core.events import EventBus
+from core.image import load_image
+from core.ic import NVIC, NVIC_ISER, NVIC_END, SCB_VTOR, SYSM_PRIMASK, SYSM_FAULTMASK
 from core.logger import logger
+from core.memory import MemoryRegion, Snapshot
+from core.run import HeadlessRun
+from core.sanitizer import Sanitizer
+from core.scenario import RxScenario
+from core.svd import DATA_DIR
+from core import trace as tracing
+from core.vclock import VirtualClock, NEVER, seconds_to_cycles
 
+# the firmware the tools run when given none, next to the SVD
+DEFAULT_FIRMWARE = os.path.join(DATA_DIR, 'CoriandoloRadio.bin')
 RAM_START_ADDRESS = 0x20000000
 RAM_SIZE = 0x40000
-NRF52840_REGISTERS = {}
-NRF52840_PERIPHERALS = {}
-# NOTE: you'd need to handle mrs & msr properly in 
-# firmware running on top of a RTOS
-INSTRUCTIONS_TO_SKIP = ["vmsr", "mrs", "msr"]
-RADIO_INT_RETURN = False
+# (base, size) of the peripheral windows, peripheral registers live in their memory
+MMIO_RANGES = [
+    (0x40000000, 0x40000),
+    (0x50000000, 0x1000),
+]
+INSTRUCTIONS_TO_SKIP = ["vmsr"]
+# special register accesses unicorn's ARM cpu doesn't have (mrs/msr of
+# PRIMASK, BASEPRI...) or gets wrong (cps sets CPSR.I, not PRIMASK), run by the NVIC
+SYSTEM_INSTRUCTIONS = ["mrs", "msr", "cpsid", "cpsie"]
+# r0-r12, sp, lr, pc by their number in an instruction
+GENERAL_REGISTERS = [UC_ARM_REG_R0, UC_ARM_REG_R1, UC_ARM_REG_R2, UC_ARM_REG_R3, UC_ARM_REG_R4, UC_ARM_REG_R5,
+                     UC_ARM_REG_R6, UC_ARM_REG_R7, UC_ARM_REG_R8, UC_ARM_REG_R9, UC_ARM_REG_R10, UC_ARM_REG_R11,
+                     UC_ARM_REG_R12, UC_ARM_REG_SP, UC_ARM_REG_LR, UC_ARM_REG_PC]
+# sleeping until the next event is a jump in virtual time
+IDLE_INSTRUCTIONS = ["wfi", "wfe"]
+# where the main loop of known images polls its message queue, by sha1 of the
+# file: [(address, register that is 0 when there is nothing to do)]. Reaching
+# one with nothing to do is as good as a wfi
+KNOWN_IDLE_POINTS = {
+    # data/CoriandoloRadio.bin
+    "4fbbb584d5820bc661907d8d4d52dcbc20660f61": [(0x20aa, UC_ARM_REG_R0)],
+}
+# what the bundled firmware expects to receive, see repeat_packet()
+DEFAULT_RX_PACKET = b'\x05\x00\x44\x00\x01\x02'
+# vector table entries whose handlers mean the firmware crashed
+FAULT_HANDLERS = ["hardfault_handler", "mgnmem_handler", "busfault_handler", "usefault_handler"]
+# a poll loop is one iteration from the target of a conditional branch back
+# to that branch, through calls into leaf functions too, that only loads,
+# compares and recomputes registers it does not carry over between iterations.
+# What it pushes it pops again. Without stores it reads the same values until
+# an event or interrupt changes them
+MAX_POLL_INSTRUCTIONS = 24
+POLL_INSTRUCTIONS = {"ldr", "ldrb", "ldrh", "ldrsb", "ldrsh", "cmp", "cmn", "tst", "teq",
+                     "mov", "movs", "mvn", "mvns", "and", "ands", "orr", "orrs", "eor", "eors",
+                     "bic", "bics", "lsl", "lsls", "lsr", "lsrs", "asr", "asrs", "add", "adds",
+                     "sub", "subs", "ubfx", "sbfx", "uxtb", "uxth", "sxtb", "sxth"}
+POLL_BRANCHES = {"beq", "bne", "bhs", "blo", "bcs", "bcc", "bmi", "bpl", "bhi", "bls",
+                 "bge", "blt", "bgt", "ble", "cbz", "cbnz"}
+# the only stores a poll loop may make: tasks that copy the time into a
+# register (TIMERn TASKS_CAPTURE[n]). A loop sampling time waits for it to
+# reach a bound rather than for an event
+POLL_STORES = time_sampling_addresses()
+# latch branches of loops waiting for a bound, compared with cmp right before:
+# mnemonic -> (loops while below the bound, bound included, signed)
+POLL_BOUNDS = {"blo": (True, False, False), "bcc": (True, False, False), "bls": (True, True, False),
+               "blt": (True, False, True), "ble": (True, True, True),
+               "bhi": (False, False, False), "bhs": (False, True, False), "bcs": (False, True, False),
+               "bgt": (False, False, True), "bge": (False, True, True)}
+# what the analysis cache depends on, a cache made with other lists is rebuilt
+ANALYZER_CONFIG = analyzer_config(INSTRUCTIONS_TO_SKIP + IDLE_INSTRUCTIONS + SYSTEM_INSTRUCTIONS, MAX_POLL_INSTRUCTIONS,
+                                  sorted(POLL_INSTRUCTIONS), sorted(POLL_BRANCHES), sorted(POLL_STORES))
+# handled registers closer than this many bytes share one unicorn hook,
+# fewer hooks are cheaper than a few extra dict misses
+MMIO_HOOK_GAP = 0x10
+# writes that get a trace record of their own on top of the MMIO one
+TRACED_WRITES = {
+    0x50000508: tracing.GPIO_OUTSET,
+    0x5000050c: tracing.GPIO_OUTCLR,
+    0x50000808: tracing.GPIO_OUTSET,
+    0x5000080c: tracing.GPIO_OUTCLR,
+    0x40001000: tracing.RADIO_TX,
+}
+
+VECTOR_NAMES = [
+    "initial_sp",
+    "reset_handler",
+    "nmi_handler",
+    "hardfault_handler",
+    "mgnmem_handler",
+    "busfault_handler",
+    "usefault_handler",
+    "reserved1",
+    "reserved2",
+    "reserved3",
+    "reserved4",
+    "svc_handler",
+    "dbgmon_handler",
+    "reserved5",
+    "pendsvc_handler",
+    "systick_handler",
+    "wdtirq_handler",
+    "radioirq_handler",
+]
 
 class VectorTable(OrderedDict):
     def __repr__(self) -> str:
@@ -32,162 +121,806 @@ def get_uc_aligned_size(length):
         return length
     return 1024*(length // 1024) + 1024
 
-def skip_instr(mn, uc, address, size):
-    #print("[!] skipping %s instruction" %mn)
+class BlockHook:
+    # UC_HOOK_BLOCK calling cb(uc, address, size, None) straight from unicorn,
+    # without the wrappers hook_add() puts in front of every call. It runs on
+    # every block, they are most of what a block costs. An exception stops
+    # the emulation and is raised by emu_start() as with hook_add()
+    def __init__(self, uc, cb, begin, end):
+        def block_cb(handle, address, size, user_data):
+            try:
+                cb(uc, address, size, None)
+            except Exception as e:
+                if uc._hook_exception is None:
+                    uc._hook_exception = e
+                uc.emu_stop()
+        # unicorn only holds a pointer, the callback has to stay alive
+        self.callback = unicorn_lib.UC_HOOK_CODE_CB(block_cb)
+        self.handle = unicorn_lib.uc_hook_h()
+        status = unicorn_lib._uc.uc_hook_add(uc._uch, ctypes.byref(self.handle), UC_HOOK_BLOCK, self.callback, None,
+                                             ctypes.c_uint64(begin), ctypes.c_uint64(end))
+        if status != UC_ERR_OK:
+            raise UcError(status)
+
+def skip_instr(uc, address, size, user_data):
+    #print("[!] skipping instruction at 0x%x" %address)
     uc.reg_write(UC_ARM_REG_PC, (address + size) | 1)
 
+def decode_system_instruction(code):
+    # mrs -> ("mrs", SYSm, destination), msr -> ("msr", SYSm, source),
+    # cps -> ("cps", [(SYSm, value)]) from the first 4 bytes at the instruction
+    hw1, hw2 = struct.unpack('<HH', bytes(code))
+    if hw1 & 0xffe8 == 0xb660:
+        value = 1 if hw1 & 0x10 else 0
+        writes = []
+        if hw1 & 2:
+            writes.append((SYSM_PRIMASK, value))
+        if hw1 & 1:
+            writes.append((SYSM_FAULTMASK, value))
+        return ("cps", writes)
+    if hw1 == 0xf3ef:
+        return ("mrs", hw2 & 0xff, GENERAL_REGISTERS[(hw2 >> 8) & 0xf])
+    return ("msr", hw2 & 0xff, GENERAL_REGISTERS[hw1 & 0xf])
+
+def find_instructions(cs, content, base_addr, mnemonics):
+    # thumb instructions are halfword aligned, so decoding one instruction at
+    # every halfword offset finds all candidates without caring about literal
+    # pools or linear sweep desync. Offsets that are never executed are harmless.
+    # Returns {address: mnemonic}
+    addresses = {}
+    for offset in range(0, len(content) - 1, 2):
+        for insr in cs.disasm(content[offset:offset + 4], base_addr + offset, 1):
+            if insr.mnemonic in mnemonics:
+                addresses[insr.address] = insr.mnemonic
+    return addresses
+
 def parse_vector_table(content):
-    vector_table = VectorTable({
-        "initial_sp" : 0,
-        "reset_handler": 0,
-        "nmi_handler": 0,
-        "hardfault_handler": 0,
-        "mgnmem_handler": 0,
-        "busfault_handler": 0,
-        "usefault_handler": 0,
-        "reserved1": 0,
-        "reserved2": 0,
-        "reserved3": 0,
-        "reserved4": 0,
-        "svc_handler": 0,
-        "dbgmon_handler": 0,
-        "reserved5": 0,
-        "pendsvc_handler": 0,
-        "systick_handler": 0,
-        "wdtirq_handler": 0,
-        "radioirq_handler": 0
-    })
-    i = 0
-    for name in vector_table.keys():
-        vector_table[name] = struct.unpack('<I', content[i:i+4])[0]
-        i += 4
+    vector_table = VectorTable()
+    for i, name in enumerate(VECTOR_NAMES):
+        vector_table[name] = struct.unpack('<I', content[i*4:i*4+4])[0]
     return vector_table
 
-def load_registers_from_svd():
-    clist = load_peripherals()
-    for c in clist:
-        instance = c()
-        name = instance.get_name()
-        NRF52840_PERIPHERALS[name] = instance
-        logger.info("[*] instantiated %s peripheral", name)
-    parser = SVDParser.for_xml_file('data/nrf52840.svd')
-    device = parser.get_device()
-    for p in device.peripherals:
-        base_addr = p.base_address
-        for reg in p.registers:
-            addr = base_addr + reg.address_offset
-            NRF52840_REGISTERS[addr] = (reg, p.name)
+def poll_loop(cs, read, insns):
+    # PollLoop if the block insns ends a poll loop, None if not. read(address,
+    # size) gets the code of the blocks and functions one iteration runs through
+    if not insns:
+        return None
+    latch = insns[-1]
+    if latch.mnemonic.split('.')[0] not in POLL_BRANCHES:
+        return None
+    pc = latch.operands[-1].imm
+    # registers that may differ from what they were at the top of the
+    # iteration, and those read before that: both at once and iterations differ
+    clobbered = set()
+    reads = set()
+    # register -> word loaded from a literal pool, store addresses come from them
+    literals = {}
+    # per push [(register, clobbered when pushed)], return addresses of calls
+    frames = []
+    calls = []
+    samples_time = False
+    for count in range(1, MAX_POLL_INSTRUCTIONS + 1):
+        insn = next(cs.disasm(read(pc, 4), pc, 1), None)
+        if insn is None:
+            return None
+        if insn.address == latch.address:
+            break
+        mnemonic = insn.mnemonic.split('.')[0]
+        pc = insn.address + insn.size
+        if mnemonic == "push":
+            regs = [op.reg for op in insn.operands]
+            reads.update(reg for reg in regs if reg not in clobbered)
+            frames.append([(reg, reg in clobbered) for reg in regs])
+        elif mnemonic == "pop":
+            regs = [op.reg for op in insn.operands]
+            if not frames or len(frames[-1]) != len(regs):
+                return None
+            for (pushed, was_clobbered), reg in zip(frames.pop(), regs):
+                literals.pop(reg, None)
+                if reg == UC_ARM_REG_PC:
+                    if pushed != UC_ARM_REG_LR or not calls:
+                        return None
+                    pc = calls.pop()
+                elif reg == pushed and not was_clobbered:
+                    clobbered.discard(reg)
+                else:
+                    clobbered.add(reg)
+        elif mnemonic == "bl":
+            calls.append(pc)
+            clobbered.add(UC_ARM_REG_LR)
+            literals.pop(UC_ARM_REG_LR, None)
+            pc = insn.operands[0].imm
+        elif mnemonic == "bx":
+            if insn.operands[0].reg != UC_ARM_REG_LR or not calls:
+                return None
+            pc = calls.pop()
+        elif mnemonic == "b":
+            pc = insn.operands[0].imm
+        else:
+            read_regs, written = insn.regs_access()
+            if mnemonic in ("str", "strb", "strh"):
+                mem = insn.operands[1].mem
+                if mem.index or insn.writeback or literals.get(mem.base, -1) + mem.disp not in POLL_STORES:
+                    return None
+                samples_time = True
+            elif mnemonic not in POLL_INSTRUCTIONS:
+                return None
+            if UC_ARM_REG_SP in written or UC_ARM_REG_PC in written:
+                return None
+            reads.update(reg for reg in read_regs if reg not in clobbered and reg != UC_ARM_REG_PC)
+            clobbered.update(written)
+            for reg in written:
+                literals.pop(reg, None)
+            if mnemonic == "ldr" and insn.operands[1].mem.base == UC_ARM_REG_PC:
+                literal = ((insn.address + 4) & ~3) + insn.operands[1].mem.disp
+                literals[insn.operands[0].reg] = struct.unpack('<I', read(literal, 4))[0]
+    else:
+        return None
+    if calls or frames:
+        return None
+    reads.update(reg for reg in latch.regs_access()[0] if reg not in clobbered)
+    if reads & clobbered:
+        return None
+    return PollLoop(count, samples_time)
+
+def poll_bound(insns):
+    # (register, bound register or None, bound immediate, POLL_BOUNDS entry)
+    # of a latch block ending in cmp and a branch of POLL_BOUNDS, None otherwise
+    if len(insns) < 2 or insns[-2].mnemonic != "cmp":
+        return None
+    bound = POLL_BOUNDS.get(insns[-1].mnemonic.split('.')[0])
+    from capstone.arm_const import ARM_OP_REG
+    operands = insns[-2].operands
+    if bound is None or len(operands) != 2 or operands[0].reg in (UC_ARM_REG_SP, UC_ARM_REG_PC):
+        return None
+    if operands[1].type == ARM_OP_REG:
+        return (operands[0].reg, operands[1].reg, 0, bound)
+    return (operands[0].reg, None, operands[1].imm, bound)
+
+def to_signed(value):
+    return value - (1 << 32) if value & 0x80000000 else value
+
+def address_ranges(addresses):
+    # sorted word addresses -> (begin, end) ranges of adjacent words, end inclusive
+    ranges = []
+    for address in sorted(addresses):
+        if ranges and address <= ranges[-1][1] + 1 + MMIO_HOOK_GAP:
+            ranges[-1][1] = address + 3
+        else:
+            ranges.append([address, address + 3])
+    return ranges
+
+def create_peripheral(c, clock, nvic):
+    instance = c()
+    instance.clock = clock
+    instance.nvic = nvic
+    logger.info("[*] instantiated %s peripheral", instance.get_name())
+    return instance
+
+def create_peripherals(clock, nvic):
+    # every model at once, returns them by name
+    peripherals = {}
+    for c in load_peripherals():
+        instance = create_peripheral(c, clock, nvic)
+        peripherals[instance.get_name()] = instance
+    return peripherals
+
+
+class PeripheralSet(dict):
+    # name -> peripheral model of one emulator, a model is created the
+    # first time it is looked up. Iterating only sees the ones created so far
+    def __init__(self, create):
+        super().__init__()
+        self.create = create
+
+    def __missing__(self, name):
+        return self.create(name)
 
 
 class Emulator:
-    def __init__(self, fw_path, base_addr) -> None:
+    def __init__(self, fw_path, base_addr, idle_points=None) -> None:
         self.uc = Uc(UC_ARCH_ARM, UC_MODE_LITTLE_ENDIAN)
-        self.cs = Cs(CS_ARCH_ARM, CS_MODE_THUMB | CS_MODE_MCLASS | CS_MODE_LITTLE_ENDIAN)
-        self.cs.detail = True
+        self._cs = None
+        # .bin, ELF or Intel HEX, only a .bin is placed at base_addr
+        image = load_image(fw_path, base_addr)
+        if image.kind != 'bin':
+            base_addr = image.flash_range()[0]
         self.base_addr = base_addr
-        load_registers_from_svd()
-        # setup flash      
-        vector_table = None
-        self.fw_size = None
-        with open(fw_path, 'rb') as fp:
-            content = fp.read()
-            self.fw_size = len(content)
-            self.vector_table = parse_vector_table(content)
-            logger.debug("[*] loaded vector table:\n{%s}", self.vector_table)
-            # map flash memory
-            size = get_uc_aligned_size(len(content))    
-            self.uc.mem_map(base_addr, size)
-            self.uc.mem_write(base_addr, content)
-
-        # setup SRAM and map peripherals
-        self.uc.mem_map(RAM_START_ADDRESS, RAM_SIZE)
-        self.uc.mem_map(0xf0000000, 0x1000)
-        self.uc.mem_map(0xe0000000, 0x10000)
-        self.uc.mem_map(0x10000000, 0x10000)
-        self.uc.mem_map(0x40000000, 0x40000)
-        self.uc.mem_map(0x50000000, 0x1000)
+        # functions and objects of the image, empty for .bin
+        self.symbols = image.symbols
+        # all peripheral timing derives from this clock, never from wall time
+        self.clock = VirtualClock()
+        self.nvic = NVIC(self.uc, base_addr)
+        # SHORTS, PPI and interrupts of the events the models publish
+        self.events = EventBus(self.uc, self.task_handler)
+        # models are created on the first access to their MMIO window, or when
+        # something asks for them by name
+        self.peripherals = PeripheralSet(self.create_peripheral)
+        # state of each model right after it was created, for snapshots taken before that
+        self.initial_states = {}
+        # instructions executed so far, counted per translated block
+        self.icount = 0
+        # what fast forwarding poll loops saved, instructions that would have
+        # run in the iterations skipped
+        self.poll_skips = 0
+        self.poll_instructions = 0
+        # hooked MMIO reads so far, a poll iteration causing one has side effects
+        self.mmio_read_count = 0
+        self.poll_read_count = 0
+        # last poll loop block reached and icount then, an iteration went by
+        # without anything else running if it comes around again one
+        # iteration later. poll_sample is (address, value, bound, time) of
+        # the last iteration of a loop sampling time
+        self.poll_address = None
+        self.poll_icount = 0
+        self.poll_sample = None
+        # block address -> poll_bound() of loops sampling time
+        self.poll_bounds = {}
+        # set by stop(), the block hook stops before the next block runs
+        self.stopping = False
+        self.stop_pc = None
+        self.stop_generation = 0
+        # TraceWriter while tracing, block_address is the pc records get
+        # (unicorn only syncs the pc at block granularity in mem hooks)
+        self.trace = None
+        # core.replay.Recording while recording
+        self.recording = None
+        # run_to() stops at the first block boundary with this many instructions executed
+        self.icount_limit = NEVER
+        self.trace_hooks = []
+        self.block_address = 0
+        # block address -> executions while profiling
+        self.profile = None
+        self.profile_hooks = []
+        # addresses of the blocks run in order while recording coverage, the
+        # block hook appends them so coverage costs no hook of its own
+        self.coverage = None
+        # core.sanitizer.Sanitizer while checking RAM accesses
+        self.sanitizer = None
+        # setup SRAM and map peripherals, everything but flash is
+        # backed by host buffers so it can be snapshotted cheaply
+        self.memory = [
+            MemoryRegion(self.uc, RAM_START_ADDRESS, RAM_SIZE),
+            MemoryRegion(self.uc, 0xf0000000, 0x1000),
+            MemoryRegion(self.uc, 0xe0000000, 0x10000),
+            MemoryRegion(self.uc, 0x10000000, 0x10000),
+        ]
+        self.mmio_regions = []
+        for begin, size in MMIO_RANGES:
+            region = MemoryRegion(self.uc, begin, size)
+            self.memory.append(region)
+            self.mmio_regions.append(region)
 
         # special value for EXC_RETURN
-        self.uc.mem_map(0xfffff000, 0x1000)
+        self.memory.append(MemoryRegion(self.uc, 0xfffff000, 0x1000))
+
+        # setup flash, host backed as well so segments are copied into it
+        # straight from the mapped file. It isn't part of snapshots
+        self.fw_size = image.flash_range()[1] - base_addr
+        self.flash = MemoryRegion(self.uc, base_addr, get_uc_aligned_size(self.fw_size))
+        for segment in image.segments:
+            self.load_segment(segment)
+        image.close()
+        content = self.flash.view[:self.fw_size]
+        # disassembly happens once per image, later runs load it from the cache
+        self.analysis = load_analysis(fw_path, content, base_addr, lambda analysis: self.analyze(analysis, bytes(content)),
+                                      ANALYZER_CONFIG)
+        self.vector_table = VectorTable(zip(VECTOR_NAMES, self.analysis.vector_words))
+        logger.debug("[*] loaded vector table:\n{%s}", self.vector_table)
 
         # setup uc hooks
-        self.uc.hook_add(UC_HOOK_CODE, self.uc_code_cb, user_data={'fw_base_addr': base_addr})
-        self.uc.hook_add(UC_HOOK_MEM_READ | UC_HOOK_MEM_WRITE, self.uc_mem_cb)
+        # instructions to skip are located once per image and get a
+        # hook of their own, so no code hook runs on ordinary instructions
+        hooked = self.analysis.hooked
+        # blocks are decoded the first time they run, shared with every
+        # emulator of the same image
+        self.block_icounts = self.analysis.icounts
+        self.poll_blocks = self.analysis.poll_blocks
+        self.skip_addresses = {addr for addr, mnemonic in hooked.items() if mnemonic in INSTRUCTIONS_TO_SKIP}
+        self.idle_addresses = {addr for addr, mnemonic in hooked.items() if mnemonic in IDLE_INSTRUCTIONS}
+        # address -> (special register, general register or None for mrs, value for cps)
+        self.system_instructions = {}
+        logger.debug("[*] found %d instructions to skip", len(self.skip_addresses))
+        for addr in self.skip_addresses:
+            self.uc.hook_add(UC_HOOK_CODE, skip_instr, begin=addr, end=addr)
+        for addr in self.idle_addresses:
+            self.uc.hook_add(UC_HOOK_CODE, self.idle_cb, begin=addr, end=addr)
+        for addr, mnemonic in hooked.items():
+            if mnemonic in SYSTEM_INSTRUCTIONS:
+                self.uc.hook_add(UC_HOOK_CODE, self.system_instr_cb, begin=addr, end=addr)
+        self.breakpoints = {}
+        self.callbacks = {
+            # the firmware has nothing to do until the next event
+            "idle": None
+        }
+        # address -> register, None takes the ones known for the image
+        self.idle_points = {}
+        if idle_points is None:
+            idle_points = KNOWN_IDLE_POINTS.get(image.digest.hex(), [])
+        for address, register in idle_points:
+            self.add_idle_point(address, register)
+        # other useful spots while reversing the firmware:
+        # 0x858 -> r1 holds the device id, 0x84a -> r0 holds the msg ptr
+        # peripheral registers are words of the MMIO windows, only the ones with
+        # side effects get hooks. Everything else is plain memory to unicorn
+        self.mmio_reads = {}
+        self.mmio_writes = {}
+        # name -> hook on the window of a model that doesn't exist yet
+        self.window_hooks = {}
+        for begin, end, name in peripheral_windows():
+            self.window_hooks[name] = self.uc.hook_add(UC_HOOK_MEM_READ | UC_HOOK_MEM_WRITE, self.uc_window_cb,
+                                                       name, begin=begin, end=end - 1)
+        self.uc.hook_add(UC_HOOK_MEM_READ | UC_HOOK_MEM_WRITE, self.nvic.uc_mem_cb, begin=NVIC_ISER, end=NVIC_END)
+        self.uc.hook_add(UC_HOOK_MEM_READ | UC_HOOK_MEM_WRITE, self.nvic.uc_mem_cb, begin=SCB_VTOR, end=SCB_VTOR + 3)
+        self.nvic.add_callback("enter", self.irq_enter_cb)
+        self.nvic.add_callback("exit", self.irq_exit_cb)
         self.uc.hook_add(UC_HOOK_INTR, self.uc_intr_cb)        
+        self.block_hook = BlockHook(self.uc, self.uc_block_cb, base_addr, base_addr + self.fw_size - 1)
         self.uc.hook_add(UC_HOOK_BLOCK, self.uc_mem_block_cb, begin=0xfffff000, end=0xffffffff)
+        # packets the radio receives, created on first use
+        self._scenario = None
    
     
-    def start(self):
-        # subscribe to TASKS_RXEN envet from radio
-        NRF52840_PERIPHERALS['RADIO'].add_callback("rx_en", self.rx_enabled_cb)
-        NRF52840_PERIPHERALS['RADIO'].add_callback("tx_en", self.tx_enabled_cb)
+    @property
+    def scenario(self):
+        # an empty one, it creates the RADIO model
+        if self._scenario is None:
+            self._scenario = RxScenario(self)
+        return self._scenario
+
+    @property
+    def cs(self):
+        # capstone is only needed for static analysis of the firmware
+        if self._cs is None:
+            from capstone import Cs, CS_ARCH_ARM, CS_MODE_THUMB, CS_MODE_MCLASS, CS_MODE_LITTLE_ENDIAN
+            self._cs = Cs(CS_ARCH_ARM, CS_MODE_THUMB | CS_MODE_MCLASS | CS_MODE_LITTLE_ENDIAN)
+            self._cs.detail = True
+        return self._cs
+
+    def analyze(self, analysis, content):
+        analysis.vector_words = list(parse_vector_table(content).values())
+        analysis.hooked = find_instructions(self.cs, content, self.base_addr,
+                                            INSTRUCTIONS_TO_SKIP + IDLE_INSTRUCTIONS + SYSTEM_INSTRUCTIONS)
+
+    def start(self, seconds=20):
+        # run for the given amount of emulated time, however long it takes
+        self.boot()
+        self.run_until(seconds_to_cycles(seconds))
+        logger.info("[*] stopped after %d instructions, %d idle cycles skipped, %d poll loops fast forwarded",
+                    self.icount, self.clock.skipped, self.poll_skips)
+        self.analysis.save()
+
+    def run_until(self, deadline):
+        # run until virtual time reaches deadline, stops at the first block boundary after it
+        if self.clock.time >= deadline:
+            return
+        self.stop_generation += 1
+        self.clock.schedule_at(deadline, self.stop_cb, self.stop_generation)
+        self.resume()
+
+    def run(self, seconds=None, instructions=None, conditions=()):
+        # run from the current state until one of conditions (see core.run) is met
+        # or seconds of virtual time or an instruction budget are used up
+        return HeadlessRun(self, seconds, instructions, conditions).run()
+
+    def run_to(self, icount):
+        # run until icount instructions were executed, stops at the first block
+        # boundary at or after it. Unlike the instruction budget of run() this
+        # adds no clock event, so idle time is skipped exactly as without it
+        self.icount_limit = icount
+        try:
+            self.resume()
+        finally:
+            self.icount_limit = NEVER
+
+    def stop_cb(self, generation):
+        # a run_until() that ended early for another reason leaves a stale stop behind
+        if generation == self.stop_generation:
+            self.stop()
+
+    def boot(self):
         self.uc.reg_write(UC_ARM_REG_MSP, self.vector_table['initial_sp'])
-        self.uc.emu_start(self.vector_table['reset_handler'], self.fw_size + self.base_addr, 20 * UC_SECOND_SCALE , 0)
-        # stop timer0 after UC timed out
-        NRF52840_PERIPHERALS['TIMER0'].stop()
-
-    def uc_code_cb(self, uc, addr, size, user_data):
-        global RADIO_INT_RETURN       
-        code = uc.mem_read(addr, size)
-        lr = uc.reg_read(UC_ARM_REG_LR)
-        for insr in self.cs.disasm(code, addr, 1):
-            #print("0x%08x\t %s %s" %(addr, insr.mnemonic, insr.op_str))
-            pass
-        if insr.mnemonic in INSTRUCTIONS_TO_SKIP:
-            skip_instr(insr.mnemonic, uc, addr, size)
-
-        elif addr == 0x20aa and not RADIO_INT_RETURN:
-            radio = NRF52840_PERIPHERALS['RADIO']
-            radio.get_reg_by_name('EVENTS_END').value = 1
-            packet = b'\x05\x00\x44\x00\x01\x02'
-            radio.set_packet(packet, uc)
-            interrupt_enter(0x11, uc, user_data['fw_base_addr'])
-        elif addr == 0x20aa and RADIO_INT_RETURN:
-            RADIO_INT_RETURN = False
-        
-        elif addr == 0x858:
-            #logger.debug("device id: %x", uc.reg_read(UC_ARM_REG_R1))
-            pass
-        elif addr == 0x84a:
-            ptr = uc.reg_read(UC_ARM_REG_R0)
-            #logger.debug("msgptr: %x", ptr)
-            pass
-        #if addr == 0x178c:
-        #    print("r0=%x r8=%x"%(uc.reg_read(UC_ARM_REG_R0), uc.reg_read(UC_ARM_REG_R8)))       
-     
-    def uc_mem_cb(self, uc, access, address, size, value, user_data):
-        if address in NRF52840_REGISTERS.keys():
-            reg, pname = NRF52840_REGISTERS[address]
-            pc = self.uc.reg_read(UC_ARM_REG_PC)
-            if access == UC_MEM_READ:
-                #logger.debug("read access at %x to %x -> %s register of %s", pc, address, reg.name, pname)
-                pass
-            elif access == UC_MEM_WRITE:
-                #logger.debug("write access at %x to %x value: %x -> %s register of %s", pc, address, value, reg.name, pname)
-                pass
-            if pname in NRF52840_PERIPHERALS.keys():
-                peripheral = NRF52840_PERIPHERALS[pname]
-                if access == UC_MEM_READ:
-                    peripheral.read(uc, address)
-                elif access == UC_MEM_WRITE:
-                    peripheral.write(uc, address, value)       
+        self.uc.reg_write(UC_ARM_REG_PC, self.vector_table['reset_handler'])
+
+    def resume(self, timeout=0, count=0):
+        # continue from the current pc, e.g. after stop() or restore()
+        pc = self.uc.reg_read(UC_ARM_REG_PC)
+        self.stopping = False
+        self.stop_pc = None
+        self.uc.emu_start(pc | 1, self.fw_size + self.base_addr, timeout, count)
+        if self.stop_pc is not None:
+            self.uc.reg_write(UC_ARM_REG_PC, self.stop_pc)
+
+    def stop(self, pc=None):
+        # from a code or block hook pc is where the firmware is, it stops
+        # right there. Elsewhere, e.g. in a memory hook, unicorn's pc is stale
+        # until the block ends, the block hook stops before the next one
+        self.stopping = True
+        if pc is not None:
+            self.stop_pc = pc
+            self.uc.emu_stop()
+
+    def create_peripheral(self, name):
+        peripheral = create_peripheral(load_peripheral(name), self.clock, self.nvic)
+        dict.__setitem__(self.peripherals, name, peripheral)
+        self.events.attach(peripheral)
+        # peripheral registers are words of the MMIO windows, only the ones with
+        # side effects get hooks. Everything else is plain memory to unicorn
+        for region in self.mmio_regions:
+            peripheral.bind(region)
+        reads = peripheral.read_addresses()
+        writes = peripheral.write_addresses()
+        self.mmio_reads.update(dict.fromkeys(reads, peripheral))
+        self.mmio_writes.update(dict.fromkeys(writes, peripheral))
+        for begin, end in address_ranges(reads):
+            self.uc.hook_add(UC_HOOK_MEM_READ, self.uc_mmio_read_cb, begin=begin, end=end)
+        for begin, end in address_ranges(writes):
+            self.uc.hook_add(UC_HOOK_MEM_WRITE, self.uc_mmio_write_cb, begin=begin, end=end)
+        handle = self.window_hooks.pop(name, None)
+        if handle is not None:
+            self.uc.hook_del(handle)
+        if self.trace is not None:
+            # the trace hooks have to stay behind the peripheral ones
+            self.add_trace_hooks()
+        self.initial_states[name] = peripheral.save_state()
+        return peripheral
+
+    def task_handler(self, address):
+        # model handling the task at address. PPI may wire tasks of models
+        # the firmware hasn't touched yet, they get created
+        name = window_name(address)
+        if name in self.window_hooks:
+            self.peripherals[name]
+        return self.mmio_writes.get(address)
+
+    def uc_window_cb(self, uc, access, address, size, value, name):
+        # first access to the window of a model, the hooks added for it
+        # handle this access too
+        if name in self.window_hooks:
+            self.peripherals[name]
+
+    def start_trace(self, path=None, capacity=tracing.DEFAULT_CAPACITY):
+        # without a path the latest records are kept in memory, see TraceWriter.save()
+        self.stop_trace()
+        self.trace = tracing.TraceWriter(path, capacity)
+        self.add_trace_hooks()
+        return self.trace
+
+    def add_trace_hooks(self):
+        # the trace hooks are added last so they see what the peripherals did
+        for handle in self.trace_hooks:
+            self.uc.hook_del(handle)
+        self.trace_hooks = []
+        for begin, size in MMIO_RANGES:
+            self.trace_hooks.append(self.uc.hook_add(UC_HOOK_MEM_READ | UC_HOOK_MEM_WRITE, self.uc_trace_cb,
+                                                     begin=begin, end=begin + size - 1))
+
+    def stop_trace(self):
+        for handle in self.trace_hooks:
+            self.uc.hook_del(handle)
+        self.trace_hooks = []
+        trace, self.trace = self.trace, None
+        if trace is not None:
+            trace.close()
+        return trace
+
+    def start_profile(self):
+        # counts block executions in firmware until stop_profile(), see core.analysis.hot_blocks()
+        self.stop_profile()
+        self.profile = Counter()
+        self.profile_hooks.append(self.uc.hook_add(UC_HOOK_BLOCK, self.uc_profile_cb, begin=self.base_addr,
+                                                   end=self.base_addr + self.fw_size - 1))
+        return self.profile
+
+    def stop_profile(self):
+        for handle in self.profile_hooks:
+            self.uc.hook_del(handle)
+        self.profile_hooks = []
+        profile, self.profile = self.profile, None
+        return profile
+
+    def start_coverage(self):
+        # records the firmware blocks run until stop_coverage(), those the
+        # NVIC interrupted before they ran are recorded once they do
+        self.coverage = []
+        return self.coverage
+
+    def stop_coverage(self):
+        coverage, self.coverage = self.coverage, None
+        return coverage
+
+    def start_sanitizer(self, stack_size=None):
+        # start before boot(), the startup code is what initializes RAM
+        self.stop_sanitizer()
+        self.sanitizer = Sanitizer(self, RAM_START_ADDRESS, RAM_SIZE, stack_size)
+        self.sanitizer.start()
+        return self.sanitizer
+
+    def stop_sanitizer(self):
+        sanitizer, self.sanitizer = self.sanitizer, None
+        if sanitizer is not None:
+            sanitizer.stop()
+        return sanitizer
+
+    def snapshot(self):
+        # take snapshots while emulation is stopped, i.e. between resume() calls
+        return Snapshot(self.uc.context_save(),
+                        {region.begin: region.save() for region in self.memory},
+                        {name: p.save_state() for name, p in self.peripherals.items()},
+                        self.save_state())
+
+    def save_state(self):
+        # python side state of a snapshot that isn't memory or peripherals
+        return {'icount': self.icount, 'clock': self.clock.save_state(),
+                'nvic': self.nvic.save_state(),
+                'scenario': self._scenario.save_state() if self._scenario is not None else None,
+                # poll loop detection looks at the previous iteration
+                'poll': (self.block_address, self.mmio_read_count, self.poll_read_count,
+                         self.poll_address, self.poll_icount, self.poll_sample),
+                'shadow': self.sanitizer.save_state() if self.sanitizer is not None else None}
+
+    def restore(self, snapshot):
+        self.uc.context_restore(snapshot.context)
+        for region in self.memory:
+            region.restore(snapshot.memory[region.begin])
+        for name in snapshot.peripherals:
+            # a snapshot of another emulator may have models this one hasn't created yet
+            self.peripherals[name]
+        for name, p in self.peripherals.items():
+            p.load_state(snapshot.peripherals.get(name, self.initial_states[name]))
+        self.icount = snapshot.state['icount']
+        self.clock.load_state(snapshot.state['clock'])
+        self.nvic.load_state(snapshot.state['nvic'])
+        if snapshot.state['scenario'] is not None:
+            self.scenario.load_state(snapshot.state['scenario'])
+        (self.block_address, self.mmio_read_count, self.poll_read_count,
+         self.poll_address, self.poll_icount, self.poll_sample) = snapshot.state['poll']
+        if self.sanitizer is not None and snapshot.state.get('shadow') is not None:
+            self.sanitizer.load_state(snapshot.state['shadow'])
+        # routes were compiled from the registers before the restore
+        self.events.invalidate()
+
+    def load_segment(self, segment):
+        for region in [self.flash] + self.memory:
+            if region.contains(segment.address):
+                offset = segment.address - region.begin
+                if offset + segment.size > region.size:
+                    break
+                # what's left of segment.size is .bss, zero already
+                region.view[offset:offset + len(segment.data)] = segment.data
+                return
+        logger.warning("[!] segment at 0x%x (%d bytes) is outside of guest memory", segment.address, segment.size)
+
+    def add_breakpoint(self, addr, cb):
+        # cb(uc, addr, size, user_data) runs only when addr is executed,
+        # addr may be a symbol, see core.image.SymbolIndex.address()
+        if isinstance(addr, str):
+            addr = self.symbols.address(addr)
+        handle = self.uc.hook_add(UC_HOOK_CODE, cb, begin=addr, end=addr)
+        self.breakpoints.setdefault(addr, []).append(handle)
+        return handle
+
+    def add_idle_point(self, addr, register):
+        # reaching addr with register 0 means the firmware has nothing to do
+        # until the next event, addr may be a symbol
+        if isinstance(addr, str):
+            addr = self.symbols.address(addr)
+        self.idle_points[addr] = register
+        return self.add_breakpoint(addr, self.idle_point_cb)
+
+    def remove_breakpoint(self, addr):
+        if isinstance(addr, str):
+            addr = self.symbols.address(addr)
+        for handle in self.breakpoints.pop(addr, []):
+            self.uc.hook_del(handle)
+
+    def add_callback(self, name, cb):
+        self.callbacks[name] = cb
+
+    def inject_rx_packet(self, packet, crc_ok=True, rxmatch=0):
+        # the radio receives packet now, whatever it is doing
+        radio = self.peripherals['RADIO']
+        if self.trace is not None:
+            self.trace.payload(tracing.RADIO_RX, self.block_address, self.clock.time,
+                               radio.get_reg_by_name('FREQUENCY').value, packet)
+        if self.recording is not None:
+            self.recording.rx(self.icount, self.block_address, radio.get_reg_by_name('FREQUENCY').value, packet)
+        radio.receive(self.uc, packet, crc_ok, rxmatch)
+
+    def inject_rx_air(self, air):
+        # the radio receives the bytes on air (core.packet.Frame.air of the sender) now,
+        # returns the decoded Frame, None if they aren't sent to an address it listens on
+        radio = self.peripherals['RADIO']
+        frame = radio.receive_air(self.uc, air)
+        if frame is not None and self.trace is not None:
+            self.trace.payload(tracing.RADIO_RX, self.block_address, self.clock.time,
+                               radio.get_reg_by_name('FREQUENCY').value, frame.packet)
+        if frame is not None and self.recording is not None:
+            self.recording.rx(self.icount, self.block_address, radio.get_reg_by_name('FREQUENCY').value, frame.packet)
+        return frame
+
+    def uc_mmio_read_cb(self, uc, access, address, size, value, user_data):
+        peripheral = self.mmio_reads.get(address)
+        if peripheral is not None:
+            self.mmio_read_count += 1
+            peripheral.read(uc, address)
+            if self.recording is not None:
+                self.recording.mmio_read(self.icount, self.block_address, address, self.read_mmio(address, size))
+
+    def uc_mmio_write_cb(self, uc, access, address, size, value, user_data):
+        peripheral = self.mmio_writes.get(address)
+        if peripheral is not None:
+            if value != 1 and address in peripheral.task_addresses:
+                return
+            peripheral.write(uc, address, value)
+
+    def uc_trace_cb(self, uc, access, address, size, value, user_data):
+        trace = self.trace
+        self.analysis.add_mmio_site(self.block_address, address)
+        if access == UC_MEM_READ:
+            trace.record(tracing.MMIO_READ, self.block_address, self.clock.time, address,
+                         self.read_mmio(address, size), size)
+        elif access == UC_MEM_WRITE:
+            trace.record(tracing.MMIO_WRITE, self.block_address, self.clock.time, address, value, size)
+            kind = TRACED_WRITES.get(address)
+            if kind == tracing.RADIO_TX:
+                if value != 1:
+                    return
+                radio = self.peripherals['RADIO']
+                trace.payload(kind, self.block_address, self.clock.time,
+                              radio.get_reg_by_name('FREQUENCY').value, radio.last_tx_packet or b'')
+            elif kind is not None:
+                trace.record(kind, self.block_address, self.clock.time, address, value)
+
+    def read_mmio(self, address, size):
+        # value the firmware is about to load, as left by the peripheral
+        for region in self.mmio_regions:
+            if region.contains(address):
+                return int.from_bytes(region.data[address - region.begin:address - region.begin + size], 'little')
+        return 0
     
-    def uc_intr_cb(self, uc, exc_no):
-        print("exception %d raised" %exc_no)
+    def uc_profile_cb(self, uc, address, size, user_data):
+        self.profile[address] += 1
+
+    def uc_intr_cb(self, uc, exc_no, user_data):
+        logger.debug("[*] exception %d raised", exc_no)
+
+    def uc_block_cb(self, uc, address, size, user_data):
+        if self.stopping or self.icount >= self.icount_limit:
+            # see stop() and run_to(), nothing of this block has run or been counted
+            self.stop(address)
+            return
+        n = self.block_icounts.get(address)
+        if n is None:
+            insns = list(self.cs.disasm(bytes(uc.mem_read(address, size)), address))
+            self.analysis.add_block(address, size, insns,
+                                    poll_loop(self.cs, lambda pc, size: bytes(uc.mem_read(pc, size)), insns))
+            n = len(insns)
+        clock = self.clock
+        poll = self.poll_blocks.get(address)
+        if poll is not None:
+            if address == self.poll_address and self.icount - self.poll_icount == poll.instructions:
+                self.fast_forward(address, poll)
+            self.poll_address = address
+            self.poll_icount = self.icount
+            self.poll_read_count = self.mmio_read_count
+        self.block_address = address
+        # events due by now are handled before the block runs
+        if clock.time >= clock.next_deadline:
+            clock.run_due()
+            if self.stopping:
+                # pc is not synced at block entry, resume() fixes it up
+                self.stop(address)
+                return
+        if self.nvic.ready and self.nvic.dispatch(address):
+            return
+        if self.coverage is not None:
+            self.coverage.append(address)
+        self.icount += n
+        clock.time += n
+
+    def fast_forward(self, address, poll):
+        # a poll loop went around once more without side effects, it keeps
+        # spinning until the next event, so jump there
+        clock = self.clock
+        if self.mmio_read_count != self.poll_read_count or self.nvic.ready:
+            return
+        n = poll.instructions
+        if poll.samples_time:
+            skipped = self.skip_iterations(address, n)
+            if not skipped:
+                return
+        else:
+            if clock.next_deadline == NEVER:
+                return
+            skipped = (clock.next_deadline - clock.time) // n * n
+            clock.skip_to_next_event()
+        # like idle time the jump is skipped cycles, icount stays what ran,
+        # so budgets and replay positions don't leap with it
+        self.poll_instructions += skipped
+        self.poll_skips += 1
+
+    def skip_iterations(self, address, n):
+        # a loop sampling time waits for a register to pass a bound instead,
+        # how far it moved since the last iteration says how many more
+        # iterations can't get there. The step is rounded down to whole timer
+        # ticks, so only half of those are skipped, never past the next event,
+        # and it takes a few jumps to get close. Returns the instructions skipped
+        clock = self.clock
+        if address not in self.poll_bounds:
+            insns = list(self.cs.disasm(bytes(self.uc.mem_read(address, self.analysis.sizes[address])), address))
+            self.poll_bounds[address] = poll_bound(insns)
+        bound = self.poll_bounds[address]
+        if bound is None:
+            return 0
+        register, bound_register, value, (below, inclusive, signed) = bound
+        current = self.uc.reg_read(register)
+        if bound_register is not None:
+            value = self.uc.reg_read(bound_register)
+        last = self.poll_sample
+        self.poll_sample = (address, current, value, clock.time)
+        if last is None or last[0] != address or last[2] != value:
+            return 0
+        step = to_signed((current - last[1]) & 0xffffffff)
+        period = clock.time - last[3]
+        if signed:
+            current, value = to_signed(current), to_signed(value)
+        remaining = value - current if below else current - value
+        if not below:
+            step = -step
+        if inclusive:
+            remaining += 1
+        # a step of at least 2 is off by less than half
+        if step < 2 or period <= 0 or remaining <= 0:
+            return 0
+        iterations = min((remaining - 1) // step // 2, (clock.next_deadline - clock.time) // period)
+        if iterations <= 0:
+            return 0
+        clock.skip_polling(iterations * period)
+        # the next sample comes after the jump
+        self.poll_sample = None
+        return iterations * n
+
+    def idle_cb(self, uc, address, size, user_data):
+        self.idle()
+
+    def system_instr_cb(self, uc, address, size, user_data):
+        decoded = self.system_instructions.get(address)
+        if decoded is None:
+            decoded = self.system_instructions[address] = decode_system_instruction(uc.mem_read(address, 4))
+        if decoded[0] == "cps":
+            for sysm, value in decoded[1]:
+                self.nvic.write_special(sysm, value)
+            uc.reg_write(UC_ARM_REG_PC, (address + 2) | 1)
+            return
+        kind, sysm, register = decoded
+        if kind == "mrs":
+            uc.reg_write(register, self.nvic.read_special(sysm))
+        else:
+            self.nvic.write_special(sysm, uc.reg_read(register))
+        uc.reg_write(UC_ARM_REG_PC, (address + 4) | 1)
+
+    def idle_point_cb(self, uc, address, size, user_data):
+        if uc.reg_read(self.idle_points[address]) == 0:
+            self.idle()
+
+    def idle(self):
+        self.clock.skip_to_next_event()
+        cb = self.callbacks["idle"]
+        if cb != None:
+            cb()
 
     def uc_mem_block_cb(self, uc, address, size, data):
-        global RADIO_INT_RETURN       
-        irq_num = uc.reg_read(UC_ARM_REG_IPSR)
-        if irq_num == 17:
-            RADIO_INT_RETURN = True
-        interrupt_return(uc)
-
-    def rx_enabled_cb(self):
-        global RADIO_RX_ENABLED
-        logger.debug("rx enabled cb called")
-        RADIO_RX_ENABLED = True
-    
-    def tx_enabled_cb(self):
-        global RADIO_TX_ENABLED
-        logger.debug("tx enabled cb called")
-        RADIO_TX_ENABLED = True
\ No newline at end of file
+        # the handler branched to EXC_RETURN
+        self.nvic.exception_return(address | 1)
+
+    def irq_enter_cb(self, irq):
+        if self.trace is not None:
+            self.trace.record(tracing.IRQ_ENTER, self.block_address, self.clock.time, 0, irq)
+        if self.recording is not None:
+            self.recording.irq_enter(self.icount, self.block_address, irq)
+
+    def irq_exit_cb(self, irq):
+        self.events.interrupt_exit(irq)
+        if self.trace is not None:
+            self.trace.record(tracing.IRQ_EXIT, self.block_address, self.clock.time, 0, irq)
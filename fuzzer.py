@@ -0,0 +1,253 @@
+import argparse
+import hashlib
+import json
+import logging
+import os
+import random
+import time
+from array import array
+
+from emulator import Emulator, DEFAULT_RX_PACKET, FAULT_HANDLERS, DEFAULT_FIRMWARE
+from core import run
+from core.run import CpuException, Fault, RxWaiting, SanitizerReport
+from core.scenario import rx_packets
+from core.logger import logger
+
+MAP_SIZE = 1 << 16
+# instructions one input may execute before it counts as a hang
+DEFAULT_BUDGET = 500000
+DEFAULT_MAX_SIZE = 64
+STATS_INTERVAL = 2.0
+# edges of this many distinct paths are remembered, then forgotten all at once
+PATH_CACHE_SIZE = 4096
+INTERESTING_BYTES = [0x00, 0x01, 0x02, 0x03, 0x04, 0x05, 0x7f, 0x80, 0xfe, 0xff]
+
+
+def edges(blocks):
+    # AFL style edge ids of the blocks an input ran, in the order they ran
+    found = set()
+    prev_loc = 0
+    for address in blocks:
+        cur_loc = (address ^ (address >> 16)) & (MAP_SIZE - 1)
+        found.add(cur_loc ^ prev_loc)
+        prev_loc = cur_loc >> 1
+    return found
+
+def mutate(data, rng, corpus, max_size):
+    data = bytearray(data)
+    for _ in range(1 << rng.randint(0, 4)):
+        op = rng.randint(0, 7)
+        if op == 0 and data:
+            pos = rng.randrange(len(data) * 8)
+            data[pos >> 3] ^= 1 << (pos & 7)
+        elif op == 1 and data:
+            data[rng.randrange(len(data))] = rng.randrange(256)
+        elif op == 2 and data:
+            data[rng.randrange(len(data))] = rng.choice(INTERESTING_BYTES)
+        elif op == 3 and data:
+            pos = rng.randrange(len(data))
+            data[pos] = (data[pos] + rng.randint(-16, 16)) & 0xff
+        elif op == 4 and len(data) < max_size:
+            pos = rng.randint(0, len(data))
+            data[pos:pos] = bytes([rng.randrange(256)]) * rng.randint(1, 4)
+        elif op == 5 and len(data) > 1:
+            pos = rng.randrange(len(data))
+            del data[pos:pos + rng.randint(1, 4)]
+        elif op == 6 and len(corpus) > 1:
+            other = rng.choice(corpus)
+            pos = rng.randint(0, min(len(data), len(other)))
+            data[pos:] = other[pos:]
+        elif op == 7 and data:
+            # keep the length field consistent with the payload
+            data[0] = (len(data) - 1) & 0xff
+    if not data:
+        data.append(0)
+    return bytes(data[:max_size])
+
+
+class Fuzzer:
+    def __init__(self, fw_path, base_addr, output_dir, budget=DEFAULT_BUDGET, max_size=DEFAULT_MAX_SIZE, seed=None,
+                 sanitize=False):
+        self.emu = Emulator(fw_path, base_addr)
+        self.output_dir = output_dir
+        self.budget = budget
+        self.max_size = max_size
+        self.rng = random.Random(seed)
+        for name in ["queue", "crashes", "hangs"]:
+            os.makedirs(os.path.join(output_dir, name), exist_ok=True)
+
+        self.corpus = []
+        self.virgin_edges = set()
+        self.crash_sites = set()
+        self.execs = 0
+        self.crashes = 0
+        self.hangs = 0
+        self.start_time = None
+        self.last_new_edge = None
+        self.last_stats = 0
+
+        self.cur_edges = set()
+        self.pc = None
+        # path digest -> its edges, most inputs take a path seen before and
+        # working out the edges costs more than hashing the path
+        self.paths = {}
+
+        # the input is the only packet the radio gets, it has been handled once
+        # the radio listens again
+        self.emu.scenario.load(())
+        self.conditions = [RxWaiting(), Fault(FAULT_HANDLERS), CpuException()]
+        # the shadow memory is part of the snapshot, every input starts from the booted state
+        self.sanitizer = self.emu.start_sanitizer() if sanitize else None
+        self.snapshot = None
+
+    def boot(self):
+        # run from reset until the radio first listens and fork every input from there
+        self.emu.boot()
+        self.emu.run(conditions=[RxWaiting()])
+        self.snapshot = self.emu.snapshot()
+        # whatever boot itself trips over isn't the input's doing
+        if self.sanitizer is not None:
+            self.conditions.append(SanitizerReport())
+
+    def exit_reason(self, result):
+        if result.reason == RxWaiting.name:
+            return "done"
+        if result.reason == run.INSTRUCTIONS:
+            return "hang"
+        if result.reason == Fault.name:
+            return "fault handler 0x%x" % result.condition.address
+        if result.reason == CpuException.name:
+            return "exception %d" % result.condition.exc_no
+        if result.reason == SanitizerReport.name:
+            return "sanitizer %s" % result.condition.report.kind
+        if result.reason == run.ERROR:
+            return "uc error: %s" % result.error
+        return result.reason
+
+    def run_one(self, data):
+        emu = self.emu
+        emu.restore(self.snapshot)
+        emu.scenario.load(rx_packets([data]))
+        # coverage is recorded by the emulator's block hook, edges are worked out afterwards
+        blocks = emu.start_coverage()
+        try:
+            result = emu.run(instructions=self.budget, conditions=self.conditions)
+        finally:
+            emu.stop_coverage()
+        path = hashlib.blake2b(array('I', blocks), digest_size=16).digest()
+        self.cur_edges = self.paths.get(path)
+        if self.cur_edges is None:
+            if len(self.paths) >= PATH_CACHE_SIZE:
+                self.paths.clear()
+            self.cur_edges = self.paths[path] = edges(blocks)
+        self.pc = result.pc
+        self.execs += 1
+        return self.exit_reason(result)
+
+    def save_input(self, kind, data, tag=""):
+        name = "id_%06d_%s%s" % (self.execs, hashlib.sha1(data).hexdigest()[:8], tag)
+        with open(os.path.join(self.output_dir, kind, name), 'wb') as fp:
+            fp.write(data)
+
+    def process(self, data):
+        reason = self.run_one(data)
+        new_edges = self.cur_edges - self.virgin_edges
+        if reason == "hang":
+            if new_edges:
+                self.hangs += 1
+                self.save_input("hangs", data)
+        elif reason != "done":
+            pc = self.pc
+            if (reason, pc) not in self.crash_sites:
+                self.crash_sites.add((reason, pc))
+                self.crashes += 1
+                self.save_input("crashes", data, "_pc_%x" % pc)
+                logger.warning("[!] crash at pc=0x%x (%s) input=%s", pc, reason, data.hex())
+        if new_edges:
+            self.virgin_edges |= new_edges
+            self.last_new_edge = time.time()
+            if reason == "done":
+                self.corpus.append(data)
+                self.save_input("queue", data)
+        return reason
+
+    def load_seeds(self, seed_dir):
+        seeds = []
+        if seed_dir is not None:
+            for filename in sorted(os.listdir(seed_dir)):
+                with open(os.path.join(seed_dir, filename), 'rb') as fp:
+                    seeds.append(fp.read()[:self.max_size])
+        # resume from an earlier campaign in the same output directory
+        queue_dir = os.path.join(self.output_dir, "queue")
+        for filename in sorted(os.listdir(queue_dir)):
+            with open(os.path.join(queue_dir, filename), 'rb') as fp:
+                seeds.append(fp.read())
+        if not seeds:
+            seeds.append(DEFAULT_RX_PACKET)
+        for data in seeds:
+            self.process(data)
+        # seeds that found nothing new are kept, there has to be something to mutate
+        if not self.corpus:
+            self.corpus.extend(seeds)
+
+    def stats(self):
+        elapsed = time.time() - self.start_time
+        return {
+            "execs": self.execs,
+            "execs_per_sec": self.execs / elapsed if elapsed > 0 else 0.0,
+            "edges": len(self.virgin_edges),
+            "corpus": len(self.corpus),
+            "crashes": self.crashes,
+            "hangs": self.hangs,
+            "elapsed": elapsed,
+            "last_new_edge": self.last_new_edge - self.start_time if self.last_new_edge else None,
+        }
+
+    def report(self):
+        stats = self.stats()
+        print("[*] execs: %d (%.0f/s) edges: %d corpus: %d crashes: %d hangs: %d" %(
+              stats["execs"], stats["execs_per_sec"], stats["edges"], stats["corpus"],
+              stats["crashes"], stats["hangs"]))
+        with open(os.path.join(self.output_dir, "fuzzer_stats"), 'w') as fp:
+            json.dump(stats, fp, indent=2)
+        # coverage growth over time
+        with open(os.path.join(self.output_dir, "plot_data"), 'a') as fp:
+            fp.write("%.3f,%d,%d,%d\n" % (stats["elapsed"], stats["execs"], stats["edges"], stats["corpus"]))
+
+    def fuzz(self, seed_dir=None, max_execs=None, max_time=None):
+        if self.snapshot is None:
+            self.boot()
+        self.start_time = time.time()
+        self.load_seeds(seed_dir)
+        try:
+            while max_execs is None or self.execs < max_execs:
+                now = time.time()
+                if max_time is not None and now - self.start_time >= max_time:
+                    break
+                if now - self.last_stats >= STATS_INTERVAL:
+                    self.last_stats = now
+                    self.report()
+                self.process(mutate(self.rng.choice(self.corpus), self.rng, self.corpus, self.max_size))
+        finally:
+            self.report()
+            self.emu.analysis.save()
+        return self.stats()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="coverage guided fuzzing of the radio rx path")
+    parser.add_argument('-o', '--output', required=True, help="output directory (queue, crashes, hangs, stats)")
+    parser.add_argument('-i', '--input', help="directory with seed packets")
+    parser.add_argument('-f', '--firmware', default=DEFAULT_FIRMWARE)
+    parser.add_argument('-b', '--base', type=lambda x: int(x, 0), default=0x0)
+    parser.add_argument('-n', '--execs', type=int, help="stop after this many executions")
+    parser.add_argument('-t', '--time', type=float, help="stop after this many seconds")
+    parser.add_argument('--budget', type=int, default=DEFAULT_BUDGET, help="instructions per input")
+    parser.add_argument('--max-size', type=int, default=DEFAULT_MAX_SIZE)
+    parser.add_argument('--seed', type=int)
+    parser.add_argument('--sanitize', action='store_true', help="uninitialized reads, stack overflow and radio DMA out of bounds are crashes")
+    args = parser.parse_args()
+
+    logger.setLevel(logging.WARNING)
+    fuzzer = Fuzzer(args.firmware, args.base, args.output, args.budget, args.max_size, args.seed, args.sanitize)
+    fuzzer.fuzz(args.input, args.execs, args.time)
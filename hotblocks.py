@@ -0,0 +1,73 @@
+import argparse
+import logging
+
+from emulator import Emulator, DEFAULT_FIRMWARE, DEFAULT_RX_PACKET
+from core.analysis import hot_blocks, hot_functions
+from core.logger import logger
+from core import trace as tracing
+from core.svd import load_register_map
+from core.scenario import read_scenario, repeat_packet
+
+DEFAULT_TOP = 20
+
+
+def import_trace(analysis, path):
+    # MMIO access sites of a recorded trace, by the block they happened in
+    for record in tracing.read_trace(path):
+        if record.type in (tracing.MMIO_READ, tracing.MMIO_WRITE):
+            analysis.add_mmio_site(record.pc, record.address)
+
+def print_report(emu, counts, top, disasm):
+    analysis = emu.analysis
+    total = sum(n * analysis.icounts.get(address, 0) for address, n in counts.items())
+    print("[*] %d blocks ran, %d instructions" % (len(counts), total))
+    symbols = emu.symbols
+    print("[*] hot functions")
+    for entry, instructions in hot_functions(analysis, counts, top, symbols.functions()):
+        print("    %-24s %12d %5.1f%%" % (symbols.name(entry) if entry is not None else "?", instructions,
+                                          100.0 * instructions / total if total else 0))
+    print("[*] hot blocks")
+    for address, n, instructions in hot_blocks(analysis, counts, top):
+        print("    %-24s %10d runs %12d insns %5.1f%%%s" % (symbols.name(address), n, instructions,
+              100.0 * instructions / total if total else 0, " poll" if address in analysis.poll_blocks else ""))
+        if disasm:
+            for line in analysis.disassembly.get(address, "").splitlines():
+                print("        " + line)
+
+def print_sites(analysis):
+    names = {reg.address: "%s.%s" % (reg.peripheral, reg.name) for reg in load_register_map().registers}
+    print("[*] MMIO access sites")
+    for pc, address in sorted(analysis.mmio_sites):
+        print("    0x%-8x %s (0x%08x)" % (pc, names.get(address, "?"), address))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="profile the firmware by basic block and keep its analysis cache up to date")
+    parser.add_argument('-f', '--firmware', default=DEFAULT_FIRMWARE)
+    parser.add_argument('-b', '--base', type=lambda x: int(x, 0), default=0x0)
+    parser.add_argument('-s', '--seconds', type=float, default=20, help="emulated time to profile, 0 to only print the cache")
+    parser.add_argument('-n', '--top', type=int, default=DEFAULT_TOP)
+    parser.add_argument('-d', '--disasm', action='store_true', help="disassembly of the hot blocks")
+    parser.add_argument('--scenario', help="radio packets from this scenario file")
+    parser.add_argument('--trace', action='append', help="add the MMIO sites of this trace to the cache, can be repeated")
+    parser.add_argument('--sites', action='store_true', help="list the cached MMIO access sites")
+    args = parser.parse_args()
+
+    logger.setLevel(logging.WARNING)
+    emu = Emulator(args.firmware, args.base)
+    for path in args.trace or []:
+        import_trace(emu.analysis, path)
+    if args.seconds > 0:
+        if args.scenario:
+            emu.scenario.load(read_scenario(args.scenario))
+        else:
+            emu.scenario.load(repeat_packet(DEFAULT_RX_PACKET))
+        counts = emu.start_profile()
+        emu.start(args.seconds)
+        emu.stop_profile()
+        print_report(emu, counts, args.top, args.disasm)
+    emu.analysis.save()
+    print("[*] cache: %d blocks, %d hooked instructions, %d MMIO sites" % (
+          len(emu.analysis.icounts), len(emu.analysis.hooked), len(emu.analysis.mmio_sites)))
+    if args.sites:
+        print_sites(emu.analysis)
@@ -1,4 +1,21 @@
-from emulator import Emulator
+import argparse
 
-emu = Emulator('data/CoriandoloRadio.bin', 0x0)
-emu.start()
\ No newline at end of file
+from emulator import Emulator, DEFAULT_FIRMWARE, DEFAULT_RX_PACKET
+from core.scenario import read_scenario, repeat_packet
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="run the bundled firmware for 20 seconds of emulated time")
+    parser.add_argument('scenario', nargs='?', help="radio packets from this scenario file instead of the default stream")
+    parser.add_argument('--trace', help="write a trace of the run to this file, see tracedump.py")
+    args = parser.parse_args()
+
+    emu = Emulator(DEFAULT_FIRMWARE, 0x0)
+    if args.scenario:
+        emu.scenario.load(read_scenario(args.scenario))
+    else:
+        emu.scenario.load(repeat_packet(DEFAULT_RX_PACKET))
+    if args.trace:
+        emu.start_trace(args.trace)
+    emu.start()
+    if args.trace:
+        emu.stop_trace()
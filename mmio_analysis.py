@@ -1,38 +1,128 @@
-from cmsis_svd.parser import SVDParser
-
-def load_mmio_register_addr_list():
-    registers = []
-    with open('data/mmio.txt', 'r') as fp:
-        lines = fp.readlines()
-        count = 0
-        for line in lines:
-            count += 1
-            mmio_addr = int(line.strip(),16)
-            registers.append(mmio_addr)
-        print("read %d lines" %count)
-    return registers
-
-
-addresses = load_mmio_register_addr_list()
-unmatched_addresses = set()
-matched_mmio_registers = {}
-parser = SVDParser.for_xml_file('data/nrf52840.svd')
-device = parser.get_device()
-for addr in addresses:    
-    found = False
-    for p in device.peripherals:
-        max_addr = p.base_address + p.address_block.offset + p.address_block.size
-        if addr >= p.base_address and addr <= max_addr:
-            if p.name not in matched_mmio_registers.keys():
-                matched_mmio_registers[p.name] = []
-            matched_mmio_registers[p.name].append(addr)
-            print("%x -> %s" %(addr, p.name))
-            found = True
-            break
-    if not found:
-        unmatched_addresses.add(addr)
-
-print(matched_mmio_registers.keys())
-print("unamtched addresses:")
-for addr in unmatched_addresses:
-    print("%x" %addr)
\ No newline at end of file
+import argparse
+import gzip
+import os
+from collections import Counter
+
+from core import trace as tracing
+from core.svd import DATA_DIR, AddressIndex, load_register_map, field_values
+
+DEFAULT_INPUT = os.path.join(DATA_DIR, 'mmio.txt')
+DEFAULT_TOP = 20
+# distinct values kept per register field, the rest are only counted
+MAX_FIELD_VALUES = 8
+
+READ = "read"
+WRITE = "write"
+# text logs don't say what the access was
+ACCESS = "access"
+
+
+def read_log(path):
+    # text log, one hex address per line, '.gz' is decompressed on the fly.
+    # Yields (kind, pc, address, value, count), unknown parts are None.
+    # Lines are counted as they are, which is C speed, and parsed once each
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rt') as fp:
+        lines = Counter(fp)
+    for line, count in lines.items():
+        line = line.strip()
+        if line:
+            yield ACCESS, None, int(line, 16), None, count
+
+def read_trace_accesses(path):
+    for record in tracing.read_trace(path):
+        if record.type == tracing.MMIO_READ:
+            yield READ, record.pc, record.address, record.value, 1
+        elif record.type == tracing.MMIO_WRITE:
+            yield WRITE, record.pc, record.address, record.value, 1
+
+def read_accesses(path):
+    with tracing.open_trace(path) as fp:
+        magic = fp.read(len(tracing.MAGIC))
+    if magic == tracing.MAGIC:
+        return read_trace_accesses(path)
+    return read_log(path)
+
+
+class MmioStats:
+    # counts accesses per peripheral, register, pc and field value in one pass.
+    # Memory depends on the distinct addresses and sites, not on the log length
+    def __init__(self, index):
+        self.index = index
+        # address -> (peripheral, register), resolved once per address
+        self.resolved = {}
+        self.total = 0
+        self.peripherals = Counter()
+        self.registers = Counter()
+        self.sites = Counter()
+        # (register address, kind) -> field name -> Counter of values
+        self.fields = {}
+        self.unmatched = Counter()
+
+    def resolve(self, address):
+        found = self.resolved.get(address)
+        if found is None:
+            found = (self.index.peripheral(address), self.index.register(address))
+            self.resolved[address] = found
+        return found
+
+    def add(self, kind, pc, address, value, count=1):
+        self.total += count
+        peripheral, reg = self.resolve(address)
+        if peripheral is None:
+            self.unmatched[address] += count
+            return
+        self.peripherals[peripheral] += count
+        if reg is None:
+            self.registers[(address, kind)] += count
+        else:
+            self.registers[(reg.address, kind)] += count
+            if value is not None:
+                fields = self.fields.setdefault((reg.address, kind), {})
+                for name, field_value in field_values(reg, value):
+                    values = fields.setdefault(name, Counter())
+                    if field_value in values or len(values) < MAX_FIELD_VALUES:
+                        values[field_value] += count
+        if pc is not None:
+            self.sites[(pc, kind, address)] += count
+
+    def register_name(self, address):
+        reg = self.index.register(address)
+        if reg is None:
+            return "%s+0x%x" % (self.index.peripheral(address), address & 0xfff)
+        return "%s.%s" % (reg.peripheral, reg.name)
+
+    def report(self, top):
+        print("[*] %d accesses, %d addresses, %d unmatched" % (self.total, len(self.resolved), sum(self.unmatched.values())))
+        print("[*] peripherals")
+        for name, count in self.peripherals.most_common():
+            print("    %-32s %12d" % (name, count))
+        print("[*] registers")
+        for (address, kind), count in self.registers.most_common(top):
+            print("    %-6s %-40s 0x%08x %12d" % (kind, self.register_name(address), address, count))
+            fields = self.fields.get((address, kind), {})
+            if fields and len(self.index.register(address).fields) > 1:
+                for name, values in sorted(fields.items()):
+                    print("           %-24s %s" % (name, " ".join("%d(%d)" % item for item in values.most_common())))
+        if self.sites:
+            print("[*] access sites")
+            for (pc, kind, address), count in self.sites.most_common(top):
+                print("    pc=0x%05x %-6s %-40s %12d" % (pc, kind, self.register_name(address), count))
+        if self.unmatched:
+            print("[*] unmatched addresses")
+            for address, count in self.unmatched.most_common(top):
+                print("    0x%08x %12d" % (address, count))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="classify MMIO accesses by peripheral, register and field")
+    parser.add_argument('input', nargs='*', default=[DEFAULT_INPUT],
+                        help="address logs (one hex address per line, may be gzipped) or binary traces")
+    parser.add_argument('-n', '--top', type=int, default=DEFAULT_TOP, help="rows per table")
+    args = parser.parse_args()
+
+    stats = MmioStats(AddressIndex(load_register_map()))
+    for path in args.input:
+        for kind, pc, address, value, count in read_accesses(path):
+            stats.add(kind, pc, address, value, count)
+    stats.report(args.top)
@@ -0,0 +1,156 @@
+import argparse
+import logging
+import time
+
+from emulator import Emulator, DEFAULT_FIRMWARE
+from core.logger import logger
+from core.vclock import CPU_FREQUENCY, seconds_to_cycles, cycles_to_us
+
+# nodes run in turns of this many cycles (1 ms), packets sent during a
+# turn reach the other nodes when the turn is over
+DEFAULT_QUANTUM = CPU_FREQUENCY // 1000
+# the bundled firmware listens on 46, 72 and 80
+DEFAULT_FREQUENCY = 46
+
+
+class Node:
+    def __init__(self, name, emu):
+        self.name = name
+        self.emu = emu
+        self.radio = emu.peripherals['RADIO']
+        # idle in the main loop, nothing to run until a packet or timer event
+        self.idle = False
+        self.tx_count = 0
+        self.rx_count = 0
+
+
+class RadioMedium:
+    def __init__(self, quantum=DEFAULT_QUANTUM):
+        self.quantum = quantum
+        self.nodes = []
+        self.time = 0
+        # (sender, frequency, packet, air) put on air during the current turn, air
+        # is what the sender's radio framed (core.packet.Frame.air), None for injected packets
+        self.on_air = []
+        # (time, frequency, packet) sent from outside at a given time
+        self.injected = []
+        self.callbacks = {
+            "tx": None,
+            "rx": None
+        }
+
+    def add_node(self, emu, name=None):
+        node = Node(name or "node%d" % len(self.nodes), emu)
+        # packets come from the medium only
+        emu.scenario.load(())
+        emu.add_callback("idle", lambda: self.idle_cb(node))
+        emu.boot()
+        node.radio.add_callback("tx_en", lambda: self.transmit(node))
+        self.nodes.append(node)
+        return node
+
+    def idle_cb(self, node):
+        # an idle node sleeps until the end of the turn, and for
+        # following turns as long as nothing wakes it up
+        node.idle = True
+
+    def add_callback(self, name, cb):
+        self.callbacks[name] = cb
+
+    def transmit(self, node, packet=None, frequency=None):
+        # called from the sender's MMIO hook, the packet is delivered between turns.
+        # node is None for packets injected from outside
+        air = None
+        if node is not None:
+            frame = node.radio.last_tx_frame
+            packet, frequency, air = frame.packet, frame.frequency, frame.air
+            node.tx_count += 1
+        self.on_air.append((node, frequency, packet, air))
+        cb = self.callbacks["tx"]
+        if cb != None:
+            cb(node, frequency, packet)
+
+    def inject(self, packet, frequency, at=0):
+        self.injected.append((at, frequency, packet))
+        self.injected.sort(key=lambda injected: injected[0])
+
+    def deliver(self):
+        while self.injected and self.injected[0][0] <= self.time:
+            at, frequency, packet = self.injected.pop(0)
+            self.transmit(None, packet, frequency)
+        on_air, self.on_air = self.on_air, []
+        # senders publish END themselves once the frame's airtime is over
+        for sender, frequency, packet, air in on_air:
+            for node in self.nodes:
+                if node is sender or not node.radio.is_listening():
+                    continue
+                if node.radio.get_reg_by_name('FREQUENCY').value != frequency:
+                    continue
+                if air is None:
+                    node.emu.inject_rx_packet(packet)
+                else:
+                    # receivers decode with their own framing, address and CRC settings
+                    frame = node.emu.inject_rx_air(air)
+                    if frame is None:
+                        continue
+                    packet = frame.packet
+                node.rx_count += 1
+                cb = self.callbacks["rx"]
+                if cb != None:
+                    cb(node, frequency, packet)
+
+    def step(self):
+        # one turn: every node catches up to the same point in virtual time
+        self.deliver()
+        self.time += self.quantum
+        for node in self.nodes:
+            clock = node.emu.clock
+            # interrupts raised by the deliveries are taken at the first block
+            if node.idle and not node.emu.nvic.ready and clock.next_deadline > self.time:
+                clock.advance(self.time - clock.time)
+                continue
+            node.idle = False
+            node.emu.run_until(self.time)
+
+    def run(self, cycles):
+        end = self.time + cycles
+        while self.time < end:
+            self.step()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="run several devices sharing one radio channel")
+    parser.add_argument('-f', '--firmware', action='append',
+                        help="firmware of one node, repeat for more nodes. Default: %s" % DEFAULT_FIRMWARE)
+    parser.add_argument('-b', '--base', type=lambda x: int(x, 0), default=0x0)
+    parser.add_argument('-n', '--nodes', type=int, default=2, help="number of nodes when no firmware is given")
+    parser.add_argument('-s', '--seconds', type=float, default=1.0, help="emulated time to run")
+    parser.add_argument('-q', '--quantum', type=int, default=DEFAULT_QUANTUM, help="cycles per turn")
+    parser.add_argument('--inject', help="hex packet sent on air from outside the network")
+    parser.add_argument('--frequency', type=int, default=DEFAULT_FREQUENCY, help="channel of the injected packet")
+    parser.add_argument('--at', type=float, default=6.0, help="seconds into the run to send the injected packet")
+    parser.add_argument('-v', '--verbose', action='store_true', help="log every packet")
+    args = parser.parse_args()
+
+    logger.setLevel(logging.WARNING)
+    firmwares = args.firmware or [DEFAULT_FIRMWARE] * args.nodes
+    medium = RadioMedium(args.quantum)
+    for fw_path in firmwares:
+        medium.add_node(Emulator(fw_path, args.base))
+    if args.verbose:
+        medium.add_callback("tx", lambda node, freq, pkt: print("[%dus] %s tx freq=%d %s" % (
+            cycles_to_us(medium.time), node.name if node else "inject", freq, pkt.hex())))
+    if args.inject:
+        medium.inject(bytes.fromhex(args.inject), args.frequency, seconds_to_cycles(args.at))
+
+    start_time = time.time()
+    medium.run(seconds_to_cycles(args.seconds))
+    elapsed = time.time() - start_time
+    for node in medium.nodes:
+        node.emu.analysis.save()
+    instructions = 0
+    for node in medium.nodes:
+        instructions += node.emu.icount
+        print("[*] %s: %d instructions, tx %d rx %d" % (node.name, node.emu.icount, node.tx_count, node.rx_count))
+    print("[*] %d nodes, %.2fs emulated in %.2fs, %.0f instructions/s" % (
+          len(medium.nodes), args.seconds, elapsed, instructions / elapsed if elapsed > 0 else 0))
@@ -1,32 +1,103 @@
-from core.peripheral import IPeripheral, Register
+from core.peripheral import IPeripheral
 from core.logger import logger
+from core.timeline import PinTimeline
 
-class GPIO(IPeripheral):   
+# PIN_CNF[n].DIR is bit n of DIR
+PIN_CNF_DIR = 1 << 0
+
+class GPIO(IPeripheral):
+    # all 32 pins of a port as bit masks. OUT and DIR are what the firmware
+    # wrote, IN is what it reads back: the driven level of outputs and
+    # whatever set_input() put on the others. Changes are found with a xor
+    # and go to the timelines, stamped with virtual time
+    write_handlers = ["OUT", "DIR", "PIN_CNF*"]
 
     def __init__(self):
-        self.base_address = 0x50000000
-        self.register_list = [
-            Register("OUTSET", self.base_address + 0x508),
-            Register("OUTCLR", self.base_address + 0x50C),
-            Register("PIN_CNF[15]", self.base_address + 0x73C)
-        ]
-        self.populate_maps()
-
-    def read(self, uc, address):
-        val = self.get_reg_val(address)
-        if val != None:
-            uc.mem_write(address, val.to_bytes(4, 'little'))
-    
+        super().__init__()
+        self.callbacks = {
+            "outset": None,
+            "outclr": None,
+            "change": None
+        }
+        self.out = self.get_reg_by_name('OUT')
+        self.dir = self.get_reg_by_name('DIR')
+        self.in_ = self.get_reg_by_name('IN')
+        self.outset = self.get_reg_by_name('OUTSET').address
+        self.outclr = self.get_reg_by_name('OUTCLR').address
+        self.pin_cnf = self.get_reg_by_name('PIN_CNF[0]').address
+        # levels applied to the pins from outside
+        self.inputs = 0
+        self.timelines = {name: PinTimeline(self.get_reg_by_name(name).value) for name in ("OUT", "DIR", "IN")}
+        self.clock = None
+
     def write(self, uc, address, value):
-        self.set_reg_val(address, value)
-        if address == self.get_reg_by_name('OUTSET').address or address == self.get_reg_by_name('OUTCLR').address:
-            pins = []
-            for i in range(0, 32):
-                if value & (1 << i) != 0:
-                    pins.append(i)
-            if address == self.get_reg_by_name('OUTSET').address:
-                logger.info("[*] these gpio pins were set to high: %s", pins)
+        # runs before the store, the new OUT/DIR are worked out here
+        out = self.out.value
+        direction = self.dir.value
+        if address == self.out.address:
+            self.out.value = value
+        elif address == self.dir.address:
+            self.dir.value = value
+        elif address >= self.pin_cnf:
+            pin = (address - self.pin_cnf) // 4
+            if value & PIN_CNF_DIR:
+                self.dir.value |= 1 << pin
             else:
-                logger.info("[*] these gpio pins were cleared: %s", pins)
+                self.dir.value &= ~(1 << pin)
+        else:
+            # OUTSET/OUTCLR/DIRSET/DIRCLR update OUT and DIR in the base class
+            super().write(uc, address, value)
+        if address == self.outset:
+            logger.info("[*] %s pins set to high: 0x%08x", self.get_name(), value)
+            cb = self.callbacks["outset"]
+            if cb != None:
+                cb(value)
+        elif address == self.outclr:
+            logger.info("[*] %s pins cleared: 0x%08x", self.get_name(), value)
+            cb = self.callbacks["outclr"]
+            if cb != None:
+                cb(value)
+        if self.out.value != out or self.dir.value != direction:
+            self.update(out ^ self.out.value)
+
+    def set_input(self, pins, level):
+        # drive the pins in the mask pins from outside, only inputs see it
+        if level:
+            self.inputs |= pins
+        else:
+            self.inputs &= ~pins
+        self.update(0)
+
+    def update(self, changed):
+        # changed: pins whose OUT changed
+        direction = self.dir.value
+        self.in_.value = (self.out.value & direction) | (self.inputs & ~direction)
+        time = self.clock.time
+        self.timelines["OUT"].record(time, self.out.value)
+        self.timelines["DIR"].record(time, direction)
+        self.timelines["IN"].record(time, self.in_.value)
+        if changed:
+            cb = self.callbacks["change"]
+            if cb != None:
+                cb(changed)
+
+    def get_name(self):
+        return "P0"
+
+    def save_state(self):
+        # callbacks belong to whoever set them up, not to the state
+        return (super().save_state(), self.inputs,
+                {name: timeline.save_state() for name, timeline in self.timelines.items()})
+
+    def load_state(self, state):
+        registers, self.inputs, timelines = state
+        super().load_state(registers)
+        for name, timeline in self.timelines.items():
+            timeline.load_state(timelines[name])
+
+    def add_callback(self, name, cb):
+        self.callbacks[name] = cb
+
+class GPIO_P1(GPIO):
     def get_name(self):
-        return "P0"
\ No newline at end of file
+        return "P1"
@@ -0,0 +1,84 @@
+from core.peripheral import IPeripheral, Register, load_svd_peripherals
+
+# channels 0-19 are programmable, 20-31 wired in hardware
+CHANNELS = 32
+PROGRAMMABLE_CHANNELS = 20
+GROUPS = 6
+# the SVD has these registers in clusters, they are laid out by hand:
+# TASKS_CHG[n].EN/DIS, CH[n].EEP/TEP and FORK[n].TEP
+TASKS_CHG_OFFSET = 0x000
+CH_OFFSET = 0x510
+FORK_OFFSET = 0x910
+# (event, task) of channels 20-31 as (peripheral, register) pairs
+FIXED_CHANNELS = [
+    (("TIMER0", "EVENTS_COMPARE[0]"), ("RADIO", "TASKS_TXEN")),
+    (("TIMER0", "EVENTS_COMPARE[0]"), ("RADIO", "TASKS_RXEN")),
+    (("TIMER0", "EVENTS_COMPARE[1]"), ("RADIO", "TASKS_DISABLE")),
+    (("RADIO", "EVENTS_BCMATCH"), ("AAR", "TASKS_START")),
+    (("RADIO", "EVENTS_READY"), ("CCM", "TASKS_KSGEN")),
+    (("RADIO", "EVENTS_ADDRESS"), ("CCM", "TASKS_CRYPT")),
+    (("RADIO", "EVENTS_ADDRESS"), ("TIMER0", "TASKS_CAPTURE[1]")),
+    (("RADIO", "EVENTS_END"), ("TIMER0", "TASKS_CAPTURE[2]")),
+    (("RTC0", "EVENTS_COMPARE[0]"), ("RADIO", "TASKS_TXEN")),
+    (("RTC0", "EVENTS_COMPARE[0]"), ("RADIO", "TASKS_RXEN")),
+    (("RTC0", "EVENTS_COMPARE[0]"), ("TIMER0", "TASKS_CLEAR")),
+    (("RTC0", "EVENTS_COMPARE[0]"), ("TIMER0", "TASKS_START")),
+]
+
+def svd_address(peripheral, name):
+    return next(reg.address for reg in load_svd_peripherals()[peripheral][1] if reg.name == name)
+
+
+class PPI(IPeripheral):
+    write_handlers = ["TASKS_CHG*"]
+    # every register but the groups' tasks is wiring
+    routing_registers = ["CHEN*", "CH[*", "CHG[*", "FORK[*"]
+
+    def __init__(self):
+        super().__init__()
+        for n in range(GROUPS):
+            self.register_list.append(Register('TASKS_CHG[%d].EN' % n, self.base_address + TASKS_CHG_OFFSET + 8 * n))
+            self.register_list.append(Register('TASKS_CHG[%d].DIS' % n, self.base_address + TASKS_CHG_OFFSET + 8 * n + 4))
+        for n in range(CHANNELS):
+            if n < PROGRAMMABLE_CHANNELS:
+                address = self.base_address + CH_OFFSET + 8 * n
+                self.register_list.append(Register('CH[%d].EEP' % n, address))
+                self.register_list.append(Register('CH[%d].TEP' % n, address + 4))
+            else:
+                event, task = FIXED_CHANNELS[n - PROGRAMMABLE_CHANNELS]
+                self.register_list.append(Register('CH[%d].EEP' % n, None, svd_address(*event)))
+                self.register_list.append(Register('CH[%d].TEP' % n, None, svd_address(*task)))
+            self.register_list.append(Register('FORK[%d].TEP' % n, self.base_address + FORK_OFFSET + 4 * n))
+        self.populate_maps()
+        # (EEP, TEP, FORK.TEP) of every channel
+        self.channels = [tuple(self.get_reg_by_name(name % n) for name in ('CH[%d].EEP', 'CH[%d].TEP', 'FORK[%d].TEP'))
+                         for n in range(CHANNELS)]
+        # TASKS_CHG[n].EN/DIS address -> (CHG[n], enable)
+        self.group_tasks = {}
+        for n in range(GROUPS):
+            group = self.get_reg_by_name('CHG[%d]' % n)
+            self.group_tasks[self.get_reg_by_name('TASKS_CHG[%d].EN' % n).address] = (group, True)
+            self.group_tasks[self.get_reg_by_name('TASKS_CHG[%d].DIS' % n).address] = (group, False)
+
+    def write(self, uc, address, value):
+        entry = self.group_tasks.get(address)
+        if entry is not None:
+            group, enable = entry
+            chen = self.get_reg_by_name('CHEN')
+            chen.value = chen.value | group.value if enable else chen.value & ~group.value
+            if self.bus is not None:
+                self.bus.invalidate()
+        else:
+            super().write(uc, address, value)
+
+    def get_name(self):
+        return "PPI"
+
+    def channel_tasks(self, event):
+        # task addresses of the enabled channels whose EEP is event
+        enabled = self.get_reg_by_name('CHEN').value
+        tasks = []
+        for n, (eep, tep, fork) in enumerate(self.channels):
+            if enabled & (1 << n) and eep.value == event:
+                tasks += [register.value for register in (tep, fork) if register.value != 0]
+        return tasks
@@ -1,8 +1,12 @@
-from core.peripheral import IPeripheral, Register
+from core.peripheral import IPeripheral
+from unicorn import UcError
 from unicorn.arm_const import *
 from enum import Enum
+from collections import deque
 
 from core.logger import logger
+from core.packet import FORMAT_REGISTERS, packet_format
+from core.vclock import CPU_FREQUENCY
 
 class RadioState(Enum):
     DISABLED = 0
@@ -15,97 +19,181 @@ class RadioState(Enum):
     TX = 11
     TXDISABLED = 12
 
+# transmitted frames kept until someone reads them
+TX_FRAMES = 1024
+# MODE -> (bits per second, preamble bits), a frame is on air for its
+# preamble and the bytes from the address on. Other modes count as Nrf_1Mbit
+MODE_RATES = {
+    0: (1000000, 8),    # Nrf_1Mbit
+    1: (2000000, 16),   # Nrf_2Mbit
+    3: (1000000, 8),    # Ble_1Mbit
+    4: (2000000, 16),   # Ble_2Mbit
+    15: (250000, 40),   # Ieee802154_250Kbit, preamble and SFD
+}
+
 class Radio(IPeripheral):
- 
+    irq = 1
+
+    write_handlers = ["TASKS_TXEN", "TASKS_RXEN", "TASKS_START", "TASKS_DISABLE"]
+    # CRC of the last received packet, see receive()
+    reset_values = {"CRCSTATUS": 1}
+
     def __init__(self) -> None:
-        self.base_address =  0x40001000
-        self.register_list = [
-            Register("TASKS_TXEN", self.base_address + 0x0),
-            Register("TASKS_RXEN", self.base_address + 0x4),
-            Register("TASKS_START", self.base_address + 0x8),
-            Register("TASKS_STOP", self.base_address + 0xC),
-            Register("TASKS_DISABLE", self.base_address + 0x10),
-            
-            Register("EVENTS_READY", self.base_address + 0x100),
-            Register("EVENTS_ADDRESS", self.base_address + 0x104),
-            Register("EVENTS_PAYLOAD", self.base_address + 0x108),
-            Register("EVENTS_END", self.base_address + 0x10C),
-            Register("EVENTS_DISABLED", self.base_address + 0x110),
-
-            Register("SHORTS", self.base_address + 0x200),
-            Register("INTENSET", self.base_address + 0x304),
-            Register("INTENCLR", self.base_address + 0x308),
-            Register("CRCSTATUS", self.base_address + 0x400, 1),
-
-            Register("PACKETPTR", self.base_address + 0x504),
-            Register("FREQUENCY", self.base_address + 0x508),
-            Register("TXPOWER", self.base_address + 0x50C),
-            Register("MODE", self.base_address + 0x510),
-            Register("PCNF0", self.base_address + 0x514),
-            Register("PCNF1", self.base_address + 0x518),
-            Register("BASE0", self.base_address + 0x51C),
-            Register("BASE1", self.base_address + 0x520),
-            Register("PREFIX0", self.base_address + 0x524),
-            Register("PREFIX1", self.base_address + 0x528),
-            Register("TXADDRESS", self.base_address + 0x52C),
-            Register("RXADDRESS", self.base_address + 0x530),
-            Register("CRCCNF", self.base_address + 0x534),
-            Register("CRCPOLY", self.base_address + 0x538),
-            Register("CRCINIT", self.base_address + 0x53C),
-
-            Register("STATE", self.base_address + 0x550),
-            Register("DATAWHITEIV", self.base_address + 0x554),
-            Register("BCC", self.base_address + 0x560),
-
-            Register("MODECFN0", self.base_address + 0x650),
-            Register("POWER", self.base_address + 0xFFC),
-        ]
-        self.populate_maps()
+        super().__init__()
         self.callbacks = {
             "rx_en": None,
-            "tx_en": None
+            "tx_en": None,
+            # the radio started listening
+            "rx_start": None,
+            # (address, size) of what EasyDMA wrote to or read from RAM
+            "dma_write": None,
+            "dma_read": None
         }
+        self.last_tx_packet = None
+        self.last_tx_frame = None
+        # core.packet.Frame of every transmission, oldest first
+        self.tx_frames = deque(maxlen=TX_FRAMES)
+        self.format_registers = [self.get_reg_by_name(name) for name in FORMAT_REGISTERS]
+        # cycles the frame of the last TXEN is on air, END comes that long after START
+        self.tx_cycles = 0
+        # bumped whenever a scheduled END becomes stale
+        self.generation = 0
+        self.clock = None
 
-    def read(self, uc, address):
-        if address in self.register_address_map.keys():
-            val = self.register_address_map[address].value
-            uc.mem_write(address, val.to_bytes(4, 'little'))
-    
     def write(self, uc, address, value):
-        if address in self.register_address_map.keys():
-            self.register_address_map[address].value = value
         # TASKS_TXEN
         if address == self.register_name_map['TASKS_TXEN'].address:
-            data = uc.mem_read(self.get_pktptr(), 1)
-            # first byte is payload size
-            size = int.from_bytes(data, 'little', signed=False)
-            payload = uc.mem_read(self.get_pktptr(), size + 1)
-            logger.info("radio packet transmit requested by firmware, size: %d payload: %s", size, payload)
+            packet_format = self.packet_format()
+            frame = packet_format.encode(self.read_packet(uc, packet_format), self.get_reg_by_name('TXADDRESS').value & 7,
+                                         self.clock.time, self.get_reg_by_name('FREQUENCY').value)
+            logger.info("radio packet transmit requested by firmware, size: %d payload: %s", frame.length, frame.payload)
+            self.last_tx_packet = frame.packet
+            self.last_tx_frame = frame
+            self.tx_frames.append(frame)
+            self.tx_cycles = self.airtime(frame)
+            self.generation += 1
+            cb = self.callbacks["dma_read"]
+            if cb != None:
+                cb(self.get_pktptr(), len(frame.packet))
+            # ramped up at once, READY_START goes on to TX
+            self.set_state(RadioState.TXIDLE)
+            self.publish('READY')
+            self.publish('TXREADY')
             cb = self.callbacks["tx_en"]
             if cb != None:
                 cb()
         # TASKS_RXEN
-        if address == self.register_name_map['TASKS_RXEN'].address:
+        elif address == self.register_name_map['TASKS_RXEN'].address:
+            self.set_state(RadioState.RXIDLE)
+            self.publish('READY')
+            self.publish('RXREADY')
             cb = self.callbacks["rx_en"]
             if cb != None:
                 cb()
-    
+        elif address == self.register_name_map['TASKS_START'].address:
+            if self.get_reg_by_name('STATE').value == RadioState.RXIDLE.value:
+                self.set_state(RadioState.RX)
+            elif self.get_reg_by_name('STATE').value == RadioState.TXIDLE.value:
+                self.set_state(RadioState.TX)
+                self.clock.schedule(self.tx_cycles, self.tx_end_cb, self.generation)
+        elif address == self.register_name_map['TASKS_DISABLE'].address:
+            self.generation += 1
+            self.set_state(RadioState.DISABLED)
+            self.publish('DISABLED')
+        else:
+            super().write(uc, address, value)
+
     def get_name(self):
         return "RADIO"
+
+    def save_state(self):
+        return (super().save_state(), self.tx_cycles, self.generation)
+
+    def load_state(self, state):
+        registers, self.tx_cycles, self.generation = state
+        super().load_state(registers)
+
+    def airtime(self, frame):
+        bitrate, preamble = MODE_RATES.get(self.get_reg_by_name('MODE').value & 0xf, MODE_RATES[0])
+        return (preamble + 8 * len(frame.air)) * CPU_FREQUENCY // bitrate
+
+    def tx_end_cb(self, generation):
+        # the frame went out, whether or not a medium carries it anywhere
+        if generation == self.generation and self.get_reg_by_name('STATE').value == RadioState.TX.value:
+            self.publish('END')
     
     def add_callback(self, name, cb):
         self.callbacks[name] = cb
 
     def set_state(self, state):
+        listening = self.is_listening()
         self.get_reg_by_name('STATE').value = state.value
+        if not listening and self.is_listening():
+            cb = self.callbacks["rx_start"]
+            if cb != None:
+                cb()
     
+    def is_listening(self):
+        return self.get_reg_by_name('STATE').value in (RadioState.RXIDLE.value, RadioState.RX.value)
+
+    def accepts_address(self, rxmatch):
+        # firmware that never sets RXADDRESSES gets every packet
+        enabled = self.get_reg_by_name('RXADDRESSES').value
+        return enabled == 0 or enabled & (1 << rxmatch) != 0
+
+    def packet_format(self):
+        # core.packet.PacketFormat of the current configuration
+        return packet_format(tuple(register.value for register in self.format_registers))
+
+    def read_packet(self, uc, packet_format):
+        # the packet at PACKETPTR, in one read unless it sits at the very end of RAM
+        try:
+            return bytes(uc.mem_read(self.get_pktptr(), packet_format.ram_size))
+        except UcError:
+            header = uc.mem_read(self.get_pktptr(), packet_format.header_size)
+            size, _ = packet_format.payload_length(packet_format.parse_header(header)[1])
+            return bytes(uc.mem_read(self.get_pktptr(), packet_format.header_size + size))
+
+    def receive(self, uc, pkt, crc_ok=True, rxmatch=0):
+        # pkt is the packet as it ends up in RAM. Packets longer than MAXLEN are cut short and fail the CRC
+        frame = self.packet_format().encode(pkt, rxmatch)
+        self.receive_frame(uc, frame, crc_ok and frame.crc_ok)
+
+    def receive_air(self, uc, air):
+        # bytes on air from the address on, returns the core.packet.Frame
+        # received or None if it isn't sent to one of RXADDRESSES
+        frame = self.packet_format().decode(air, self.get_reg_by_name('RXADDRESSES').value or 0xff)
+        if frame is not None:
+            self.receive_frame(uc, frame, frame.crc_ok)
+        return frame
+
+    def receive_frame(self, uc, frame, crc_ok):
+        self.get_reg_by_name('RXMATCH').value = frame.address
+        self.get_reg_by_name('RXCRC').value = frame.crc
+        self.get_reg_by_name('CRCSTATUS').value = 1 if crc_ok else 0
+        self.set_packet(frame.packet, uc)
+        self.publish('ADDRESS')
+        self.publish('PAYLOAD')
+        self.publish('CRCOK' if crc_ok else 'CRCERROR')
+        self.end_packet(uc)
+
+    def end_packet(self, uc, pkt=None):
+        # the packet on air is done, received pkt is copied to PACKETPTR.
+        # END_DISABLE and the like are SHORTS on the event bus
+        if pkt is not None:
+            self.set_packet(pkt, uc)
+        self.publish('END')
+
     def set_packet(self, pkt, uc):
         addr = self.get_reg_by_name('PACKETPTR').value
         if addr != 0:
+            cb = self.callbacks["dma_write"]
+            if cb != None:
+                cb(addr, len(pkt))
             uc.mem_write(addr, pkt)
             logger.info("copied %d bytes to radio packet ptr at 0x%x", len(pkt), addr)
         else:
-            logger.warn("[!] cannot set radio packet, packetptr is null")
+            logger.warning("[!] cannot set radio packet, packetptr is null")
 
     def get_pktptr(self):
         return self.get_reg_by_name('PACKETPTR').value
@@ -1,24 +1,109 @@
-from core.peripheral import IPeripheral, Register
+from core.peripheral import IPeripheral
+from core.vclock import CPU_FREQUENCY
+
+LFCLK_FREQUENCY = 32768
+COUNTER_MASK = 0xffffff
 
 class RTC1(IPeripheral):
+    irq = 17
+    read_handlers = ["COUNTER", "PRESCALER"]
+    write_handlers = ["TASKS_*", "CC*", "PRESCALER"]
+
     def __init__(self):
-        self.base_address = 0x40011000
-        self.register_list = [
-            Register("TASKS_START", self.base_address + 0x0),
-            Register("TASKS_STOP", self.base_address + 0x4),
-            Register("TASKS_CLEAR", self.base_address + 0x8),            
-        ]
-        self.populate_maps()
-    
+        super().__init__()
+        # COUNTER is derived from virtual time like TIMER0's counter
+        self.counter_base = 0
+        self.start_time = 0
+        self.running = False
+        # one per CC, see Timer_0
+        self.generations = [0] * 4
+        # PRESCALER in effect, writes while running are dropped
+        self.prescaler = 0
+        self.clock = None
+
     def read(self, uc, address):
-        val = self.get_reg_val(address)
-        if val != None:
-            uc.mem_write(address, val.to_bytes(4, 'little'))
+        if address == self.get_reg_by_name('COUNTER').address:
+            self.clock.idle_poll((self.get_name(), 'COUNTER'))
+            self.get_reg_by_name('COUNTER').value = self.get_counter()
+        elif address == self.get_reg_by_name('PRESCALER').address:
+            self.get_reg_by_name('PRESCALER').value = self.prescaler
+        else:
+            super().read(uc, address)
 
     def write(self, uc, address, value):
-        self.set_reg_val(address, value)
+        if address == self.get_reg_by_name('TASKS_START').address:
+            if not self.running:
+                self.running = True
+                self.start_time = self.clock.time
+                self.reschedule()
+        elif address == self.get_reg_by_name('TASKS_STOP').address:
+            if self.running:
+                self.counter_base = self.get_ticks()
+                self.running = False
+                self.reschedule()
+        elif address == self.get_reg_by_name('TASKS_CLEAR').address:
+            self.counter_base = 0
+            self.start_time = self.clock.time
+            self.reschedule()
+        elif address == self.get_reg_by_name('PRESCALER').address:
+            if not self.running:
+                self.prescaler = value & 0xfff
+        elif address >= self.get_reg_by_name('CC[0]').address and address <= self.get_reg_by_name('CC[3]').address:
+            self.set_reg_val(address, value)
+            idx = (address - self.get_reg_by_name('CC[0]').address) // 4
+            self.generations[idx] += 1
+            if self.running:
+                self.schedule_compare(idx)
+        else:
+            super().write(uc, address, value)
 
-    
     def get_name(self):
         return "RTC1"
-    
\ No newline at end of file
+
+    def save_state(self):
+        return (super().save_state(), self.counter_base, self.start_time, self.running, list(self.generations),
+                self.prescaler)
+
+    def load_state(self, state):
+        registers, self.counter_base, self.start_time, self.running, generations, self.prescaler = state
+        self.generations = list(generations)
+        super().load_state(registers)
+
+    def cycles_per_tick(self):
+        # not an integer number of cycles, callers multiply before dividing
+        return CPU_FREQUENCY * (self.prescaler + 1)
+
+    def get_ticks(self):
+        ticks = self.counter_base
+        if self.running:
+            ticks += (self.clock.time - self.start_time) * LFCLK_FREQUENCY // self.cycles_per_tick()
+        return ticks
+
+    def get_counter(self):
+        return self.get_ticks() & COUNTER_MASK
+
+    def reschedule(self):
+        self.generations = [generation + 1 for generation in self.generations]
+        if not self.running:
+            return
+        for idx in range(4):
+            self.schedule_compare(idx)
+
+    def schedule_compare(self, idx):
+        elapsed = (self.clock.time - self.start_time) * LFCLK_FREQUENCY // self.cycles_per_tick()
+        delta = (self.get_reg_by_name('CC[%d]' % idx).value - (self.counter_base + elapsed)) & COUNTER_MASK
+        if delta == 0:
+            delta = COUNTER_MASK + 1
+        # first cycle at which the counter reaches elapsed + delta
+        ticks = elapsed + delta
+        deadline = self.start_time + -(-ticks * self.cycles_per_tick() // LFCLK_FREQUENCY)
+        self.clock.schedule_at(deadline, self.compare_cb, (idx, self.generations[idx]))
+
+    def compare_cb(self, arg):
+        idx, generation = arg
+        if generation != self.generations[idx]:
+            return
+        self.publish('COMPARE[%d]' % idx)
+        # unless SHORTS or PPI restarted the counter and rescheduled everything
+        if generation == self.generations[idx]:
+            self.schedule_compare(idx)
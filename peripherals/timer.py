@@ -1,75 +1,144 @@
-from core.peripheral import IPeripheral, Register
-import time
-import threading
-
+from core.peripheral import IPeripheral
 from core.logger import logger
 
+# counter width selected by BITMODE
+BITMODE_MASKS = [0xffff, 0xff, 0xffffff, 0xffffffff]
+# the timer runs from the 16 MHz peripheral clock divided by 2^PRESCALER
+CYCLES_PER_TICK_0 = 4
+
 class Timer_0(IPeripheral):
+    irq = 8
+
+    write_handlers = ["TASKS_*", "CC*", "MODE", "BITMODE", "PRESCALER"]
 
     def __init__(self):
-        self.base_address =  0x40008000
-        self.register_list = [
-            Register("TASKS_START", self.base_address + 0x0),
-            Register("TASKS_STOP", self.base_address + 0x4),
-            Register("TASKS_CAPTURE[0]", self.base_address + 0x40),
-            Register("TASKS_CAPTURE[5]", self.base_address + 0x54),
-            Register("CC[0]", self.base_address + 0x540),
-            Register("CC[5]", self.base_address + 0x554)
-        ]
+        super().__init__()
         # there are six compare/capture registers
-        self.cc_registers = [0, 0, 0, 0, 0, 0]
-        self.counter = 0
-        self.thread = None
-        self.should_stop = False
-        self.populate_maps()
-
-    def read(self, uc, address):
-        if address >= self.get_reg_by_name('CC[0]').address and address <= self.get_reg_by_name('CC[5]').address:
-            idx = (address - self.get_reg_by_name('CC[0]').address) // 4
-            byte_array = self.cc_registers[idx].to_bytes(4, 'little')
-            uc.mem_write(address, byte_array)
-            #print("CC[%d] = %x" %(idx, self.cc_registers[idx]))
+        self.cc_registers = [self.get_reg_by_name('CC[%d]' % idx) for idx in range(6)]
+        # the counter is derived from virtual time: counter_base ticks were
+        # counted before start_time, the rest follow from the clock
+        self.counter_base = 0
+        self.start_time = 0
+        self.running = False
+        # one per CC, bumped whenever its scheduled compare event becomes stale
+        self.generations = [0] * len(self.cc_registers)
+        self.clock = None
 
     def write(self, uc, address, value):
         if address == self.get_reg_by_name('TASKS_START').address:
             self.start()
         elif address == self.get_reg_by_name('TASKS_STOP').address:
             self.stop()
-        if address >= self.get_reg_by_name('TASKS_CAPTURE[0]').address and address <= self.get_reg_by_name('TASKS_CAPTURE[5]').address:
+        elif address == self.get_reg_by_name('TASKS_COUNT').address:
+            if self.get_reg_by_name('MODE').value != 0:
+                self.count()
+        elif address == self.get_reg_by_name('TASKS_CLEAR').address:
+            self.clear()
+        elif address >= self.get_reg_by_name('TASKS_CAPTURE[0]').address and address <= self.get_reg_by_name('TASKS_CAPTURE[5]').address:
             idx = (address - self.get_reg_by_name('TASKS_CAPTURE[0]').address) // 4
-            self.cc_registers[idx] = self.counter * 1000000
-        
-    
+            # firmware spinning on capture is waiting for time to pass
+            self.clock.idle_poll((self.get_name(), idx))
+            self.capture(idx)
+        elif address >= self.get_reg_by_name('CC[0]').address and address <= self.get_reg_by_name('CC[5]').address:
+            idx = (address - self.get_reg_by_name('CC[0]').address) // 4
+            self.cc_registers[idx].value = value
+            # the other compares keep their deadlines
+            self.generations[idx] += 1
+            if self.running and self.get_reg_by_name('MODE').value == 0:
+                self.schedule_compare(idx)
+        elif address in (self.get_reg_by_name('PRESCALER').address, self.get_reg_by_name('BITMODE').address,
+                         self.get_reg_by_name('MODE').address):
+            # keep the ticks counted so far with the old settings
+            self.counter_base = self.get_ticks()
+            self.start_time = self.clock.time
+            self.set_reg_val(address, value)
+            self.reschedule()
+        else:
+            super().write(uc, address, value)
+
+    def task(self, uc, address):
+        # captures triggered by PPI aren't the firmware polling
+        if address >= self.get_reg_by_name('TASKS_CAPTURE[0]').address and address <= self.get_reg_by_name('TASKS_CAPTURE[5]').address:
+            self.capture((address - self.get_reg_by_name('TASKS_CAPTURE[0]').address) // 4)
+        else:
+            super().task(uc, address)
+
     def get_name(self):
         return "TIMER0"
-    
+
+    def save_state(self):
+        return (super().save_state(), self.counter_base, self.start_time, self.running, list(self.generations))
+
+    def load_state(self, state):
+        registers, self.counter_base, self.start_time, self.running, generations = state
+        self.generations = list(generations)
+        super().load_state(registers)
+
+    def cycles_per_tick(self):
+        return CYCLES_PER_TICK_0 << (self.get_reg_by_name('PRESCALER').value & 0xf)
+
+    def get_ticks(self):
+        ticks = self.counter_base
+        if self.running and self.get_reg_by_name('MODE').value == 0:
+            ticks += (self.clock.time - self.start_time) // self.cycles_per_tick()
+        return ticks
+
+    def get_counter(self):
+        return self.get_ticks() & BITMODE_MASKS[self.get_reg_by_name('BITMODE').value & 3]
+
+    def count(self):
+        # counter mode: a COUNT task is a tick, compares are checked as it happens
+        self.counter_base += 1
+        counter = self.get_counter()
+        for idx, register in enumerate(self.cc_registers):
+            if register.value == counter:
+                self.publish('COMPARE[%d]' % idx)
+
+    def capture(self, idx):
+        self.cc_registers[idx].value = self.get_counter()
+
     def start(self):
-        self.thread = threading.Thread(target=self.timer_thread)
-        self.thread.start()
+        if not self.running:
+            self.running = True
+            self.start_time = self.clock.time
+            self.reschedule()
+            logger.info("%s timer started", self.get_name())
 
     def stop(self):
-        if self.thread != None:
-            self.should_stop = True
-            self.thread.join()
+        if self.running:
+            self.counter_base = self.get_ticks()
+            self.running = False
+            self.reschedule()
         logger.info("%s timer stopped", self.get_name())
 
-    def count(self):
-        self.counter += 1
-    
     def clear(self):
-        self.counter = 0
-
-    def timer_thread(self):
-        timer_resolution = 1
-        logger.info("%s thread started", self.get_name())
-        while not self.should_stop:
-            start_time = time.time()
-            self.tick()
-            elapsed_time = time.time() - start_time
-            remaining_time = timer_resolution - elapsed_time
-            if remaining_time > 0:
-                time.sleep(remaining_time)
-        logger.info("%s thread stopped", self.get_name())
-            
-    def tick(self):
-        self.counter += 1
\ No newline at end of file
+        self.counter_base = 0
+        self.start_time = self.clock.time
+        self.reschedule()
+
+    def reschedule(self):
+        # drop pending compare events and schedule the next one for every CC
+        self.generations = [generation + 1 for generation in self.generations]
+        if not self.running or self.get_reg_by_name('MODE').value != 0:
+            return
+        for idx in range(len(self.cc_registers)):
+            self.schedule_compare(idx)
+
+    def schedule_compare(self, idx):
+        mask = BITMODE_MASKS[self.get_reg_by_name('BITMODE').value & 3]
+        cycles_per_tick = self.cycles_per_tick()
+        elapsed = (self.clock.time - self.start_time) // cycles_per_tick
+        delta = (self.cc_registers[idx].value - (self.counter_base + elapsed)) & mask
+        if delta == 0:
+            delta = mask + 1
+        deadline = self.start_time + (elapsed + delta) * cycles_per_tick
+        self.clock.schedule_at(deadline, self.compare_cb, (idx, self.generations[idx]))
+
+    def compare_cb(self, arg):
+        idx, generation = arg
+        if generation != self.generations[idx]:
+            return
+        self.publish('COMPARE[%d]' % idx)
+        # unless SHORTS or PPI restarted the counter and rescheduled everything
+        if generation == self.generations[idx]:
+            self.schedule_compare(idx)
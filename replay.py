@@ -0,0 +1,94 @@
+import argparse
+import logging
+import time
+from collections import Counter
+
+from unicorn.arm_const import *
+
+from emulator import Emulator, DEFAULT_FIRMWARE, DEFAULT_RX_PACKET
+from core.logger import logger
+from core import trace as tracing
+from core.replay import Recorder, Replayer, load_recording, recording_firmware, DEFAULT_INTERVAL
+from core.scenario import read_scenario, repeat_packet
+from core.svd import load_register_map
+from core.vclock import cycles_to_us
+
+# events printed before each seek target
+DEFAULT_EVENTS = 10
+REGISTERS = [("r0", UC_ARM_REG_R0), ("r1", UC_ARM_REG_R1), ("r2", UC_ARM_REG_R2), ("r3", UC_ARM_REG_R3),
+             ("r4", UC_ARM_REG_R4), ("r5", UC_ARM_REG_R5), ("r6", UC_ARM_REG_R6), ("r7", UC_ARM_REG_R7),
+             ("r12", UC_ARM_REG_R12), ("sp", UC_ARM_REG_SP), ("lr", UC_ARM_REG_LR), ("pc", UC_ARM_REG_PC),
+             ("xpsr", UC_ARM_REG_XPSR)]
+
+
+def format_event(event, recording, names):
+    line = "    %10d pc=0x%05x %-10s" % (event.icount, event.pc, tracing.RECORD_TYPES[event.type])
+    if event.type == tracing.MMIO_READ:
+        line += " %s = 0x%x" % (names.get(event.address, "0x%08x" % event.address), event.value)
+    elif event.type == tracing.IRQ_ENTER:
+        line += " irq %d" % event.value
+    else:
+        line += " freq %d %s" % (event.address, recording.payloads[event.value].hex())
+    return line
+
+def print_summary(recording):
+    last = recording.checkpoints[-1]
+    print("[*] %s at 0x%x: %d instructions, %dus virtual" % (recording.fw_path, recording.base_addr,
+          last.icount, cycles_to_us(last.time)))
+    print("[*] %d checkpoints every %d instructions, %d scenario packets" % (
+          len(recording.checkpoints), recording.interval, len(recording.packets)))
+    for kind, count in sorted(Counter(recording.types).items()):
+        print("    %-10s %8d" % (tracing.RECORD_TYPES[kind], count))
+
+def print_state(emu, recording, target, reached, elapsed, events, names):
+    print("[*] %d (asked %d), %dus virtual, seek took %.3fs" % (reached, target, cycles_to_us(emu.clock.time), elapsed))
+    print("    " + " ".join("%s=%08x" % (name, emu.uc.reg_read(reg)) for name, reg in REGISTERS))
+    if events:
+        for event in list(recording.events(begin=0, end=reached + 1))[-events:]:
+            print(format_event(event, recording, names))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="record a run with checkpoints, then go to any instruction count of it")
+    parser.add_argument('recording', help="recording file")
+    parser.add_argument('--record', action='store_true', help="run the firmware and write the recording first")
+    parser.add_argument('-f', '--firmware', default=DEFAULT_FIRMWARE, help="firmware to record")
+    parser.add_argument('-b', '--base', type=lambda x: int(x, 0), default=0x0)
+    parser.add_argument('-s', '--seconds', type=float, default=20, help="emulated time to record")
+    parser.add_argument('-k', '--interval', type=int, default=DEFAULT_INTERVAL, help="instructions between checkpoints")
+    parser.add_argument('--scenario', help="radio packets from this scenario file")
+    parser.add_argument('--seek', type=int, action='append', help="instruction count to go to, can be repeated")
+    parser.add_argument('--irq', type=int, help="go to every entry of this irq")
+    parser.add_argument('-n', '--events', type=int, default=DEFAULT_EVENTS, help="logged events shown before each stop")
+    args = parser.parse_args()
+
+    logger.setLevel(logging.WARNING)
+    if args.record:
+        emu = Emulator(args.firmware, args.base)
+        if args.scenario:
+            emu.scenario.load(read_scenario(args.scenario))
+        else:
+            emu.scenario.load(repeat_packet(DEFAULT_RX_PACKET))
+        recorder = Recorder(emu, args.firmware, args.interval)
+        recorder.start()
+        emu.boot()
+        start_time = time.time()
+        recorder.run(args.seconds)
+        recording = recorder.stop()
+        emu.analysis.save()
+        recording.save(args.recording)
+        print("[*] recorded in %.2fs" % (time.time() - start_time))
+    # replays run on an emulator of their own, as they would in a later session
+    emu = Emulator(*recording_firmware(args.recording))
+    recording = load_recording(args.recording, emu)
+    print_summary(recording)
+
+    targets = list(args.seek or [])
+    if args.irq is not None:
+        targets += [event.icount for event in recording.events([tracing.IRQ_ENTER]) if event.value == args.irq]
+    names = {reg.address: "%s.%s" % (reg.peripheral, reg.name) for reg in load_register_map().registers}
+    replayer = Replayer(emu, recording)
+    for target in targets:
+        start_time = time.time()
+        reached = replayer.seek(target)
+        print_state(emu, recording, target, reached, time.time() - start_time, args.events, names)
@@ -0,0 +1,37 @@
+import logging
+
+import pytest
+from unicorn.arm_const import UC_ARM_REG_R0, UC_ARM_REG_R1
+
+from core.logger import logger
+from emulator import Emulator, DEFAULT_FIRMWARE, RAM_START_ADDRESS
+
+# str r1, [r0]; ldr r1, [r0]
+STORE = bytes.fromhex('0160')
+LOAD = bytes.fromhex('0168')
+
+
+@pytest.fixture
+def emu():
+    logger.setLevel(logging.WARNING)
+    return Emulator(DEFAULT_FIRMWARE, 0)
+
+@pytest.fixture
+def store(emu):
+    # the firmware writing value at address, hooks and all
+    def store(address, value):
+        emu.uc.mem_write(RAM_START_ADDRESS, STORE)
+        emu.uc.reg_write(UC_ARM_REG_R0, address)
+        emu.uc.reg_write(UC_ARM_REG_R1, value)
+        emu.uc.emu_start(RAM_START_ADDRESS | 1, RAM_START_ADDRESS + len(STORE))
+    return store
+
+@pytest.fixture
+def load(emu):
+    # the firmware reading address
+    def load(address):
+        emu.uc.mem_write(RAM_START_ADDRESS, LOAD)
+        emu.uc.reg_write(UC_ARM_REG_R0, address)
+        emu.uc.emu_start(RAM_START_ADDRESS | 1, RAM_START_ADDRESS + len(LOAD))
+        return emu.uc.reg_read(UC_ARM_REG_R1)
+    return load
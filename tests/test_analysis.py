@@ -0,0 +1,109 @@
+import os
+import struct
+
+import pytest
+from capstone import Cs, CS_ARCH_ARM, CS_MODE_THUMB
+
+from core import analysis as fwan
+from core.analysis import (FirmwareAnalysis, PollLoop, analysis_path, analyzer_config, hot_blocks, hot_functions,
+                           image_digest, load_analysis, read_analysis, write_analysis)
+
+CONTENT = b'\x00' * 64
+CONFIG = analyzer_config(['wfi'], {0x40000000: 'TIMER'})
+# movs r0, #1; bl 0x200 at 0x100
+CALLING = struct.pack('<3H', 0x2001, 0xf000, 0xf87d)
+
+
+@pytest.fixture(autouse=True)
+def cache_dir(tmp_path, monkeypatch):
+    # analyses of the test images stay out of data/.cache, none are shared
+    monkeypatch.setattr(fwan, 'CACHE_DIR', str(tmp_path / 'cache'))
+    monkeypatch.setattr(fwan, 'ANALYSES', {})
+
+def disasm(code, address):
+    cs = Cs(CS_ARCH_ARM, CS_MODE_THUMB)
+    cs.detail = True
+    return list(cs.disasm(code, address))
+
+def analysis():
+    analysis = FirmwareAnalysis('fw', image_digest(CONTENT, 0), 0, CONFIG)
+    analysis.vector_words = [0x20008000, 0x101, 0, 0x301]
+    analysis.hooked = {0x104: 'wfi', 0x108: 'cpsid'}
+    analysis.add_block(0x100, 6, disasm(CALLING, 0x100), None)
+    analysis.add_block(0x200, 2, disasm(b'\xfe\xe7', 0x200), PollLoop(1, False))
+    analysis.add_block(0x300, 2, disasm(b'\xfe\xe7', 0x300), PollLoop(3, True))
+    analysis.add_mmio_site(0x200, 0x40000100)
+    return analysis
+
+def same(a, b):
+    return all(getattr(a, name) == getattr(b, name) for name in
+               ('name', 'digest', 'base_addr', 'config', 'vector_words', 'hooked', 'sizes', 'icounts',
+                'disassembly', 'calls', 'poll_blocks', 'mmio_sites'))
+
+
+def test_add_block():
+    blocks = analysis()
+    assert blocks.icounts[0x100] == 2
+    assert blocks.calls == {0x100: 0x200}
+    assert blocks.disassembly[0x100].splitlines() == ["0x100: movs r0, #1", "0x102: bl #0x200"]
+    assert blocks.dirty
+
+def test_file_round_trip(tmp_path):
+    path = str(tmp_path / 'fw.fwan')
+    original = analysis()
+    write_analysis(path, original)
+    assert same(read_analysis(path, 'fw', original.digest, CONFIG), original)
+    # another image, other analyzer settings, a broken file
+    assert read_analysis(path, 'fw', image_digest(CONTENT, 0x1000), CONFIG) is None
+    assert read_analysis(path, 'fw', original.digest, analyzer_config()) is None
+    with open(path, 'r+b') as fp:
+        fp.truncate(10)
+    assert read_analysis(path, 'fw', original.digest, CONFIG) is None
+
+def test_load_analysis():
+    built = []
+
+    def build(analysis):
+        built.append(analysis)
+        analysis.vector_words = [0x20008000, 0x101]
+    first = load_analysis('/firmware/fw.bin', CONTENT, 0, build, CONFIG)
+    assert built == [first] and not first.dirty
+    assert os.path.exists(analysis_path('fw', first.digest))
+    # emulators of one process share it
+    assert load_analysis('/firmware/fw.bin', CONTENT, 0, build, CONFIG) is first
+    # a later process reads the file
+    fwan.ANALYSES.clear()
+    cached = load_analysis('/firmware/fw.bin', CONTENT, 0, build, CONFIG)
+    assert len(built) == 1 and cached is not first and same(cached, first)
+    # other settings or another base address are analyzed again
+    load_analysis('/firmware/fw.bin', CONTENT, 0, build, analyzer_config())
+    load_analysis('/firmware/fw.bin', CONTENT, 0x1000, build, CONFIG)
+    assert len(built) == 3
+
+def test_save_only_when_dirty():
+    blocks = analysis()
+    path = analysis_path(blocks.name, blocks.digest)
+    blocks.save()
+    assert os.path.exists(path) and not blocks.dirty
+    os.remove(path)
+    blocks.save()
+    assert not os.path.exists(path)
+    # a site already known changes nothing
+    blocks.add_mmio_site(0x200, 0x40000100)
+    assert not blocks.dirty
+    blocks.add_mmio_site(0x300, 0x40000100)
+    blocks.save()
+    assert os.path.exists(path)
+
+def test_hot_blocks_and_functions():
+    blocks = analysis()
+    counts = {0x100: 10, 0x200: 15, 0x300: 1}
+    assert hot_blocks(blocks, counts) == [(0x100, 10, 20), (0x200, 15, 15), (0x300, 1, 1)]
+    assert hot_blocks(blocks, counts, top=1) == [(0x100, 10, 20)]
+    # entry points are the reset handler, the other handler and the bl target
+    assert blocks.functions() == [0x100, 0x200, 0x300]
+    assert blocks.function_of(0x1fe, blocks.functions()) == 0x100
+    assert blocks.function_of(0x80, blocks.functions()) is None
+    assert hot_functions(blocks, counts) == [(0x100, 20), (0x200, 15), (0x300, 1)]
+    # a symbol table puts the blocks in other functions
+    assert hot_functions(blocks, counts, entries=[0x0, 0x280]) == [(0x0, 35), (0x280, 1)]
@@ -0,0 +1,79 @@
+from peripherals.radio import RadioState
+
+RADIO_TASKS_RXEN = 0x40001004
+
+
+def address(emu, peripheral, name):
+    return emu.peripherals[peripheral].get_reg_by_name(name).address
+
+
+def test_intenset_raises_set_event(emu, store):
+    rtc = emu.peripherals['RTC1']
+    rtc.get_reg_by_name('EVENTS_COMPARE[0]').value = 1
+    assert not emu.nvic.pending & (1 << rtc.irq)
+    # COMPARE1 isn't set
+    store(address(emu, 'RTC1', 'INTENSET'), 1 << 17)
+    assert not emu.nvic.pending & (1 << rtc.irq)
+    store(address(emu, 'RTC1', 'INTENSET'), 1 << 16)
+    assert emu.nvic.pending & (1 << rtc.irq)
+
+def test_inten_write_raises_set_event(emu, store):
+    radio = emu.peripherals['RADIO']
+    radio.get_reg_by_name('EVENTS_END').value = 1
+    store(address(emu, 'RADIO', 'INTENSET'), 0)
+    assert not emu.nvic.pending & (1 << radio.irq)
+    store(address(emu, 'RADIO', 'INTENSET'), 1 << 3)
+    assert emu.nvic.pending & (1 << radio.irq)
+
+def test_interrupt_on_publish(emu, store):
+    timer = emu.peripherals['TIMER0']
+    store(address(emu, 'TIMER0', 'INTENSET'), 1 << 17)
+    timer.publish('COMPARE[0]')
+    assert not emu.nvic.pending & (1 << timer.irq)
+    timer.publish('COMPARE[1]')
+    assert emu.nvic.pending & (1 << timer.irq)
+    # the handler left the event set, the line is still up
+    emu.nvic.clear_pending(timer.irq)
+    emu.events.interrupt_exit(timer.irq)
+    assert emu.nvic.pending & (1 << timer.irq)
+
+def test_shorts(emu, store):
+    radio = emu.peripherals['RADIO']
+    # READY_START
+    store(address(emu, 'RADIO', 'SHORTS'), 1)
+    store(address(emu, 'RADIO', 'TASKS_RXEN'), 1)
+    assert radio.get_reg_by_name('STATE').value == RadioState.RX.value
+    # routes follow SHORTS writes
+    store(address(emu, 'RADIO', 'TASKS_DISABLE'), 1)
+    store(address(emu, 'RADIO', 'SHORTS'), 0)
+    store(address(emu, 'RADIO', 'TASKS_RXEN'), 1)
+    assert radio.get_reg_by_name('STATE').value == RadioState.RXIDLE.value
+
+def test_ppi_channel(emu, store):
+    timer = emu.peripherals['TIMER0']
+    store(address(emu, 'PPI', 'CH[0].EEP'), address(emu, 'TIMER0', 'EVENTS_COMPARE[2]'))
+    store(address(emu, 'PPI', 'CH[0].TEP'), RADIO_TASKS_RXEN)
+    timer.publish('COMPARE[2]')
+    assert 'RADIO' not in emu.peripherals
+    store(address(emu, 'PPI', 'CHENSET'), 1)
+    timer.publish('COMPARE[2]')
+    # the task created the model
+    assert emu.peripherals['RADIO'].get_reg_by_name('STATE').value == RadioState.RXIDLE.value
+
+def test_ppi_groups(emu, store):
+    ppi = emu.peripherals['PPI']
+    store(address(emu, 'PPI', 'CHG[1]'), 0b110)
+    store(address(emu, 'PPI', 'TASKS_CHG[1].EN'), 1)
+    assert ppi.get_reg_by_name('CHEN').value == 0b110
+    store(address(emu, 'PPI', 'TASKS_CHG[1].DIS'), 1)
+    assert ppi.get_reg_by_name('CHEN').value == 0
+
+def test_fixed_channel(emu, store):
+    # channel 20: TIMER0 COMPARE[0] -> RADIO TXEN
+    store(address(emu, 'PPI', 'CHENSET'), 1 << 20)
+    radio = emu.peripherals['RADIO']
+    tx = []
+    radio.add_callback("tx_en", lambda: tx.append(radio.last_tx_frame))
+    emu.peripherals['TIMER0'].publish('COMPARE[0]')
+    assert len(tx) == 1
+    assert radio.get_reg_by_name('STATE').value == RadioState.TXIDLE.value
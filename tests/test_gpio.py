@@ -0,0 +1,99 @@
+from core.timeline import PinTimeline, write_vcd, PS_PER_CYCLE
+
+LED = 15
+
+
+def port(emu):
+    gpio = emu.peripherals['P0']
+    address = {name: gpio.get_reg_by_name(name).address
+               for name in ('OUT', 'OUTSET', 'OUTCLR', 'DIR', 'DIRSET', 'IN', 'PIN_CNF[0]')}
+    return gpio, address
+
+def timeline(changes, initial=0):
+    # changes: (time, levels)
+    timeline = PinTimeline(initial)
+    for time, levels in changes:
+        timeline.record(time, levels)
+    return timeline
+
+
+def test_outputs(emu, store, load):
+    gpio, address = port(emu)
+    store(address['PIN_CNF[0]'] + 4 * LED, 1)
+    assert gpio.dir.value == 1 << LED
+    emu.clock.advance(100)
+    store(address['OUTSET'], 1 << LED | 1)
+    assert gpio.out.value == 1 << LED | 1
+    # pin 0 is an input, it doesn't read back what it drives
+    assert load(address['IN']) == 1 << LED
+    emu.clock.advance(50)
+    store(address['OUTCLR'], 1 << LED)
+    out = gpio.timelines["OUT"]
+    assert out.edges(LED) == [(100, 1), (150, 0)]
+    assert gpio.timelines["IN"].edges(LED) == [(100, 1), (150, 0)]
+    assert gpio.timelines["DIR"].level(LED, 0) == 1
+
+def test_inputs(emu, store, load):
+    gpio, address = port(emu)
+    gpio.set_input(1 << 3 | 1 << LED, 1)
+    store(address['DIRSET'], 1 << LED)
+    # outputs read back OUT, not what is applied from outside
+    assert load(address['IN']) == 1 << 3
+    gpio.set_input(1 << 3, 0)
+    assert load(address['IN']) == 0
+
+def test_change_callback(emu, store):
+    gpio, address = port(emu)
+    changes = []
+    gpio.add_callback("change", changes.append)
+    store(address['DIR'], 0xff)
+    store(address['OUT'], 0x0f)
+    # the same levels again
+    store(address['OUTSET'], 0x01)
+    store(address['OUTCLR'], 0x03)
+    assert changes == [0x0f, 0x03]
+
+def test_state(emu, store):
+    gpio, address = port(emu)
+    store(address['OUTSET'], 1)
+    state = gpio.save_state()
+    emu.clock.advance(10)
+    store(address['OUTCLR'], 1)
+    gpio.load_state(state)
+    assert gpio.out.value == 1
+    assert gpio.timelines["OUT"].edges(0) == [(0, 1)]
+    # the saved state survives being restored and cut back again
+    emu.clock.advance(10)
+    store(address['OUTCLR'], 1)
+    gpio.load_state(state)
+    assert len(gpio.timelines["OUT"].times) == 2
+
+
+def test_timeline_levels():
+    pins = timeline([(10, 1), (10, 1), (20, 3), (30, 2), (30, 0)])
+    # the same levels again are no change
+    assert list(pins.times) == [0, 10, 20, 30, 30]
+    assert [pins.level(0, time) for time in (0, 9, 10, 29, 30)] == [0, 0, 1, 1, 0]
+    # a pulse in one block is kept as an empty run
+    assert pins.edges(1) == [(20, 1), (30, 0)]
+    assert pins.changed_pins() == 3
+    assert pins.pulse_widths(0) == [20]
+    assert pins.pulse_widths(0, level=0) == [10]
+
+def test_blinks():
+    # the first edge sets the LED up, a pulse still on at the end doesn't count
+    pins = timeline([(5, 1), (100, 0), (200, 1), (250, 0), (300, 1)])
+    assert pins.blink_widths(0) == [50]
+    assert pins.blink_widths(0, active=0) == [100, 50]
+    assert timeline([]).blinks(0) == 0
+
+def test_vcd(tmp_path):
+    path = str(tmp_path / 'pins.vcd')
+    write_vcd(path, [("P0", "OUT", timeline([(2, 1 << LED)])), ("P0", "DIR", timeline([]))], end_time=4)
+    lines = open(path).read().splitlines()
+    assert "$var wire 32 ! OUT [31:0] $end" in lines
+    assert '$var wire 1 " OUT15 $end' in lines
+    assert "$var wire 32 # DIR [31:0] $end" in lines
+    changes = lines[lines.index("$enddefinitions $end") + 1:]
+    assert changes == ["#0", "b0 !", '0"', "b0 #", "#%d" % (2 * PS_PER_CYCLE), "b%s !" % bin(1 << LED)[2:], '1"',
+                       "#%d" % (4 * PS_PER_CYCLE)]
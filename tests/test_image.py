@@ -0,0 +1,129 @@
+import struct
+
+import pytest
+
+from core import image
+from core.image import (ELF_HEADER, PROGRAM_HEADER, SECTION_HEADER, ELF_SYMBOL, PT_LOAD, SHT_SYMTAB, STT_OBJECT,
+                        STT_FUNC, Symbol, SymbolIndex, load_image)
+
+
+@pytest.fixture(autouse=True)
+def cache_dir(tmp_path, monkeypatch):
+    # symbol caches of the test images stay out of data/.cache
+    monkeypatch.setattr(image, 'CACHE_DIR', str(tmp_path / 'cache'))
+
+
+def hex_record(kind, offset, data):
+    record = bytes([len(data), offset >> 8, offset & 0xff, kind]) + data
+    return ':%s%02X\n' % (record.hex().upper(), -sum(record) & 0xff)
+
+def make_elf(segments, symbols):
+    # segments: (vaddr, paddr, data, memsz), symbols: (name, value, size, type)
+    strtab = b'\0'
+    symtab = ELF_SYMBOL.pack(0, 0, 0, 0, 0, 0)
+    for name, value, size, kind in symbols:
+        symtab += ELF_SYMBOL.pack(len(strtab), value, size, kind, 0, 1)
+        strtab += name.encode() + b'\0'
+    phoff = ELF_HEADER.size
+    offset = phoff + len(segments) * PROGRAM_HEADER.size
+    headers = b''
+    contents = b''
+    for vaddr, paddr, data, memsz in segments:
+        headers += PROGRAM_HEADER.pack(PT_LOAD, offset + len(contents), vaddr, paddr, len(data), memsz, 5, 4)
+        contents += data
+    symtab_offset = offset + len(contents)
+    strtab_offset = symtab_offset + len(symtab)
+    shoff = strtab_offset + len(strtab)
+    sections = (SECTION_HEADER.pack(*[0] * 10) +
+                SECTION_HEADER.pack(0, SHT_SYMTAB, 0, 0, symtab_offset, len(symtab), 2, 0, 4, ELF_SYMBOL.size) +
+                SECTION_HEADER.pack(0, 3, 0, 0, strtab_offset, len(strtab), 0, 0, 1, 0))
+    ident = b'\x7fELF\x01\x01\x01'.ljust(16, b'\0')
+    header = ELF_HEADER.pack(ident, 2, 40, 1, 0x101, phoff, shoff, 0, ELF_HEADER.size, PROGRAM_HEADER.size,
+                             len(segments), SECTION_HEADER.size, 3, 2)
+    return header + headers + contents + symtab + strtab + sections
+
+
+def test_symbol_lookup():
+    index = SymbolIndex([Symbol(0x200, 0x10, 'main'), Symbol(0x100, 0x20, 'reset'), Symbol(0x300, 0, 'tail')])
+    assert len(index) == 3
+    assert index.lookup(0x0ff) is None
+    assert index.lookup(0x100) == (Symbol(0x100, 0x20, 'reset'), 0)
+    assert index.lookup(0x20c) == (Symbol(0x200, 0x10, 'main'), 0xc)
+    # past the end of a sized symbol
+    assert index.lookup(0x120) is None
+    # one without a size runs up to the next
+    assert index.lookup(0x400) == (Symbol(0x300, 0, 'tail'), 0x100)
+    assert index.name(0x200) == 'main'
+    assert index.name(0x204) == 'main+0x4'
+    assert index.name(0x150) == '0x150'
+    assert index.functions() == [0x100, 0x200, 0x300]
+
+def test_symbol_address():
+    index = SymbolIndex([Symbol(0x200, 0x10, 'main')])
+    assert index.address('main') == 0x200
+    assert index.address('main+0x8') == 0x208
+    assert index.address('0x1234') == 0x1234
+    assert index.address(index.name(0x20a)) == 0x20a
+    with pytest.raises(KeyError):
+        index.address('missing')
+
+def test_load_hex(tmp_path):
+    path = tmp_path / 'fw.hex'
+    path.write_text(hex_record(4, 0, b'\x00\x00') +
+                    hex_record(0, 0x0000, b'\x00\x80\x00\x20') +
+                    hex_record(0, 0x0004, b'\x01\x01\x00\x00') +
+                    hex_record(0, 0x0100, b'\xfe\xe7') +
+                    hex_record(4, 0, b'\x10\x00') +
+                    hex_record(0, 0x1014, b'\xff\xff\xff\xfe') +
+                    hex_record(5, 0, b'\x00\x00\x01\x01') +
+                    hex_record(1, 0, b''))
+    fw = load_image(str(path))
+    assert fw.kind == 'hex'
+    assert fw.entry == 0x101
+    assert [(s.address, bytes(s.data), s.size) for s in fw.segments] == [
+        (0x0, bytes.fromhex('0080002001010000'), 8),
+        (0x100, b'\xfe\xe7', 2),
+        (0x10001014, b'\xff\xff\xff\xfe', 4)]
+    # UICR isn't flash
+    assert fw.flash_range() == (0, 0x102)
+    fw.close()
+
+def test_hex_bad_checksum(tmp_path):
+    path = tmp_path / 'bad.hex'
+    record = hex_record(0, 0, b'\x00\x80\x00\x20')
+    path.write_text(record[:-3] + '%02X\n' % (int(record[-3:-1], 16) ^ 1) + hex_record(1, 0, b''))
+    with pytest.raises(ValueError, match='checksum'):
+        load_image(str(path))
+
+def test_load_elf(tmp_path):
+    text = struct.pack('<II', 0x20008000, 0x101) + b'\xfe\xe7\x00\xbf'
+    data = b'\x11\x22\x33\x44'
+    path = tmp_path / 'fw.elf'
+    path.write_bytes(make_elf([(0x0, 0x0, text, len(text)),
+                               # .data: runs from RAM, loaded right after .text
+                               (0x20000000, 0x100, data, 0x10)],
+                              [('reset', 0x101, 4, STT_FUNC), ('counter', 0x20000000, 4, STT_OBJECT)]))
+    fw = load_image(str(path), 0x4000)
+    assert fw.kind == 'elf'
+    assert fw.entry == 0x101
+    # only the initial values go to flash, at the load address
+    assert [(s.address, bytes(s.data), s.size) for s in fw.segments] == [(0x0, text, len(text)),
+                                                                          (0x100, data, len(data))]
+    assert fw.flash_range() == (0, 0x104)
+    # the thumb bit is dropped from functions
+    assert fw.symbols.name(0x102) == 'reset+0x2'
+    assert fw.symbols.address('counter') == 0x20000000
+    fw.close()
+    # a second load reads the symbols from the cache
+    cached = load_image(str(path))
+    assert cached.symbols.symbols == fw.symbols.symbols
+    cached.close()
+
+def test_load_bin(tmp_path):
+    path = tmp_path / 'fw.bin'
+    path.write_bytes(b'\x00' * 0x20)
+    fw = load_image(str(path), 0x1000)
+    assert fw.kind == 'bin'
+    assert fw.flash_range() == (0x1000, 0x1020)
+    assert len(fw.symbols) == 0
+    fw.close()
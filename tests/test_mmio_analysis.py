@@ -0,0 +1,72 @@
+import gzip
+
+import pytest
+
+from core import trace as tracing
+from core.svd import AddressIndex, load_register_map
+from core.trace import TraceWriter
+from mmio_analysis import READ, WRITE, ACCESS, MmioStats, read_accesses
+
+RTC1_INTENSET = 0x40011304
+TIMER0_CC0 = 0x40008540
+
+
+@pytest.fixture(scope='module')
+def index():
+    return AddressIndex(load_register_map())
+
+
+def test_address_index(index):
+    assert index.register(TIMER0_CC0).name == 'CC[0]'
+    # any byte of the register
+    assert index.register(TIMER0_CC0 + 2).name == 'CC[0]'
+    assert index.peripheral(TIMER0_CC0) == 'TIMER0'
+    # P0 and P1 share a block, the register decides
+    assert index.peripheral(0x50000508) == 'P0'
+    assert index.peripheral(0x50000808) == 'P1'
+    # peripherals sharing an address block are named together
+    assert index.peripheral(0x40000000) == 'APPROTECT/CLOCK/POWER'
+    # inside a block, not a register
+    assert index.register(0x40008ffc) is None
+    assert index.peripheral(0x40008ffc) == 'TIMER0'
+    assert index.peripheral(0x60000000) is None
+
+def test_stats(index):
+    stats = MmioStats(index)
+    stats.add(WRITE, 0x322, RTC1_INTENSET, 0x1, 3)
+    stats.add(WRITE, 0x322, RTC1_INTENSET, 0x10001)
+    stats.add(READ, 0x330, RTC1_INTENSET, 0x1)
+    stats.add(ACCESS, None, TIMER0_CC0, None, 5)
+    stats.add(ACCESS, None, 0x60000000, None)
+    assert stats.total == 11
+    assert stats.peripherals == {'RTC1': 5, 'TIMER0': 5}
+    assert stats.registers[(RTC1_INTENSET, WRITE)] == 4
+    assert stats.registers[(TIMER0_CC0, ACCESS)] == 5
+    assert stats.unmatched == {0x60000000: 1}
+    # field values, by register and kind of access
+    fields = stats.fields[(RTC1_INTENSET, WRITE)]
+    assert fields['TICK'] == {1: 4}
+    assert fields['COMPARE0'] == {0: 3, 1: 1}
+    assert stats.fields[(RTC1_INTENSET, READ)]['TICK'] == {1: 1}
+    assert stats.sites[(0x322, WRITE, RTC1_INTENSET)] == 4
+
+@pytest.mark.parametrize('name', ['run.trace', 'run.trace.gz'])
+def test_read_trace(tmp_path, name):
+    writer = TraceWriter(capacity=16)
+    writer.record(tracing.MMIO_WRITE, 0x322, 10, RTC1_INTENSET, 1)
+    writer.record(tracing.IRQ_ENTER, 0x322, 20, 0, 17)
+    writer.record(tracing.MMIO_READ, 0x2044, 30, TIMER0_CC0, 1234)
+    path = str(tmp_path / name)
+    writer.save(str(tmp_path / 'run.trace'))
+    if name.endswith('.gz'):
+        with open(str(tmp_path / 'run.trace'), 'rb') as src, gzip.open(path, 'wb') as dst:
+            dst.write(src.read())
+    assert list(read_accesses(path)) == [(WRITE, 0x322, RTC1_INTENSET, 1, 1), (READ, 0x2044, TIMER0_CC0, 1234, 1)]
+
+@pytest.mark.parametrize('name', ['mmio.txt', 'mmio.txt.gz'])
+def test_read_log(tmp_path, name):
+    path = str(tmp_path / name)
+    opener = gzip.open if name.endswith('.gz') else open
+    with opener(path, 'wt') as fp:
+        fp.write('40008540\n40011304\n40008540\n')
+    assert sorted(read_accesses(path)) == [(ACCESS, None, TIMER0_CC0, None, 2), (ACCESS, None, RTC1_INTENSET, None, 1)]
@@ -0,0 +1,149 @@
+import logging
+import struct
+
+import pytest
+from unicorn.arm_const import (UC_ARM_REG_R0, UC_ARM_REG_R1, UC_ARM_REG_R3, UC_ARM_REG_R6, UC_ARM_REG_PC, UC_ARM_REG_LR, UC_ARM_REG_MSP,
+                               UC_ARM_REG_IPSR, UC_ARM_REG_PRIMASK)
+
+from core.ic import (FRAME, NVIC_ISER, NVIC_ISPR, NVIC_IPR, SYSM_PRIMASK, SYSM_BASEPRI, SYSM_BASEPRI_MAX,
+                     SYSM_FAULTMASK)
+from core.logger import logger
+from emulator import Emulator, RAM_START_ADDRESS, RAM_SIZE, decode_system_instruction
+
+STACK_TOP = RAM_START_ADDRESS + RAM_SIZE
+RETURN_ADDRESS = 0x1234
+THREAD_RETURN = 0xfffffff9
+TIMER0 = 8
+RTC1 = 17
+RADIO = 1
+CODE = 0x100
+# movs r0, #1; msr primask, r0; mrs r1, primask; movs r2, #0x40; msr basepri, r2
+# mrs r3, basepri; cpsie i; b .
+PROGRAM = struct.pack('<12H', 0x2001, 0xf380, 0x8810, 0xf3ef, 0x8110, 0x2240, 0xf382, 0x8811,
+                      0xf3ef, 0x8311, 0xb662, 0xe7fe)
+
+
+@pytest.fixture
+def nvic(emu):
+    emu.uc.reg_write(UC_ARM_REG_MSP, STACK_TOP)
+    nvic = emu.nvic
+    nvic.enabled = 1 << TIMER0 | 1 << RTC1 | 1 << RADIO
+    return nvic
+
+
+def test_enter_and_return(emu, nvic):
+    nvic.set_pending(RTC1)
+    assert nvic.ready
+    assert nvic.dispatch(RETURN_ADDRESS)
+    uc = emu.uc
+    assert uc.reg_read(UC_ARM_REG_IPSR) == 16 + RTC1
+    assert uc.reg_read(UC_ARM_REG_PC) == nvic.handler_address(RTC1) & ~1
+    assert uc.reg_read(UC_ARM_REG_LR) == THREAD_RETURN
+    sp = uc.reg_read(UC_ARM_REG_MSP)
+    assert sp == STACK_TOP - FRAME.size
+    assert FRAME.unpack(uc.mem_read(sp, FRAME.size))[6] == RETURN_ADDRESS
+    assert nvic.active == [RTC1] and not nvic.pending
+    nvic.exception_return(THREAD_RETURN)
+    assert uc.reg_read(UC_ARM_REG_PC) == RETURN_ADDRESS
+    assert uc.reg_read(UC_ARM_REG_MSP) == STACK_TOP
+    assert uc.reg_read(UC_ARM_REG_IPSR) == 0
+    assert nvic.active == []
+
+def test_priorities(nvic):
+    nvic.priorities[TIMER0] = 0x20
+    nvic.priorities[RTC1] = 0x40
+    nvic.priorities[RADIO] = 0x20
+    nvic.set_pending(RTC1)
+    nvic.set_pending(TIMER0)
+    # lower value first
+    assert nvic.next_pending() == TIMER0
+    nvic.dispatch(RETURN_ADDRESS)
+    # RTC1 can't preempt the TIMER0 handler
+    assert nvic.next_pending() is None
+    assert not nvic.ready
+    # the same priority can't either, a higher one can
+    nvic.set_pending(RADIO)
+    assert nvic.next_pending() is None
+    nvic.priorities[RADIO] = 0x00
+    nvic.update()
+    assert nvic.ready and nvic.next_pending() == RADIO
+
+def test_tail_chaining(emu, nvic):
+    entered = []
+    nvic.add_callback("enter", entered.append)
+    nvic.set_pending(RTC1)
+    nvic.dispatch(RETURN_ADDRESS)
+    frame = emu.uc.reg_read(UC_ARM_REG_MSP)
+    nvic.set_pending(TIMER0)
+    nvic.exception_return(THREAD_RETURN)
+    # the next handler runs on the same frame, no unstacking in between
+    assert entered == [RTC1, TIMER0]
+    assert nvic.active == [TIMER0]
+    assert emu.uc.reg_read(UC_ARM_REG_IPSR) == 16 + TIMER0
+    assert emu.uc.reg_read(UC_ARM_REG_MSP) == frame
+    assert emu.uc.reg_read(UC_ARM_REG_LR) == THREAD_RETURN
+    nvic.exception_return(THREAD_RETURN)
+    assert emu.uc.reg_read(UC_ARM_REG_PC) == RETURN_ADDRESS
+
+def test_return_without_active(emu, nvic):
+    # a stray EXC_RETURN, with an IRQ to chain into
+    nvic.set_pending(TIMER0)
+    nvic.exception_return(THREAD_RETURN)
+    assert nvic.active == [TIMER0]
+
+def test_primask(emu, nvic):
+    emu.uc.reg_write(UC_ARM_REG_PRIMASK, 1)
+    nvic.set_pending(RTC1)
+    assert not nvic.dispatch(RETURN_ADDRESS)
+    # taken as soon as the mask is cleared
+    assert nvic.ready
+    nvic.write_special(SYSM_PRIMASK, 0)
+    assert nvic.dispatch(RETURN_ADDRESS)
+
+def test_basepri(nvic):
+    nvic.priorities[TIMER0] = 0x20
+    nvic.priorities[RTC1] = 0x40
+    nvic.write_special(SYSM_BASEPRI, 0x40)
+    nvic.set_pending(RTC1)
+    assert not nvic.ready
+    nvic.set_pending(TIMER0)
+    assert nvic.next_pending() == TIMER0
+    # BASEPRI_MAX only raises the masking
+    nvic.write_special(SYSM_BASEPRI_MAX, 0x60)
+    assert nvic.read_special(SYSM_BASEPRI) == 0x40
+    nvic.write_special(SYSM_BASEPRI_MAX, 0x20)
+    assert nvic.read_special(SYSM_BASEPRI) == 0x20
+    assert not nvic.ready
+    nvic.write_special(SYSM_BASEPRI, 0)
+    assert nvic.next_pending() == TIMER0
+
+def test_registers(emu, store, load):
+    nvic = emu.nvic
+    store(NVIC_ISER, 1 << RTC1)
+    store(NVIC_ISPR, 1 << RTC1)
+    assert nvic.enabled == 1 << RTC1 and nvic.pending == 1 << RTC1
+    # 3 bits of priority
+    store(NVIC_IPR + 16, 0xff << 8)
+    assert nvic.priorities[RTC1] == 0xe0
+    assert load(NVIC_IPR + 16) == 0xe0 << 8
+    assert load(NVIC_ISER) == 1 << RTC1
+
+def test_decode():
+    # mrs r6, primask; msr basepri, r0; cpsid i; cpsie f
+    assert decode_system_instruction(struct.pack('<HH', 0xf3ef, 0x8610)) == ("mrs", SYSM_PRIMASK, UC_ARM_REG_R6)
+    assert decode_system_instruction(struct.pack('<HH', 0xf380, 0x8811)) == ("msr", SYSM_BASEPRI, UC_ARM_REG_R0)
+    assert decode_system_instruction(struct.pack('<HH', 0xb672, 0)) == ("cps", [(SYSM_PRIMASK, 1)])
+    assert decode_system_instruction(struct.pack('<HH', 0xb661, 0)) == ("cps", [(SYSM_FAULTMASK, 0)])
+
+def test_special_instructions(tmp_path):
+    logger.setLevel(logging.WARNING)
+    path = tmp_path / 'mask.bin'
+    path.write_bytes(struct.pack('<18I', STACK_TOP, CODE | 1, *[0] * 16).ljust(CODE, b'\0') + PROGRAM)
+    emu = Emulator(str(path), 0)
+    emu.boot()
+    emu.run(seconds=0.0001)
+    assert emu.uc.reg_read(UC_ARM_REG_R1) == 1
+    assert emu.uc.reg_read(UC_ARM_REG_R3) == 0x40
+    assert emu.nvic.basepri == 0x40
+    # cpsie
+    assert emu.uc.reg_read(UC_ARM_REG_PRIMASK) == 0
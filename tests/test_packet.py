@@ -0,0 +1,122 @@
+from core.packet import (PCNF0_S0LEN_SHIFT, PCNF0_S1LEN_SHIFT, PCNF1_STATLEN_SHIFT, PCNF1_BALEN_SHIFT,
+                         PCNF1_ENDIAN_BIG, PCNF1_WHITEEN, CRCCNF_SKIPADDR, PacketFormat, packet_format)
+
+# BLE-like framing: S0, 8 bit LENGTH, 3 byte base address, 24 bit CRC
+PCNF0 = 8 | 1 << PCNF0_S0LEN_SHIFT
+PCNF1 = 37 | 3 << PCNF1_BALEN_SHIFT
+BASE0 = 0x89bed600
+PREFIX0 = 0x8e
+CRCPOLY = 0x65b
+CRCINIT = 0x555555
+
+
+def make_format(pcnf0=PCNF0, pcnf1=PCNF1, crccnf=3, crcpoly=CRCPOLY, crcinit=CRCINIT, whiteiv=0x65,
+                base0=BASE0, base1=0x12345600, prefix0=PREFIX0, prefix1=0x44):
+    return PacketFormat((pcnf0, pcnf1, crccnf, crcpoly, crcinit, whiteiv, base0, base1, prefix0, prefix1))
+
+def air_bits(data):
+    # bits of data in the order they are sent, every byte LSB first
+    return [(byte >> n) & 1 for byte in data for n in range(8)]
+
+def reference_crc(bits, width, poly, init):
+    # the CRC as the datasheet draws it, a shift register fed one bit at a time
+    mask = (1 << width) - 1
+    poly = (poly | 1) & mask
+    crc = init & mask
+    for bit in bits:
+        feedback = (crc >> (width - 1)) ^ bit
+        crc = (crc << 1) & mask
+        if feedback & 1:
+            crc ^= poly
+    return crc
+
+
+def test_address_bytes():
+    fmt = make_format()
+    assert fmt.addresses[0] == bytes.fromhex('d6be898e')
+    assert fmt.addresses[4] == bytes.fromhex('56341244')
+
+def test_crc_matches_shift_register():
+    fmt = make_format()
+    packet = bytes([0x02, 5]) + b'hello'
+    frame = fmt.encode(packet)
+    assert frame.payload == b'hello'
+    assert frame.crc_ok
+    assert frame.packet == packet
+    # not whitened, the bits on air are the frame's
+    bits = air_bits(frame.air)
+    body = 8 * (fmt.s0len + 1) + 8 * 5
+    expected = reference_crc(bits[:32 + body], 24, CRCPOLY, CRCINIT)
+    assert frame.crc == expected
+    # the CRC goes out MSB first
+    sent = bits[32 + body:32 + body + 24]
+    assert sent == [(expected >> (23 - n)) & 1 for n in range(24)]
+
+def test_crc_skips_address():
+    fmt = make_format(crccnf=2 | CRCCNF_SKIPADDR, crcpoly=0x11021, crcinit=0xffff)
+    frame = fmt.encode(bytes([0, 3]) + b'abc')
+    bits = air_bits(frame.air)[32:]
+    assert frame.crc == reference_crc(bits[:16 + 24], 16, 0x11021, 0xffff)
+
+def test_round_trip():
+    fmt = make_format(pcnf1=PCNF1 | PCNF1_WHITEEN)
+    packet = bytes([0x40, 6]) + bytes(range(6))
+    frame = fmt.encode(packet, address=4)
+    decoded = fmt.decode(frame.air)
+    assert decoded.address == 4
+    assert decoded.packet == packet
+    assert decoded.crc == frame.crc
+    assert decoded.crc_ok
+
+def test_whitening_changes_air():
+    packet = bytes([0, 4]) + b'\0\0\0\0'
+    plain = make_format().encode(packet)
+    white = make_format(pcnf1=PCNF1 | PCNF1_WHITEEN).encode(packet)
+    assert white.air[:4] == plain.air[:4]
+    assert white.air[4:] != plain.air[4:]
+
+def test_big_endian_round_trip():
+    pcnf0 = 6 | 3 << PCNF0_S1LEN_SHIFT
+    fmt = make_format(pcnf0=pcnf0, pcnf1=PCNF1 | PCNF1_ENDIAN_BIG)
+    packet = bytes([5, 0x05]) + b'\x01\x80\xff\x10\x08'
+    frame = fmt.encode(packet)
+    assert frame.length == 5 and frame.s1 == 5
+    decoded = fmt.decode(frame.air)
+    assert decoded.packet == packet
+    assert decoded.crc_ok
+    # the first payload bit on air is the MSB of the first byte
+    bits = air_bits(frame.air)[32 + 6 + 3:]
+    assert bits[:8] == [0, 0, 0, 0, 0, 0, 0, 1]
+
+def test_corrupted_frame():
+    fmt = make_format(pcnf1=PCNF1 | PCNF1_WHITEEN)
+    air = bytearray(fmt.encode(bytes([0, 3]) + b'xyz').air)
+    air[6] ^= 0x10
+    decoded = fmt.decode(air)
+    assert decoded is not None
+    assert not decoded.crc_ok
+
+def test_address_not_enabled():
+    fmt = make_format()
+    air = fmt.encode(bytes([0, 1]) + b'a', address=4).air
+    assert fmt.decode(air, enabled=0x01) is None
+    assert fmt.decode(air, enabled=0x10).address == 4
+    assert fmt.decode(b'\x00\x01\x02\x03' + air[4:]) is None
+
+def test_static_length():
+    # STATLEN bytes are sent on top of LENGTH
+    fmt = make_format(pcnf1=PCNF1 | 2 << PCNF1_STATLEN_SHIFT)
+    frame = fmt.encode(bytes([0, 1]) + b'abc')
+    assert frame.payload == b'abc'
+    assert fmt.decode(frame.air).payload == b'abc'
+
+def test_maxlen_truncates():
+    fmt = make_format(pcnf1=4 | 3 << PCNF1_BALEN_SHIFT)
+    frame = fmt.encode(bytes([0, 6]) + b'abcdef')
+    assert frame.payload == b'abcd'
+    assert not frame.crc_ok
+    assert not fmt.decode(frame.air).crc_ok
+
+def test_formats_are_shared():
+    key = (PCNF0, PCNF1, 3, CRCPOLY, CRCINIT, 0, BASE0, 0, PREFIX0, 0)
+    assert packet_format(key) is packet_format(key)
@@ -0,0 +1,52 @@
+import os
+import subprocess
+import sys
+
+from core.peripheral import PERIPHERAL_MODELS, peripheral_windows, window_name
+
+TIMER0_TASKS_START = 0x40008000
+RTC1_COUNTER = 0x40011504
+
+
+def test_windows():
+    windows = peripheral_windows()
+    # computed once
+    assert peripheral_windows() is windows
+    assert sorted(name for _, _, name in windows) == sorted(PERIPHERAL_MODELS)
+    for begin, end, name in windows:
+        assert begin < end and begin % 4 == 0 and end % 4 == 0
+
+def test_models_created_on_first_access(emu, store, load):
+    assert 'TIMER0' not in emu.peripherals
+    assert 'RTC1' not in emu.peripherals
+    store(TIMER0_TASKS_START, 1)
+    # the store reached the model it created
+    assert emu.peripherals['TIMER0'].running
+    assert load(RTC1_COUNTER) == 0
+    assert 'RTC1' in emu.peripherals
+    # models nothing touched stay unloaded
+    assert 'P1' not in emu.peripherals
+    assert 'RADIO' not in emu.peripherals
+
+def test_scenario_creates_radio(emu):
+    assert 'RADIO' not in emu.peripherals
+    scenario = emu.scenario
+    assert emu.scenario is scenario
+    assert scenario.radio is emu.peripherals['RADIO']
+
+def test_window_name():
+    assert window_name(0x40008000) == 'TIMER0'
+    assert window_name(0x40008554) == 'TIMER0'
+    assert window_name(0x40008558) is None
+    assert window_name(0x5000080c) == 'P1'
+    assert window_name(0x3fffffff) is None
+    assert window_name(0x60000000) is None
+
+def test_nothing_loaded_up_front(emu):
+    # with the caches emu left behind, in a fresh process: the modules of
+    # this one are loaded already
+    code = ("import sys, emulator; emulator.Emulator(emulator.DEFAULT_FIRMWARE, 0); "
+            "print(sorted(m for m in sys.modules if m.startswith(('peripherals.', 'cmsis_svd', 'capstone'))))")
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    output = subprocess.run([sys.executable, '-c', code], cwd=root, capture_output=True, text=True, check=True).stdout
+    assert output.split() == ['[]']
@@ -0,0 +1,91 @@
+import logging
+import struct
+
+from unicorn.arm_const import UC_ARM_REG_R0, UC_ARM_REG_R2
+
+from core.logger import logger
+from core.run import PcReached
+from core.vclock import MAX_WARP
+from emulator import Emulator, DEFAULT_FIRMWARE, POLL_STORES, poll_loop
+
+CODE = 0x100
+STACK_TOP = 0x20008000
+TIMER0 = 0x40008000
+TIMER0_CC0 = 0x40008540
+# ticks of the 1 MHz timer the firmware waits for
+BOUND = 50000
+# ldr r0, =TIMER0; movs r1, #1; str r1, [r0] (TASKS_START); ldr r4, =BOUND
+# loop: ldr r0, =TIMER0; movs r1, #1; str r1, [r0, #0x40] (TASKS_CAPTURE[0])
+#       ldr r0, =TIMER0_CC0; ldr r2, [r0]; cmp r2, r4; blo loop
+# done: b .
+WAIT = struct.pack('<12H', 0x4805, 0x2101, 0x6001, 0x4c05, 0x4803, 0x2101, 0x6401, 0x4804, 0x6802, 0x42a2,
+                   0xd3f8, 0xe7fe) + struct.pack('<3I', TIMER0, BOUND, TIMER0_CC0)
+LOOP = CODE + 0x8
+DONE = CODE + 0x16
+
+
+def image(tmp_path, code):
+    path = tmp_path / 'poll.bin'
+    path.write_bytes(struct.pack('<18I', STACK_TOP, CODE | 1, *[0] * 16).ljust(CODE, b'\0') + code)
+    return str(path)
+
+def latch_block(emu, code, begin, end):
+    # the loop's last block and a reader for poll_loop()
+    def read(address, size):
+        return code[address - CODE:address - CODE + size]
+    return list(emu.cs.disasm(read(begin, end - begin), begin)), read
+
+
+def test_poll_stores():
+    # TASKS_CAPTURE[0..5] of the timer model
+    assert POLL_STORES == {TIMER0 + 0x40 + 4 * n for n in range(6)}
+
+def test_detects_time_sampling_loop(emu):
+    insns, read = latch_block(emu, WAIT, LOOP, DONE)
+    loop = poll_loop(emu.cs, read, insns)
+    assert loop.instructions == 7
+    assert loop.samples_time
+
+def test_detects_event_loop(emu):
+    # loop: ldr r1, [r0]; cmp r1, #0; beq loop
+    code = struct.pack('<3H', 0x6801, 0x2900, 0xd0fc)
+    insns, read = latch_block(emu, code, CODE, CODE + len(code))
+    loop = poll_loop(emu.cs, read, insns)
+    assert loop.instructions == 3
+    assert not loop.samples_time
+
+def test_rejects_loops_with_side_effects(emu):
+    # a store to RAM: loop: str r1, [r0]; ldr r1, [r0]; cmp r1, #0; beq loop
+    code = struct.pack('<4H', 0x6001, 0x6801, 0x2900, 0xd0fb)
+    insns, read = latch_block(emu, code, CODE, CODE + len(code))
+    assert poll_loop(emu.cs, read, insns) is None
+    # a counter carried over: loop: adds r2, #1; ldr r1, [r0]; cmp r1, #0; beq loop
+    code = struct.pack('<4H', 0x3201, 0x6801, 0x2900, 0xd0fb)
+    insns, read = latch_block(emu, code, CODE, CODE + len(code))
+    assert poll_loop(emu.cs, read, insns) is None
+
+def test_fast_forwards_time_sampling(tmp_path):
+    logger.setLevel(logging.WARNING)
+    emu = Emulator(image(tmp_path, WAIT), 0)
+    emu.boot()
+    result = emu.run(seconds=1, conditions=[PcReached(DONE)])
+    assert result.reason == "pc"
+    counter = emu.uc.reg_read(UC_ARM_REG_R2)
+    tick = emu.peripherals['TIMER0'].cycles_per_tick()
+    # past the bound, by no more than one jump
+    assert BOUND <= counter <= BOUND + MAX_WARP // tick
+    assert emu.clock.time // tick == counter
+    # spinning would take over a million instructions
+    assert emu.icount < 1000
+    assert emu.poll_skips > 0
+
+def test_idle_points(tmp_path):
+    logger.setLevel(logging.WARNING)
+    # the bundled firmware's are known, nothing is assumed of other images
+    assert Emulator(DEFAULT_FIRMWARE, 0).idle_points == {0x20aa: UC_ARM_REG_R0}
+    assert Emulator(DEFAULT_FIRMWARE, 0, idle_points=()).idle_points == {}
+    emu = Emulator(image(tmp_path, WAIT), 0)
+    assert emu.idle_points == {}
+    emu.add_idle_point(DONE, UC_ARM_REG_R2)
+    assert emu.idle_points == {DONE: UC_ARM_REG_R2}
+    assert emu.breakpoints[DONE]
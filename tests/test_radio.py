@@ -0,0 +1,13 @@
+from peripherals.radio import RadioState
+
+
+def test_task_needs_a_one(emu, store):
+    radio = emu.peripherals['RADIO']
+    rxen = radio.get_reg_by_name('TASKS_RXEN').address
+    for value in (0, 2, 0xffffffff):
+        store(rxen, value)
+        assert radio.get_reg_by_name('STATE').value == RadioState.DISABLED.value
+        assert radio.get_reg_by_name('EVENTS_READY').value == 0
+    store(rxen, 1)
+    assert radio.get_reg_by_name('STATE').value == RadioState.RXIDLE.value
+    assert radio.get_reg_by_name('EVENTS_READY').value == 1
@@ -0,0 +1,86 @@
+import logging
+
+import pytest
+from unicorn.arm_const import (UC_ARM_REG_R0, UC_ARM_REG_R1, UC_ARM_REG_R2, UC_ARM_REG_R3, UC_ARM_REG_R4,
+                               UC_ARM_REG_R5, UC_ARM_REG_R6, UC_ARM_REG_R7, UC_ARM_REG_R12, UC_ARM_REG_SP,
+                               UC_ARM_REG_LR, UC_ARM_REG_PC, UC_ARM_REG_XPSR)
+
+from core.logger import logger
+from core.replay import Recorder, Replayer, load_recording, recording_firmware
+from core.scenario import repeat_packet
+from emulator import Emulator, DEFAULT_FIRMWARE, DEFAULT_RX_PACKET, RAM_START_ADDRESS, RAM_SIZE
+
+SECONDS = 5
+INTERVAL = 10000
+REGISTERS = [UC_ARM_REG_R0, UC_ARM_REG_R1, UC_ARM_REG_R2, UC_ARM_REG_R3, UC_ARM_REG_R4, UC_ARM_REG_R5,
+             UC_ARM_REG_R6, UC_ARM_REG_R7, UC_ARM_REG_R12, UC_ARM_REG_SP, UC_ARM_REG_LR, UC_ARM_REG_PC,
+             UC_ARM_REG_XPSR]
+
+
+def machine_state(emu):
+    return (emu.icount, emu.clock.time, [emu.uc.reg_read(reg) for reg in REGISTERS],
+            bytes(emu.uc.mem_read(RAM_START_ADDRESS, RAM_SIZE)))
+
+
+@pytest.fixture(scope='module')
+def recording_path(tmp_path_factory):
+    logger.setLevel(logging.WARNING)
+    path = str(tmp_path_factory.mktemp('replay') / 'run.rec')
+    emu = Emulator(DEFAULT_FIRMWARE, 0)
+    emu.scenario.load(repeat_packet(DEFAULT_RX_PACKET))
+    recorder = Recorder(emu, DEFAULT_FIRMWARE, INTERVAL)
+    recorder.start()
+    emu.boot()
+    recorder.run(SECONDS)
+    recorder.stop().save(path)
+    return path
+
+
+def replayer(path):
+    # a fresh emulator, as in a later session
+    emu = Emulator(*recording_firmware(path))
+    return emu, Replayer(emu, load_recording(path, emu))
+
+
+def test_recording(recording_path):
+    emu, replay = replayer(recording_path)
+    recording = replay.recording
+    assert recording.end > 4 * INTERVAL
+    icounts = [checkpoint.icount for checkpoint in recording.checkpoints]
+    assert icounts[0] == 0
+    # checkpoints are taken at the first block boundary after each interval
+    assert all(0 <= b - a - INTERVAL < 64 for a, b in zip(icounts, icounts[1:-1]))
+    assert icounts[-1] == recording.end
+
+def test_seek_is_deterministic(recording_path):
+    target = 3 * INTERVAL + 1234
+    emu, replay = replayer(recording_path)
+    reached = replay.seek(target)
+    assert reached >= target
+    first = machine_state(emu)
+    # the same point from another emulator
+    emu, replay = replayer(recording_path)
+    assert replay.seek(target) == reached
+    assert machine_state(emu) == first
+
+def test_seek_back_and_forth(recording_path):
+    target = 2 * INTERVAL + 777
+    emu, replay = replayer(recording_path)
+    replay.seek(target)
+    expected = machine_state(emu)
+    replay.seek(4 * INTERVAL)
+    replay.seek(100)
+    # forward from a previous seek without restoring a checkpoint
+    replay.seek(target - 500)
+    replay.seek(target)
+    assert machine_state(emu) == expected
+
+def test_seek_matches_straight_run(recording_path):
+    target = 3 * INTERVAL + 1234
+    emu, replay = replayer(recording_path)
+    replay.seek(target)
+    straight = Emulator(DEFAULT_FIRMWARE, 0)
+    straight.scenario.load(repeat_packet(DEFAULT_RX_PACKET))
+    straight.boot()
+    straight.run_to(target)
+    assert machine_state(emu) == machine_state(straight)
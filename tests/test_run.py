@@ -0,0 +1,163 @@
+import logging
+import struct
+
+import pytest
+from unicorn import Uc, UC_ARCH_ARM, UC_MODE_THUMB
+
+from core import run
+from core.logger import logger
+from core.run import CpuException, Fault, GpioBlinks, GpioToggles, PcReached, RadioTx, RxWaiting
+from core.scenario import repeat_packet, rx_packets
+from emulator import Emulator, BlockHook, DEFAULT_FIRMWARE, DEFAULT_RX_PACKET, FAULT_HANDLERS
+from fuzzer import edges, MAP_SIZE
+
+STACK_TOP = 0x20008000
+CODE = 0x100
+# b CODE+4; the hard fault handler: b .; nop; the other fault handlers: b .
+FAULTING = struct.pack('<4H', 0xe000, 0xe7fe, 0xbf00, 0xe7fe)
+# nop; svc #0; b .
+SUPERVISOR_CALL = struct.pack('<3H', 0xbf00, 0xdf00, 0xe7fe)
+# nop; udf #0
+UNDEFINED = struct.pack('<2H', 0xbf00, 0xde00)
+# b .
+SPINNING = struct.pack('<H', 0xe7fe)
+# nop; nop, then off the end of the image
+RUNNING_OFF = struct.pack('<2H', 0xbf00, 0xbf00)
+LED = 1 << 15
+
+
+def program(tmp_path, code, handlers=()):
+    # vector table, the reset handler at CODE, handlers are (name, address)
+    table = dict.fromkeys(FAULT_HANDLERS, 0)
+    table.update(handlers)
+    vectors = [STACK_TOP, CODE | 1, 0] + [table[name] | 1 if table[name] else 0 for name in FAULT_HANDLERS]
+    firmware = struct.pack('<18I', *vectors, *[0] * 11).ljust(CODE, b'\0') + code
+    path = tmp_path / 'run.bin'
+    path.write_bytes(firmware)
+    logger.setLevel(logging.WARNING)
+    emu = Emulator(str(path), 0)
+    emu.boot()
+    return emu
+
+
+def test_fault(tmp_path):
+    emu = program(tmp_path, FAULTING, [("hardfault_handler", CODE + 2), ("mgnmem_handler", CODE + 6),
+                                       ("busfault_handler", CODE + 6), ("usefault_handler", CODE + 6)])
+    fault = Fault(FAULT_HANDLERS)
+    result = emu.run(seconds=0.01, conditions=[fault])
+    # the nop between the handlers shares their hook, it is no handler
+    assert result.reason == Fault.name and result.condition is fault
+    assert fault.address == CODE + 6
+    assert fault.handles == []
+
+def test_cpu_exception(tmp_path):
+    emu = program(tmp_path, SUPERVISOR_CALL)
+    result = emu.run(seconds=0.01, conditions=[CpuException()])
+    assert result.reason == CpuException.name
+    # EXCP_SWI
+    assert result.condition.exc_no == 2
+
+def test_error(tmp_path):
+    emu = program(tmp_path, UNDEFINED)
+    result = emu.run(seconds=0.01, conditions=[CpuException()])
+    assert result.reason == run.ERROR
+    assert result.error is not None and result.pc == CODE + 2
+
+def test_instruction_budget(tmp_path):
+    emu = program(tmp_path, SPINNING)
+    result = emu.run(instructions=1000, conditions=[Fault(FAULT_HANDLERS), CpuException()])
+    assert result.reason == run.INSTRUCTIONS
+    assert 1000 <= result.instructions < 1100
+    assert result.pc == CODE
+
+def test_time(tmp_path):
+    emu = program(tmp_path, SPINNING)
+    result = emu.run(seconds=0.001)
+    assert result.reason == run.TIME and result.condition is None
+    assert result.time == 1000
+
+def test_exited(tmp_path):
+    emu = program(tmp_path, RUNNING_OFF)
+    assert emu.run(seconds=0.001).reason == run.EXITED
+
+def test_pc_reached(tmp_path):
+    emu = program(tmp_path, FAULTING)
+    result = emu.run(seconds=0.001, conditions=[PcReached(CODE + 4 | 1)])
+    assert result.reason == PcReached.name and result.pc == CODE + 4
+
+def test_gpio_blinks(emu):
+    emu.scenario.load(repeat_packet(DEFAULT_RX_PACKET))
+    emu.boot()
+    toggles = []
+    gpio = emu.peripherals['P0']
+    gpio.add_callback("change", toggles.append)
+    blinks = GpioBlinks(3, LED)
+    result = emu.run(seconds=30, conditions=[blinks])
+    assert result.reason == GpioBlinks.name and blinks.blinks == 3
+    # the same count as the timeline, the LED being set up isn't one
+    assert gpio.timelines["OUT"].blinks(15) == 3
+    assert gpio.callbacks["change"] == toggles.append
+    assert len(toggles) == len(gpio.timelines["OUT"].edges(15))
+    # on from here, every toggle counts
+    before = len(toggles)
+    result = emu.run(seconds=30, conditions=[GpioToggles(2, LED)])
+    assert result.reason == GpioToggles.name and len(toggles) == before + 2
+    assert result.condition.toggles == 2
+    # other pins don't
+    assert emu.run(seconds=1, conditions=[GpioToggles(1, 1)]).reason == run.TIME
+
+def test_radio_tx(emu):
+    emu.scenario.load(repeat_packet(DEFAULT_RX_PACKET))
+    emu.boot()
+    snapshot = emu.snapshot()
+    assert emu.run(seconds=10, conditions=[RadioTx(b'\x01')]).reason == run.TIME
+    emu.restore(snapshot)
+    tx = RadioTx()
+    result = emu.run(seconds=10, conditions=[tx])
+    assert result.reason == RadioTx.name and tx.packet == emu.peripherals['RADIO'].last_tx_packet
+
+def test_rx_waiting(emu):
+    emu.scenario.load(())
+    emu.boot()
+    # the firmware waits 5 s before it first listens
+    result = emu.run(seconds=10, conditions=[RxWaiting()])
+    assert result.reason == RxWaiting.name
+    # the packet is handled and the radio listens again
+    emu.scenario.load(rx_packets([DEFAULT_RX_PACKET]))
+    result = emu.run(seconds=1, conditions=[RxWaiting()])
+    assert result.reason == RxWaiting.name
+    assert emu.scenario.received == 1 and emu.scenario.head is None
+    assert emu.scenario.callbacks["waiting"] is None
+
+def test_coverage(emu):
+    emu.scenario.load(repeat_packet(DEFAULT_RX_PACKET))
+    emu.boot()
+    blocks = emu.start_coverage()
+    result = emu.run(instructions=5000)
+    assert emu.stop_coverage() is blocks
+    assert blocks[0] == emu.vector_table['reset_handler'] & ~1
+    # every block ran is counted, the last one may end past the budget
+    assert sum(emu.block_icounts[address] for address in blocks) == result.instructions
+    emu.run(instructions=1000)
+    assert sum(emu.block_icounts[address] for address in blocks) == result.instructions
+
+def test_block_hook_exception():
+    uc = Uc(UC_ARCH_ARM, UC_MODE_THUMB)
+    uc.mem_map(0, 0x1000)
+    uc.mem_write(CODE, SPINNING)
+    seen = []
+
+    def cb(uc, address, size, user_data):
+        seen.append(address)
+        raise ValueError(address)
+    hook = BlockHook(uc, cb, 1, 0)
+    with pytest.raises(ValueError):
+        uc.emu_start(CODE | 1, CODE + 0x10)
+    assert seen == [CODE]
+
+def test_edges():
+    # a -> b -> a: (a), (a, b) and (b, a), the direction counts
+    a, b = 0x1000, 0x2000
+    assert edges([a, b, a]) == {a, b ^ (a >> 1), a ^ (b >> 1)}
+    assert edges([a, a]) == {a, a ^ (a >> 1)}
+    assert all(edge < MAP_SIZE for edge in edges([0x12345678, 0x20001234]))
@@ -0,0 +1,77 @@
+import logging
+import struct
+
+import pytest
+
+from core.logger import logger
+from core.sanitizer import UNINIT_READ, STACK_OVERFLOW, RADIO_OVERFLOW, RADIO_UNINIT, DEFAULT_STACK_SIZE
+from emulator import Emulator
+
+STACK_TOP = 0x20008000
+UNINIT = 0x20000100
+# in the guard window under the stack
+GUARD = STACK_TOP - DEFAULT_STACK_SIZE - 0x100
+CODE = 0x100
+# ldr r0, =UNINIT; ldr r1, [r0]; str r1, [r0, #4]; ldr r3, [r0, #4]
+# ldr r2, =GUARD; mov sp, r2; str r1, [r2]; b .
+PROGRAM = struct.pack('<8H', 0x4803, 0x6801, 0x6041, 0x6843, 0x4a02, 0x4695, 0x6011, 0xe7fe) + \
+          struct.pack('<II', UNINIT, GUARD)
+
+
+@pytest.fixture
+def emu(tmp_path):
+    logger.setLevel(logging.WARNING)
+    # vector table, the reset handler at CODE
+    firmware = struct.pack('<18I', STACK_TOP, CODE | 1, *[0] * 16).ljust(CODE, b'\0') + PROGRAM
+    path = tmp_path / 'sanitize.bin'
+    path.write_bytes(firmware)
+    emu = Emulator(str(path), 0)
+    emu.start_sanitizer()
+    emu.boot()
+    return emu
+
+
+def test_uninitialized_read(emu):
+    emu.run(seconds=0.001)
+    sanitizer = emu.sanitizer
+    report = sanitizer.reports[(UNINIT_READ, CODE)]
+    assert (report.address, report.size) == (UNINIT, 4)
+    # the load after the store reads initialized memory
+    assert sanitizer.counts[(UNINIT_READ, CODE)] == 1
+
+def test_stack_overflow(emu):
+    emu.run(seconds=0.001)
+    sanitizer = emu.sanitizer
+    assert sanitizer.stack_limit == STACK_TOP - DEFAULT_STACK_SIZE
+    report = sanitizer.reports[(STACK_OVERFLOW, CODE)]
+    assert (report.address, report.size) == (GUARD, 4)
+
+def test_reports_go_to_callback(emu):
+    reports = []
+    emu.sanitizer.add_callback("report", reports.append)
+    emu.run(seconds=0.001)
+    assert [report.kind for report in reports] == [UNINIT_READ, STACK_OVERFLOW]
+
+def test_radio_overflow(emu):
+    emu.run(seconds=0.001)
+    sanitizer = emu.sanitizer
+    radio = emu.peripherals['RADIO']
+    # 8 bit LENGTH, up to 255 bytes of payload
+    radio.get_reg_by_name('PCNF0').value = 8
+    radio.get_reg_by_name('PCNF1').value = 0xff
+    # a packet received into the last bytes of the stack runs past its top
+    radio.get_reg_by_name('PACKETPTR').value = STACK_TOP - 4
+    emu.inject_rx_packet(b'\x06abcdef')
+    report = sanitizer.reports[(RADIO_OVERFLOW, emu.block_address)]
+    assert report.address == STACK_TOP - 4
+    # what was received counts as written
+    assert sanitizer.uninitialized(STACK_TOP - 4, 4) is None
+
+def test_radio_sends_uninitialized(emu):
+    emu.run(seconds=0.001)
+    sanitizer = emu.sanitizer
+    # the word the firmware stored
+    sanitizer.dma_read_cb(UNINIT + 4, 4)
+    assert (RADIO_UNINIT, emu.block_address) not in sanitizer.reports
+    sanitizer.dma_read_cb(UNINIT + 4, 8)
+    assert sanitizer.reports[(RADIO_UNINIT, emu.block_address)].size == 8
@@ -0,0 +1,137 @@
+import pytest
+
+from core.scenario import (AT, AFTER, ON_RX, ANY_FREQUENCY, RxPacket, parse_packet, format_packet, read_scenario,
+                           write_scenario, rx_packets, us_to_cycles)
+from emulator import RAM_START_ADDRESS
+
+PACKETS = [
+    RxPacket(AT, us_to_cycles(5000), 7, True, 0, b'\x05\x00\x44'),
+    RxPacket(AFTER, us_to_cycles(400), ANY_FREQUENCY, False, 1, b''),
+    RxPacket(ON_RX, us_to_cycles(40), 80, True, 2, bytes(range(8))),
+]
+
+
+def run_until(emu, time):
+    clock = emu.clock
+    while clock.next_deadline <= time:
+        clock.advance(clock.next_deadline - clock.time)
+        clock.run_due()
+    clock.advance(time - clock.time)
+
+@pytest.fixture
+def scenario(emu):
+    scenario = emu.scenario
+    scenario.radio.get_reg_by_name('PACKETPTR').value = RAM_START_ADDRESS + 0x100
+    scenario.received_packets = []
+    scenario.missed_packets = []
+    scenario.add_callback("rx", scenario.received_packets.append)
+    scenario.add_callback("miss", scenario.missed_packets.append)
+    return scenario
+
+def listen(store, scenario):
+    store(scenario.radio.get_reg_by_name('TASKS_RXEN').address, 1)
+
+def disable(store, scenario):
+    store(scenario.radio.get_reg_by_name('TASKS_DISABLE').address, 1)
+
+
+def test_format_round_trip():
+    for packet in PACKETS:
+        assert parse_packet(format_packet(packet)) == packet
+    assert format_packet(PACKETS[1]) == "+400 * bad 1 -"
+    assert parse_packet("rx+40 0x50 ok 0 0102") == RxPacket(ON_RX, us_to_cycles(40), 0x50, True, 0, b'\x01\x02')
+
+def test_bad_crc_field():
+    with pytest.raises(ValueError):
+        parse_packet("100 * maybe 0 00")
+
+@pytest.mark.parametrize('name', ['rx.txt', 'rx.txt.gz'])
+def test_file_round_trip(tmp_path, name):
+    path = str(tmp_path / name)
+    write_scenario(path, PACKETS)
+    assert list(read_scenario(path)) == PACKETS
+
+def test_file_errors_name_the_line(tmp_path):
+    path = tmp_path / 'rx.txt'
+    path.write_text("# comment\n\n100 * ok 0 00  # trailing\n100 * ok\n")
+    with pytest.raises(ValueError, match='rx.txt:4'):
+        list(read_scenario(str(path)))
+
+def test_on_rx_waits_for_listening(emu, store, scenario):
+    scenario.load(rx_packets([b'\x01', b'\x02'], delay=100))
+    run_until(emu, 10000)
+    assert scenario.received_packets == []
+    listen(store, scenario)
+    run_until(emu, emu.clock.time + 99)
+    assert scenario.received == 0
+    run_until(emu, emu.clock.time + 1)
+    assert [packet.payload for packet in scenario.received_packets] == [b'\x01']
+    # the next one waits for the radio to listen again
+    disable(store, scenario)
+    run_until(emu, emu.clock.time + 1000)
+    assert scenario.received == 1
+    listen(store, scenario)
+    run_until(emu, emu.clock.time + 100)
+    assert scenario.received == 2
+
+def test_at_and_after(emu, store, scenario):
+    listen(store, scenario)
+    scenario.load([RxPacket(AT, 5000, ANY_FREQUENCY, True, 0, b'\x01'),
+                   RxPacket(AFTER, 3000, ANY_FREQUENCY, True, 0, b'\x02')])
+    run_until(emu, 4999)
+    assert scenario.received == 0
+    run_until(emu, 5000)
+    assert scenario.received == 1
+    # not listening when the second goes on air
+    disable(store, scenario)
+    run_until(emu, 8000)
+    assert scenario.missed == 1
+    assert scenario.missed_packets[0].payload == b'\x02'
+    assert scenario.head is None
+
+def test_other_frequency_is_missed(emu, store, scenario):
+    listen(store, scenario)
+    scenario.radio.get_reg_by_name('FREQUENCY').value = 10
+    scenario.load([RxPacket(AT, 100, 11, True, 0, b'\x01'), RxPacket(AT, 200, 10, True, 0, b'\x02')])
+    run_until(emu, 200)
+    assert [packet.payload for packet in scenario.missed_packets] == [b'\x01']
+    assert [packet.payload for packet in scenario.received_packets] == [b'\x02']
+
+def test_waiting(emu, store, scenario):
+    waiting = []
+    scenario.add_callback("waiting", lambda: waiting.append(emu.clock.time))
+    scenario.load(rx_packets([b'\x01']))
+    listen(store, scenario)
+    run_until(emu, 10)
+    assert scenario.received == 1 and waiting == []
+    # listening again with nothing left to send
+    disable(store, scenario)
+    listen(store, scenario)
+    run_until(emu, 20)
+    assert len(waiting) == 1
+    # stale once something is loaded
+    disable(store, scenario)
+    listen(store, scenario)
+    scenario.load(rx_packets([b'\x02']))
+    run_until(emu, 30)
+    assert len(waiting) == 1
+
+def test_state(emu, store, scenario):
+    scenario.load([RxPacket(AT, 1000, ANY_FREQUENCY, True, 0, b'\x01')])
+    state = scenario.save_state()
+    listen(store, scenario)
+    run_until(emu, 1000)
+    assert scenario.received == 1 and scenario.head is None
+    scenario.load_state(state)
+    assert scenario.received == 0
+    assert scenario.head.payload == b'\x01'
+
+def test_snapshot_without_scenario(emu):
+    snapshot = emu.snapshot()
+    assert snapshot.state['scenario'] is None
+    emu.restore(snapshot)
+    assert 'RADIO' not in emu.peripherals
+    # one made after the snapshot keeps its state
+    emu.scenario.load(rx_packets([b'\x01']))
+    emu.restore(snapshot)
+    assert emu.scenario.head.payload == b'\x01'
@@ -0,0 +1,89 @@
+import pytest
+from unicorn import Uc, UC_ARCH_ARM, UC_MODE_THUMB
+from unicorn.arm_const import UC_ARM_REG_R0, UC_ARM_REG_SP, UC_ARM_REG_PC, UC_ARM_REG_XPSR
+
+from core.memory import MemoryRegion, PAGE_SIZE, ZERO_PAGE
+from core.scenario import repeat_packet
+from emulator import Emulator, DEFAULT_FIRMWARE, DEFAULT_RX_PACKET, RAM_START_ADDRESS, RAM_SIZE
+
+REGISTERS = [UC_ARM_REG_R0, UC_ARM_REG_SP, UC_ARM_REG_PC, UC_ARM_REG_XPSR]
+
+
+def machine_state(emu):
+    return (emu.icount, emu.clock.time, [emu.uc.reg_read(reg) for reg in REGISTERS],
+            bytes(emu.uc.mem_read(RAM_START_ADDRESS, RAM_SIZE)),
+            {name: p.save_state() for name, p in emu.peripherals.items()}, emu.nvic.save_state())
+
+def booted(emu, seconds=6):
+    emu.scenario.load(repeat_packet(DEFAULT_RX_PACKET))
+    emu.boot()
+    emu.run(seconds=seconds)
+    return emu
+
+
+@pytest.fixture
+def region():
+    return MemoryRegion(Uc(UC_ARCH_ARM, UC_MODE_THUMB), 0x20000000, 0x40000)
+
+def test_region_restore(region):
+    region.data[0x100] = 1
+    saved = region.save()
+    assert region.restore(saved) == 0
+    region.data[0x100] = 2
+    region.data[0x3f000] = 3
+    region.data[0x3f001] = 3
+    assert region.restore(saved) == 2
+    assert region.data == saved
+
+def test_region_pages(region):
+    region.data[PAGE_SIZE] = 1
+    first = region.save_pages()
+    assert first[0] is ZERO_PAGE and first[1][0] == 1
+    region.data[2 * PAGE_SIZE] = 1
+    second = region.save_pages(first)
+    # unchanged pages are shared
+    assert second[1] is first[1] and second[2] is not first[2]
+    assert b''.join(second) == region.save()
+
+def test_restore_repeats_the_run(emu):
+    booted(emu)
+    snapshot = emu.snapshot()
+    emu.run(seconds=3)
+    expected = machine_state(emu)
+    for _ in range(2):
+        # the snapshot is left as it was, it can be restored again
+        emu.restore(snapshot)
+        emu.run(seconds=3)
+        assert machine_state(emu) == expected
+
+def test_restore_into_another_emulator(emu):
+    booted(emu)
+    snapshot = emu.snapshot()
+    before = machine_state(emu)
+    emu.run(seconds=3)
+    expected = machine_state(emu)
+    other = Emulator(DEFAULT_FIRMWARE, 0)
+    other.restore(snapshot)
+    # the models the snapshot has are created on the way
+    assert machine_state(other) == before
+    other.run(seconds=3)
+    assert machine_state(other) == expected
+
+def test_models_created_after_the_snapshot(emu):
+    snapshot = emu.snapshot()
+    assert 'RADIO' not in snapshot.peripherals
+    radio = emu.peripherals['RADIO']
+    radio.get_reg_by_name('FREQUENCY').value = 10
+    emu.restore(snapshot)
+    # back to reset, as it was before it existed
+    assert radio.get_reg_by_name('FREQUENCY').value == radio.get_reg_by_name('FREQUENCY').reset_value
+
+def test_callbacks_are_not_state(emu):
+    booted(emu)
+    snapshot = emu.snapshot()
+    toggles = []
+    gpio = emu.peripherals['P0']
+    gpio.add_callback("change", toggles.append)
+    emu.restore(snapshot)
+    emu.run(seconds=3)
+    assert gpio.callbacks["change"] == toggles.append and toggles
@@ -0,0 +1,75 @@
+import os
+
+import pytest
+
+from core import svd
+from core.svd import (SvdPeripheral, SvdRegister, SvdField, RegisterMap, AddressIndex, field_values, read_cache,
+                      write_cache, load_register_map)
+
+DIGEST = bytes(range(20))
+REGMAP = RegisterMap(
+    [SvdPeripheral('RADIO', 0x40001000, 0, 0x1000),
+     SvdPeripheral('UART0', 0x40002000, 0, 0x1000),
+     SvdPeripheral('UARTE0', 0x40002000, 0, 0x1000),
+     SvdPeripheral('P0', 0x50000000, 0, 0x1000),
+     SvdPeripheral('P1', 0x50000300, 0, 0x1000)],
+    [SvdRegister('TASKS_TXEN', 0x40001000, 32, 0, 'write-only', 'RADIO', ()),
+     SvdRegister('PCNF0', 0x40001514, 32, 0, 'read-write', 'RADIO',
+                 (SvdField('LFLEN', 0, 4), SvdField('S0LEN', 8, 1), SvdField('PLEN', 24, 2))),
+     SvdRegister('ENABLE', 0x40002500, 32, 0, 'read-write', 'UART0', ()),
+     # UARTE0 has one at the same address, the first one names it
+     SvdRegister('ENABLE', 0x40002500, 32, 0, 'read-write', 'UARTE0', ()),
+     SvdRegister('OUT', 0x50000504, 32, 0, 'read-write', 'P0', ()),
+     SvdRegister('OUT', 0x50000804, 32, 0, 'read-write', 'P1', ()),
+     SvdRegister('PIN_CNF[0]', 0x50000a00, 32, 2, None, 'P1', (SvdField('DIR', 0, 1),))])
+
+
+@pytest.fixture(autouse=True)
+def cache_dir(tmp_path, monkeypatch):
+    # register maps built here stay out of data/.cache
+    monkeypatch.setattr(svd, 'CACHE_DIR', str(tmp_path / 'cache'))
+    return tmp_path / 'cache'
+
+
+def test_cache_round_trip(tmp_path):
+    path = str(tmp_path / 'map.regmap')
+    write_cache(path, DIGEST, REGMAP)
+    regmap = read_cache(path, DIGEST)
+    assert regmap.peripherals == REGMAP.peripherals
+    assert regmap.registers == REGMAP.registers
+    # built from another SVD
+    assert read_cache(path, bytes(20)) is None
+
+def test_load_register_map(cache_dir, monkeypatch):
+    stale = cache_dir / 'nrf52840-0000.regmap'
+    os.makedirs(str(cache_dir))
+    stale.write_bytes(b'')
+    regmap = load_register_map()
+    assert not stale.exists()
+    assert len(os.listdir(str(cache_dir))) == 1
+    # from the cache now, the SVD isn't parsed again
+    monkeypatch.setattr(svd, 'parse_svd', None)
+    cached = load_register_map()
+    assert cached.peripherals == regmap.peripherals
+    assert cached.registers == regmap.registers
+
+def test_address_index():
+    index = AddressIndex(REGMAP)
+    assert index.peripheral(0x40001000) == 'RADIO'
+    # inside the block, no register there
+    assert index.peripheral(0x40001ffc) == 'RADIO'
+    assert index.peripheral(0x40002500) == index.peripheral(0x40002ffc) == 'UART0/UARTE0'
+    assert index.register(0x40002500).peripheral == 'UART0'
+    # the P0 and P1 blocks overlap, their registers tell them apart
+    assert index.peripheral(0x50000504) == 'P0'
+    assert index.peripheral(0x50000804) == 'P1'
+    assert index.peripheral(0x50000100) == 'P0'
+    assert index.peripheral(0x3fffff00) is None
+    assert index.peripheral(0x60000000) is None
+    # byte accesses find the register of their word
+    assert index.register(0x40001516).name == 'PCNF0'
+    assert index.register(0x40001518) is None
+
+def test_field_values():
+    pcnf0 = REGMAP.registers[1]
+    assert field_values(pcnf0, 0x01000108) == [('LFLEN', 8), ('S0LEN', 1), ('PLEN', 1)]
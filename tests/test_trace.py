@@ -0,0 +1,64 @@
+import io
+
+import pytest
+
+from core import trace as tracing
+from core.trace import Record, TraceWriter, iter_records, read_chunks, read_trace
+
+EVENTS = [
+    Record(tracing.MMIO_WRITE, 4, 0x1c84, 1045, 0x40001000, 1, None),
+    Record(tracing.IRQ_ENTER, 4, 0x1d28, 2000, 0, 17, None),
+    Record(tracing.RADIO_TX, 3, 0x1c84, 2100, 46, 0, b'\x00D\x00'),
+    Record(tracing.MMIO_READ, 1, 0x1d34, 1 << 40, 0x40001304, 0xa, None),
+    # payload spread over several DATA records
+    Record(tracing.RADIO_RX, 40, 0x1d34, 3000, 80, 0, bytes(range(40))),
+    Record(tracing.RADIO_TX, 0, 0x1c84, 3100, 2, 0, b''),
+    Record(tracing.GPIO_OUTSET, 4, 0x2086, 4000, 0x50000508, 0x8000, None),
+]
+
+
+def write(writer, events):
+    for event in events:
+        if event.type in (tracing.RADIO_TX, tracing.RADIO_RX):
+            writer.payload(event.type, event.pc, event.time, event.address, event.payload)
+        else:
+            writer.record(event.type, event.pc, event.time, event.address, event.value, event.size)
+
+
+@pytest.mark.parametrize('capacity', [tracing.DEFAULT_CAPACITY, 3])
+def test_file_round_trip(tmp_path, capacity):
+    # a small buffer is written out many times, payloads straddle the flushes
+    path = str(tmp_path / 'run.trace')
+    writer = TraceWriter(path, capacity)
+    write(writer, EVENTS * 3)
+    writer.close()
+    assert list(read_trace(path)) == EVENTS * 3
+
+def test_ring_keeps_latest():
+    writer = TraceWriter(capacity=8)
+    write(writer, EVENTS)
+    # the oldest records were overwritten, the first payload left is cut short
+    # or dropped, everything after it is whole
+    records = list(iter_records([writer.contents()]))
+    assert records[-3:] == EVENTS[-3:]
+    assert len(writer.contents()) == 8 * tracing.RECORD_SIZE
+
+def test_ring_save(tmp_path):
+    path = str(tmp_path / 'ring.trace')
+    writer = TraceWriter(capacity=64)
+    write(writer, EVENTS)
+    writer.save(path)
+    assert list(read_trace(path)) == EVENTS
+
+def test_unfinished_trace():
+    # a partial record at the end is left out
+    fp = io.BytesIO()
+    fp.write(tracing.HEADER.pack(tracing.MAGIC, tracing.VERSION, tracing.RECORD_SIZE))
+    fp.write(tracing.RECORD.pack(tracing.IRQ_EXIT, 4, 0x744, 10, 0, 17))
+    fp.write(b'\x02\x00')
+    fp.seek(0)
+    assert list(iter_records(read_chunks(fp))) == [Record(tracing.IRQ_EXIT, 4, 0x744, 10, 0, 17, None)]
+
+def test_not_a_trace():
+    with pytest.raises(ValueError):
+        list(read_chunks(io.BytesIO(b'NRFSYMS1' + bytes(8))))
@@ -0,0 +1,86 @@
+import pytest
+
+from core import trace as tracing
+from core.trace import Record, TraceWriter
+from core.tracediff import first_divergence
+
+TXEN = 0x40001000
+CAPTURE = 0x40008040
+
+
+def mmio(address, value, pc=0x1c84, time=0):
+    return Record(tracing.MMIO_WRITE, 4, pc, time, address, value, None)
+
+def radio(kind, payload, time=0):
+    return Record(kind, len(payload), 0x1d34, time, 80, 0, payload)
+
+def read(address):
+    return Record(tracing.MMIO_READ, 4, 0x1d30, 0, address, 0, None)
+
+# a boot, long enough to span a few chunks
+PREFIX = [mmio(0x40000000 + 4 * i, i, time=10 * i) for i in range(40)]
+
+
+def save(path, events):
+    writer = TraceWriter(str(path))
+    for event in events:
+        if event.type in (tracing.RADIO_TX, tracing.RADIO_RX):
+            writer.payload(event.type, event.pc, event.time, event.address, event.payload)
+        else:
+            writer.record(event.type, event.pc, event.time, event.address, event.value, event.size)
+    writer.close()
+    return str(path)
+
+def diff(tmp_path, events_a, events_b, **kwargs):
+    return first_divergence(save(tmp_path / 'a.trace', events_a), save(tmp_path / 'b.trace', events_b), **kwargs)
+
+
+@pytest.fixture(autouse=True, params=[4, 7, 4096])
+def chunk_size(request, monkeypatch):
+    # small chunks put the events on both sides of chunk boundaries
+    monkeypatch.setattr(tracing, 'READ_CHUNK', tracing.RECORD_SIZE * request.param)
+
+
+def test_same_events(tmp_path):
+    assert diff(tmp_path, PREFIX, PREFIX) is None
+    # pcs, times and reads don't count
+    moved = [event._replace(pc=event.pc + 2, time=event.time + 5) for event in PREFIX]
+    assert diff(tmp_path, PREFIX + [read(TXEN)], moved) is None
+
+def test_first_difference(tmp_path):
+    a = PREFIX + [mmio(TXEN, 1), read(CAPTURE), mmio(CAPTURE, 1), mmio(TXEN, 0)]
+    b = PREFIX + [mmio(TXEN, 1), mmio(CAPTURE, 2), mmio(TXEN, 0)]
+    divergence = diff(tmp_path, a, b, context=3)
+    # indices count every record of the trace
+    assert (divergence.index_a, divergence.index_b) == (42, 41)
+    assert (divergence.record_a.value, divergence.record_b.value) == (1, 2)
+    assert [index for index, _ in divergence.context_a] == [38, 39, 40]
+    assert [record for _, record in divergence.context_b] == b[38:41]
+
+def test_repeats(tmp_path):
+    a = PREFIX + [mmio(CAPTURE, 1), mmio(TXEN, 1)]
+    b = PREFIX + [mmio(CAPTURE, 1)] * 3 + [mmio(TXEN, 1)]
+    assert diff(tmp_path, a, b) is None
+    divergence = diff(tmp_path, a, b, repeats=True)
+    assert divergence.record_a == mmio(TXEN, 1)
+    assert divergence.record_b == mmio(CAPTURE, 1)
+
+def test_trace_ends(tmp_path):
+    divergence = diff(tmp_path, PREFIX, PREFIX + [mmio(TXEN, 1)])
+    assert divergence.record_a is None and divergence.index_a == len(PREFIX)
+    assert divergence.record_b == mmio(TXEN, 1)
+
+def test_payloads(tmp_path):
+    # a payload over several DATA records
+    DATA_RECORDS = 3
+    packet = bytes(range(60))
+    other = packet[:-1] + b'\xff'
+    a = PREFIX + [radio(tracing.RADIO_RX, packet), radio(tracing.RADIO_TX, packet), mmio(TXEN, 1)]
+    b = PREFIX + [radio(tracing.RADIO_RX, other), radio(tracing.RADIO_TX, other), mmio(TXEN, 1)]
+    divergence = diff(tmp_path, a, b)
+    # what was received only counts if asked for
+    assert divergence.record_a == a[41] and divergence.record_b == b[41]
+    assert divergence.index_a == divergence.index_b == len(PREFIX) + 1 + DATA_RECORDS
+    divergence = diff(tmp_path, a, b, kinds=(tracing.RADIO_RX,))
+    assert divergence.record_a.payload == packet and divergence.index_a == len(PREFIX)
+    assert diff(tmp_path, a, b, kinds=(tracing.MMIO_WRITE,)) is None
@@ -0,0 +1,170 @@
+import pytest
+
+from core.vclock import CPU_FREQUENCY, VirtualClock, NEVER, POLL_THRESHOLD, MIN_WARP, seconds_to_cycles
+from peripherals.rtc import RTC1, LFCLK_FREQUENCY
+from peripherals.timer import Timer_0
+
+
+def run_until(clock, time):
+    # what the emulator does between blocks: run what is due, then move on
+    while clock.next_deadline <= time:
+        clock.advance(clock.next_deadline - clock.time)
+        clock.run_due()
+    clock.advance(time - clock.time)
+
+def make(cls, clock):
+    peripheral = cls()
+    peripheral.clock = clock
+    return peripheral
+
+def event(peripheral, name):
+    return peripheral.get_reg_by_name('EVENTS_' + name).value
+
+def task(peripheral, name):
+    peripheral.write(None, peripheral.get_reg_by_name('TASKS_' + name).address, 1)
+
+def write(peripheral, name, value):
+    register = peripheral.get_reg_by_name(name)
+    peripheral.write(None, register.address, value)
+    register.value = value
+
+
+def test_events_in_order():
+    clock = VirtualClock()
+    fired = []
+    clock.schedule(30, fired.append, 'c')
+    clock.schedule(10, fired.append, 'a')
+    clock.schedule(10, fired.append, 'b')
+    assert clock.next_deadline == 10
+    # never past the next event
+    clock.advance(100)
+    assert clock.time == 10 and clock.skipped == 10
+    clock.run_due()
+    assert fired == ['a', 'b']
+    assert clock.next_deadline == 30
+    clock.skip_to_next_event()
+    clock.run_due()
+    assert fired == ['a', 'b', 'c']
+    assert clock.next_deadline == NEVER
+
+def test_idle_poll_warps():
+    clock = VirtualClock()
+    clock.schedule(seconds_to_cycles(1), None)
+    # the first read starts the streak
+    for _ in range(POLL_THRESHOLD + 1):
+        clock.time += 10
+        clock.idle_poll('counter')
+    assert clock.skipped == MIN_WARP
+    # something else polled, the streak starts over
+    clock.idle_poll('other')
+    assert clock.poll_streak == 0 and clock.warp == 0
+
+def test_save_load():
+    clock = VirtualClock()
+    fired = []
+    clock.schedule(10, fired.append, 1)
+    state = clock.save_state()
+    clock.schedule(5, fired.append, 2)
+    run_until(clock, 20)
+    assert fired == [2, 1]
+    clock.load_state(state)
+    assert clock.time == 0 and clock.next_deadline == 10
+    run_until(clock, 20)
+    assert fired == [2, 1, 1]
+
+def test_timer_compare():
+    clock = VirtualClock()
+    timer = make(Timer_0, clock)
+    # 1 MHz after reset
+    tick = timer.cycles_per_tick()
+    assert tick == CPU_FREQUENCY // 1000000
+    write(timer, 'CC[0]', 100)
+    task(timer, 'START')
+    run_until(clock, 100 * tick - 1)
+    assert not event(timer, 'COMPARE[0]')
+    run_until(clock, 100 * tick)
+    assert event(timer, 'COMPARE[0]')
+    task(timer, 'CAPTURE[1]')
+    assert timer.get_reg_by_name('CC[1]').value == 100
+
+def test_timer_cc_write_keeps_other_compares():
+    clock = VirtualClock()
+    timer = make(Timer_0, clock)
+    tick = timer.cycles_per_tick()
+    write(timer, 'CC[0]', 100)
+    task(timer, 'START')
+    queued = len(clock.queue)
+    write(timer, 'CC[1]', 50)
+    # only CC[1] is scheduled again
+    assert len(clock.queue) == queued + 1
+    run_until(clock, 50 * tick)
+    assert event(timer, 'COMPARE[1]') and not event(timer, 'COMPARE[0]')
+    run_until(clock, 100 * tick)
+    assert event(timer, 'COMPARE[0]')
+
+def test_timer_prescaler_and_stop():
+    clock = VirtualClock()
+    timer = make(Timer_0, clock)
+    write(timer, 'PRESCALER', 0)
+    # the 16 MHz peripheral clock
+    tick = timer.cycles_per_tick()
+    assert tick == CPU_FREQUENCY // 16000000
+    write(timer, 'CC[2]', 10)
+    task(timer, 'START')
+    run_until(clock, 5 * tick)
+    task(timer, 'STOP')
+    # stopped half way, nothing comes
+    run_until(clock, 100 * tick)
+    assert not event(timer, 'COMPARE[2]')
+    task(timer, 'CAPTURE[0]')
+    assert timer.get_reg_by_name('CC[0]').value == 5
+
+def test_timer_counter_mode():
+    clock = VirtualClock()
+    timer = make(Timer_0, clock)
+    write(timer, 'MODE', 1)
+    write(timer, 'CC[3]', 3)
+    task(timer, 'START')
+    for _ in range(2):
+        task(timer, 'COUNT')
+    assert not event(timer, 'COMPARE[3]')
+    # time alone doesn't count
+    run_until(clock, seconds_to_cycles(1))
+    assert not event(timer, 'COMPARE[3]')
+    task(timer, 'COUNT')
+    assert event(timer, 'COMPARE[3]')
+    task(timer, 'CAPTURE[0]')
+    assert timer.get_reg_by_name('CC[0]').value == 3
+
+def test_timer_state_restores_compares():
+    clock = VirtualClock()
+    timer = make(Timer_0, clock)
+    write(timer, 'CC[0]', 100)
+    task(timer, 'START')
+    state = (clock.save_state(), timer.save_state())
+    write(timer, 'CC[0]', 1000)
+    clock.load_state(state[0])
+    timer.load_state(state[1])
+    run_until(clock, 100 * timer.cycles_per_tick())
+    assert event(timer, 'COMPARE[0]')
+
+@pytest.mark.parametrize('prescaler', [0, 7])
+def test_rtc_compare(prescaler):
+    clock = VirtualClock()
+    rtc = make(RTC1, clock)
+    write(rtc, 'PRESCALER', prescaler)
+    write(rtc, 'CC[0]', 20)
+    write(rtc, 'CC[1]', 40)
+    task(rtc, 'START')
+    deadline = 20 * (prescaler + 1) * CPU_FREQUENCY // LFCLK_FREQUENCY
+    run_until(clock, deadline - 1)
+    assert not event(rtc, 'COMPARE[0]')
+    run_until(clock, deadline + 1)
+    assert event(rtc, 'COMPARE[0]') and not event(rtc, 'COMPARE[1]')
+    assert rtc.get_counter() == 20
+    # moving CC[0] leaves CC[1] alone
+    queued = len(clock.queue)
+    write(rtc, 'CC[0]', 60)
+    assert len(clock.queue) == queued + 1
+    run_until(clock, 2 * deadline + 1)
+    assert event(rtc, 'COMPARE[1]')
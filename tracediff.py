@@ -0,0 +1,47 @@
+import argparse
+import sys
+import time
+
+from core import trace as tracing
+from core.image import SymbolIndex, image_symbols
+from core.tracediff import DEFAULT_KINDS, DEFAULT_CONTEXT, first_divergence
+from tracedump import TYPES_BY_NAME, register_names, format_record
+
+
+def print_side(label, path, index, record, context, names, symbols):
+    print("[*] %s: record %d of %s" % (label, index, path))
+    for i, event in context:
+        print("    %10d %s" % (i, format_record(event, names, symbols)))
+    if record is None:
+        print("  > %10d end of trace" % index)
+    else:
+        print("  > %10d %s" % (index, format_record(record, names, symbols)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="first difference in the peripheral events of two traces, exit status 1 if there is one")
+    parser.add_argument('a')
+    parser.add_argument('b')
+    parser.add_argument('-t', '--type', action='append', choices=sorted(TYPES_BY_NAME),
+                        help="compare records of this type, can be repeated (default: %s)" %
+                             ", ".join(tracing.RECORD_TYPES[kind] for kind in DEFAULT_KINDS))
+    parser.add_argument('-r', '--repeats', action='store_true', help="runs of the same event don't count as one")
+    parser.add_argument('-c', '--context', type=int, default=DEFAULT_CONTEXT, help="events shown before the divergence")
+    parser.add_argument('--firmware-a', help="ELF image trace a was made with, names the pcs")
+    parser.add_argument('--firmware-b', help="ELF image trace b was made with")
+    args = parser.parse_args()
+
+    kinds = [TYPES_BY_NAME[name] for name in args.type] if args.type else DEFAULT_KINDS
+    start = time.time()
+    divergence = first_divergence(args.a, args.b, kinds, args.repeats, args.context)
+    elapsed = time.time() - start
+    if divergence is None:
+        print("[*] same events, %.3fs" % elapsed)
+        sys.exit(0)
+    names = register_names()
+    print("[*] traces diverge, %.3fs" % elapsed)
+    print_side("a", args.a, divergence.index_a, divergence.record_a, divergence.context_a, names,
+               image_symbols(args.firmware_a) if args.firmware_a else SymbolIndex())
+    print_side("b", args.b, divergence.index_b, divergence.record_b, divergence.context_b, names,
+               image_symbols(args.firmware_b) if args.firmware_b else SymbolIndex())
+    sys.exit(1)
@@ -0,0 +1,109 @@
+import argparse
+from collections import Counter
+
+from core import trace as tracing
+from core.image import SymbolIndex, image_symbols
+from core.svd import load_register_map
+from core.vclock import cycles_to_us
+
+TYPES_BY_NAME = {name: kind for kind, name in tracing.RECORD_TYPES.items()}
+
+
+def register_names():
+    return {reg.address: "%s.%s" % (reg.peripheral, reg.name) for reg in load_register_map().registers}
+
+def filter_records(records, kinds=None, begin=None, end=None, irq=None):
+    for record in records:
+        if kinds and record.type not in kinds:
+            continue
+        if begin is not None and record.address < begin:
+            continue
+        if end is not None and record.address >= end:
+            continue
+        if irq is not None and (record.type not in (tracing.IRQ_ENTER, tracing.IRQ_EXIT) or record.value != irq):
+            continue
+        yield record
+
+def format_record(record, names, symbols=SymbolIndex()):
+    kind = tracing.RECORD_TYPES.get(record.type, "type%d" % record.type)
+    line = "%12dus pc=%-7s %-11s" % (cycles_to_us(record.time), symbols.name(record.pc), kind)
+    if record.type in (tracing.MMIO_READ, tracing.MMIO_WRITE):
+        line += " %s (0x%08x) = 0x%x" % (names.get(record.address, "?"), record.address, record.value)
+    elif record.type in (tracing.IRQ_ENTER, tracing.IRQ_EXIT):
+        line += " irq %d" % record.value
+    elif record.type in (tracing.GPIO_OUTSET, tracing.GPIO_OUTCLR):
+        line += " pins 0x%08x" % record.value
+    else:
+        line += " freq %d %s" % (record.address, record.payload.hex())
+    return line
+
+def summarize(records, names):
+    kinds = Counter()
+    registers = Counter()
+    irqs = Counter()
+    pins = Counter()
+    packets = Counter()
+    first = last = None
+    for record in records:
+        if first is None:
+            first = record.time
+        last = record.time
+        kinds[record.type] += 1
+        if record.type in (tracing.MMIO_READ, tracing.MMIO_WRITE):
+            registers[(record.type, record.address)] += 1
+        elif record.type == tracing.IRQ_ENTER:
+            irqs[record.value] += 1
+        elif record.type in (tracing.GPIO_OUTSET, tracing.GPIO_OUTCLR):
+            pins[(record.type, record.value)] += 1
+        elif record.type in (tracing.RADIO_TX, tracing.RADIO_RX):
+            packets[(record.type, record.address, record.payload)] += 1
+
+    if first is None:
+        print("[*] empty trace")
+        return
+    print("[*] %d records, %dus to %dus" % (sum(kinds.values()), cycles_to_us(first), cycles_to_us(last)))
+    for kind, count in sorted(kinds.items()):
+        print("    %-11s %d" % (tracing.RECORD_TYPES.get(kind, kind), count))
+    if registers:
+        print("[*] registers")
+        for (kind, address), count in registers.most_common():
+            print("    %-5s %-32s %d" % ("read" if kind == tracing.MMIO_READ else "write",
+                                         names.get(address, hex(address)), count))
+    if irqs:
+        print("[*] interrupts")
+        for irq, count in sorted(irqs.items()):
+            print("    irq %-3d %d" % (irq, count))
+    if pins:
+        print("[*] gpio")
+        for (kind, mask), count in sorted(pins.items()):
+            print("    %s 0x%08x %d" % ("set" if kind == tracing.GPIO_OUTSET else "clr", mask, count))
+    if packets:
+        print("[*] radio")
+        for (kind, frequency, payload), count in packets.most_common():
+            print("    %s freq %-3d %s %d" % ("tx" if kind == tracing.RADIO_TX else "rx", frequency, payload.hex(), count))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="print or summarize a binary emulator trace")
+    parser.add_argument('trace')
+    parser.add_argument('-t', '--type', action='append', choices=sorted(TYPES_BY_NAME),
+                        help="only records of this type, can be repeated")
+    parser.add_argument('--begin', type=lambda x: int(x, 0), help="lowest address")
+    parser.add_argument('--end', type=lambda x: int(x, 0), help="address past the last one")
+    parser.add_argument('--irq', type=int, help="only enter/exit of this irq")
+    parser.add_argument('-n', '--limit', type=int, help="stop after this many records")
+    parser.add_argument('-s', '--summary', action='store_true', help="counts instead of records")
+    parser.add_argument('-f', '--firmware', help="ELF image the trace was made with, names the pcs")
+    args = parser.parse_args()
+
+    kinds = {TYPES_BY_NAME[name] for name in args.type} if args.type else None
+    records = filter_records(tracing.read_trace(args.trace), kinds, args.begin, args.end, args.irq)
+    names = register_names()
+    symbols = image_symbols(args.firmware) if args.firmware else SymbolIndex()
+    if args.summary:
+        summarize(records, names)
+    else:
+        for i, record in enumerate(records):
+            if args.limit is not None and i >= args.limit:
+                break
+            print(format_record(record, names, symbols))